@@ -1,5 +1,70 @@
+import functools
+import multiprocessing
+import sys
+
 import parse_args
-from image_sort import image_sort
+from engines import ActiveRankingEngine, ENGINES, TopKEngine, TreeEngine
+from library import Library
+from metrics import Metrics
+from trees import SnapshotHistory
+
+if __name__ == '__main__':
+    # thumbnails are made in worker processes, which import this module
+    # again under another name; the executable needs this to start them
+    multiprocessing.freeze_support()
+
+    args = parse_args.parse()
+    files = parse_args.args_files(args)
+    engine = ENGINES[args.engine]
+    if engine is ActiveRankingEngine:
+        engine = functools.partial(
+            ActiveRankingEngine, confidence=args.confidence)
+    if args.top is not None:
+        engine = functools.partial(TopKEngine, k=args.top)
+    library = None
+    if args.library:
+        library = Library(args.library)
+    if engine is TreeEngine and args.undo_limit:
+        if args.undo_limit < 0:
+            sys.exit('--undo-limit must not be negative')
+        engine = functools.partial(
+            TreeEngine, history=SnapshotHistory(args.undo_limit))
+    duplicates = {}
+    if args.dedup:
+        # Pillow is only imported when it is needed
+        import dedup
+
+        # every file is needed to find the copies of each
+        files = files.wait()
+        duplicates = dedup.find_duplicates(
+            files, perceptual=args.dedup == 'perceptual')
+        copies = {f for group in duplicates.values() for f in group}
+        files = [f for f in files if f not in copies]
+    metrics = None
+    if args.metrics or args.metrics_log:
+        metrics = Metrics(args.metrics_log)
+    try:
+        if args.answers:
+            from headless_sort import headless_sort
+            from oracles import ScriptedOracle
+
+            oracle = ScriptedOracle(args.answers)
+            result = headless_sort(files, oracle, engine=engine,
+                                   metrics=metrics, library=library)
+        else:
+            # only import Kivy when a window is needed
+            from image_sort import image_sort
 
-files = parse_args.args_files()
-print(image_sort(files))
+            result = image_sort(files, engine=engine, metrics=metrics,
+                                library=library)
+        if duplicates:
+            result = dedup.restore_duplicates(result, duplicates)
+        print(result)
+        if args.answers and oracle.pending:
+            print('Out of answers; next comparison: {} vs {}'.format(
+                *oracle.pending), file=sys.stderr)
+    finally:
+        if metrics is not None:
+            if args.metrics:
+                metrics.write(args.metrics)
+            metrics.close()
@@ -0,0 +1,358 @@
+import argparse
+import bisect
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+from engines import ENGINES, ActiveRankingEngine, SortEngine
+from trees import AVLTree, MyTree, OperationLog, SaveStateTree, UndoTree
+
+
+class SimulatedUser:
+    """
+    An oracle that knows the true order of the values, like a user who
+    never makes a mistake, but who clicks undo at random.
+    """
+
+    def __init__(self, undo_rate, seed):
+        """
+        Create the oracle.
+
+        :param undo_rate: Chance of undoing instead of answering each
+                          comparison
+        :type undo_rate: float
+        :param seed: Seed for choosing when to undo
+        :type seed: int
+        """
+
+        self.undo_rate = undo_rate
+        self.random = random.Random(seed)
+        self.comparisons = 0  # comparisons answered
+        self.undos = 0
+
+    def __call__(self, value, other):
+        """
+        Answer a comparison, or undo the previous one.
+
+        :param value: A value
+        :type value: int
+        :param other: The value to compare to
+        :type other: int
+        :return: 1 if `value` is greater than `other`, -1 if it is less,
+                 or 0 if they are equal
+        :rtype: int
+        """
+
+        if self.undo_rate and self.random.random() < self.undo_rate:
+            self.undos += 1
+            raise SortEngine.UndoClicked
+        self.comparisons += 1
+        return (value > other) - (value < other)
+
+
+def _with_oracle(tree_class):
+    """
+    Make a tree class without undo ask an oracle, like
+    :class:`trees.UndoTree` does.
+
+    :param tree_class: :class:`trees.AVLTree` or :class:`trees.MyTree`
+    :type tree_class: type
+    :return: The subclass
+    :rtype: type
+    """
+
+    class Tree(tree_class):
+        def __init__(self, oracle):
+            super().__init__()
+            self.oracle = oracle
+
+        def _less(self, value, other):
+            return self.oracle(value, other) < 0
+
+        def _greater(self, value, other):
+            return self.oracle(value, other) > 0
+
+    return Tree
+
+
+def _sort_tree(make_tree):
+    """
+    Get a function that sorts by inserting into a tree.
+
+    :param make_tree: Called with the oracle and the name of a save file
+                      to create the tree
+    :type make_tree: function
+    :return: The function, called with the values, the oracle and the
+             name of a save file, returning the sorted list and the
+             object holding the state
+    :rtype: function
+    """
+
+    def sort(values, oracle, filename):
+        tree = make_tree(oracle, filename)
+        for value in values:
+            tree.insert(value)
+        return tree.to_list(), tree
+
+    return sort
+
+
+def _sort_engine(engine):
+    """
+    Get a function that sorts with a sort engine.
+
+    :param engine: The :class:`engines.SortEngine` subclass
+    :type engine: type
+    :return: The function, like the one from :func:`_sort_tree`
+    :rtype: function
+    """
+
+    def sort(values, oracle, filename):
+        sorter = engine(filename, oracle=oracle)
+        return sorter.sort(values), sorter
+
+    return sort
+
+
+# every structure benchmarked, with whether it can undo and save
+STRUCTURES = {
+    'AVLTree': (_sort_tree(
+        lambda oracle, _filename: _with_oracle(AVLTree)(oracle)),
+        False, False),
+    'MyTree': (_sort_tree(
+        lambda oracle, _filename: _with_oracle(MyTree)(oracle)),
+        False, False),
+    'UndoTree': (_sort_tree(
+        lambda oracle, _filename: UndoTree(oracle=oracle)), True, False),
+    'UndoTree-oplog': (_sort_tree(
+        lambda oracle, _filename: UndoTree(OperationLog(), oracle)),
+        True, False),
+    'SaveStateTree': (_sort_tree(
+        lambda oracle, filename: SaveStateTree(filename, oracle=oracle)),
+        True, True),
+}
+STRUCTURES.update(
+    (name, (_sort_engine(engine), True, True))
+    for name, engine in ENGINES.items() if name != 'tree')
+
+# how far the active engine's estimate of its accuracy may be above the
+# true accuracy; the estimate is from a sample of pairs
+ESTIMATE_TOLERANCE = 0.05
+
+
+def make_values(n_items, order, rng):
+    """
+    Make the values to sort.
+
+    :param n_items: Number of values
+    :type n_items: int
+    :param order: 'random', 'sorted', 'reversed' or 'nearly-sorted'
+                  (sorted, then 5% of the values swapped with a random
+                  value)
+    :type order: str
+    :param rng: Random number generator
+    :type rng: random.Random
+    :return: The values, all different
+    :rtype: list
+    """
+
+    values = rng.sample(range(10 * n_items), n_items)
+    if order == 'sorted':
+        values.sort()
+    elif order == 'reversed':
+        values.sort(reverse=True)
+    elif order == 'nearly-sorted':
+        values.sort()
+        for _ in range(max(1, n_items // 20)):
+            i, j = rng.randrange(n_items), rng.randrange(n_items)
+            values[i], values[j] = values[j], values[i]
+    return values
+
+
+def ranking_accuracy(ranking):
+    """
+    Get the fraction of pairs of values that a ranking orders correctly.
+
+    :param ranking: The values, from least to greatest as ranked
+    :type ranking: list
+    :return: The fraction of pairs in the right order
+    :rtype: float
+    """
+
+    pairs = len(ranking) * (len(ranking) - 1) // 2
+    if not pairs:
+        return 1.0
+    seen = []
+    wrong = 0
+    for value in ranking:
+        # every value already seen that is greater is ranked wrongly
+        i = bisect.bisect(seen, value)
+        wrong += len(seen) - i
+        seen.insert(i, value)
+    return 1 - wrong / pairs
+
+
+def run(structure, n_items, order, undo_rate, seed, directory,
+        memory=True):
+    """
+    Sort one list of values and measure it.
+
+    The values are sorted once to measure time, then again, the same
+    way, with :mod:`tracemalloc` running to measure memory, since it
+    slows everything down.
+
+    :param structure: Name of the structure, a key of `STRUCTURES`
+    :type structure: str
+    :param n_items: Number of values
+    :type n_items: int
+    :param order: Order of the values, see :func:`make_values`
+    :type order: str
+    :param undo_rate: Chance of undoing each comparison
+    :type undo_rate: float
+    :param seed: Seed for the values and the simulated user
+    :type seed: int
+    :param directory: Directory for save files
+    :type directory: str
+    :param memory: Whether to measure memory, defaults to True
+    :type memory: bool
+    :return: The measurements
+    :rtype: dict
+    """
+
+    sort, _can_undo, saves = STRUCTURES[structure]
+    values = make_values(n_items, order, random.Random(seed))
+    filename = os.path.join(directory, structure + '.tree')
+
+    def measured_sort():
+        if os.path.exists(filename):
+            os.remove(filename)
+        oracle = SimulatedUser(undo_rate, seed)
+        start = time.perf_counter()
+        result, state = sort(values, oracle, filename)
+        seconds = time.perf_counter() - start
+        if isinstance(state, ActiveRankingEngine):
+            # only ranks approximately, but must be as good as it says
+            accuracy = ranking_accuracy(result)
+            if accuracy < state.estimate() - ESTIMATE_TOLERANCE:
+                raise AssertionError(
+                    '{} estimated {:.3f} but ranked {:.3f} of pairs '
+                    'correctly'.format(
+                        structure, state.estimate(), accuracy))
+        elif result != sorted(values):
+            raise AssertionError('{} sorted wrongly'.format(structure))
+        return oracle, seconds, state
+
+    oracle, seconds, state = measured_sort()
+
+    state_bytes = None
+    if saves:
+        # the size of a checkpoint, without the journal records
+        try:
+            state.exit()
+        except SaveStateTree.Exit:
+            pass
+        state_bytes = os.path.getsize(filename)
+        state.delete_file()
+
+    peak_bytes = None
+    if memory:
+        tracemalloc.start()
+        measured_sort()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if saves:
+            os.remove(filename)
+
+    return {
+        'structure': structure,
+        'n_items': n_items,
+        'order': order,
+        'undo_rate': undo_rate,
+        'comparisons': oracle.comparisons,
+        'comparisons_per_item': oracle.comparisons / n_items,
+        'undos': oracle.undos,
+        'seconds': seconds,
+        'seconds_per_insert': seconds / n_items,
+        'peak_bytes': peak_bytes,
+        'peak_bytes_per_item': (
+            None if peak_bytes is None else peak_bytes / n_items),
+        'state_bytes': state_bytes,
+    }
+
+
+def main():
+    """
+    Run the benchmarks chosen on the command line, printing a table and
+    optionally saving the results as JSON.
+
+    :return: None
+    """
+
+    parser = argparse.ArgumentParser(
+        description='benchmark the sorting structures with a simulated '
+                    'user')
+    parser.add_argument(
+        '-s', '--structures', nargs='+', choices=list(STRUCTURES),
+        default=list(STRUCTURES))
+    parser.add_argument(
+        '-n', '--sizes', nargs='+', type=int, default=[100, 1000])
+    parser.add_argument(
+        '--orders', nargs='+', default=['random', 'sorted', 'reversed',
+                                        'nearly-sorted'],
+        choices=['random', 'sorted', 'reversed', 'nearly-sorted'])
+    parser.add_argument(
+        '-u', '--undo-rates', nargs='+', type=float, default=[0, 0.05],
+        help='chances of undoing each comparison; structures that cannot '
+             'undo only run with 0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--no-memory', action='store_true',
+        help='skip measuring memory, which sorts everything twice')
+    parser.add_argument(
+        '-o', '--output',
+        help='JSON file to save the results to, to compare with other '
+             'versions')
+    args = parser.parse_args()
+
+    results = []
+    columns = '{:<16}{:>7} {:<14}{:>6}{:>12}{:>14}{:>12}{:>12}'
+    print(columns.format('Structure', 'Items', 'Order', 'Undo',
+                         'Cmp/item', 'Seconds/ins', 'Bytes/item',
+                         'State'))
+    with tempfile.TemporaryDirectory() as directory:
+        for structure in args.structures:
+            can_undo = STRUCTURES[structure][1]
+            for n_items in args.sizes:
+                for order in args.orders:
+                    for undo_rate in args.undo_rates:
+                        if undo_rate and not can_undo:
+                            continue
+                        result = run(structure, n_items, order, undo_rate,
+                                     args.seed, directory,
+                                     not args.no_memory)
+                        results.append(result)
+                        print(columns.format(
+                            structure, n_items, order, undo_rate,
+                            '{:.2f}'.format(result['comparisons_per_item']),
+                            '{:.2e}'.format(result['seconds_per_insert']),
+                            '-' if result['peak_bytes'] is None else
+                            '{:.0f}'.format(result['peak_bytes_per_item']),
+                            '-' if result['state_bytes'] is None else
+                            result['state_bytes']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
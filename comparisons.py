@@ -0,0 +1,269 @@
+import itertools
+
+
+class ComparisonCache:
+    """
+    Remembers the answer to every comparison, so that the user is not
+    asked for an answer that is already known.
+
+    Known orderings are kept as a directed acyclic graph, with an edge
+    from each value to each value it was found to be less than. An
+    answer is known if one value can be reached from the other, either
+    directly (the same comparison was made before) or through other
+    values (by transitivity). Answers by transitivity are looked up in
+    an index of every value known to be greater than each value, built
+    on the first lookup and kept up to date as answers are added; an
+    undo drops it, to be built again. A sort whose structure rules out
+    inferred answers, e.g. insertion into a tree, should skip the index
+    with `infer=False`.
+
+    Values that are already sorted, e.g. loaded from a library, are kept
+    as a rank for each instead of as answers: two of them are compared
+    by their ranks, and any other value by its own answers about them.
+
+    The cache assumes that no two values are equal.
+    """
+
+    def __init__(self, answers=()):
+        """
+        Create the cache.
+
+        :param answers: Known orderings, each a tuple of a value and a
+                        value that it is less than, in the order they
+                        were added, defaults to ()
+        :type answers: iterable
+        """
+
+        # stack of (smaller, larger) tuples, so answers can be undone
+        self.answers = []
+
+        # for each value, the number of edges to each larger value, and
+        # to each smaller value
+        self._larger = {}
+        self._smaller = {}
+
+        # position of each value known to be sorted, from add_sorted
+        self._ranks = {}
+
+        # index of answers by transitivity: a bit for each value, the
+        # sorted values first by rank, and for each value the bits of
+        # every value known to be greater; None until it is needed
+        self._bits = None
+        self._above = None
+
+        for smaller, larger in answers:
+            self.add(smaller, larger)
+
+    def __len__(self):
+        """
+        Get the number of answers in the cache.
+
+        :return: The number of answers
+        :rtype: int
+        """
+
+        return len(self.answers)
+
+    def add(self, smaller, larger):
+        """
+        Add the answer to a comparison.
+
+        :param smaller: The value found to be less than `larger`
+        :type smaller: object
+        :param larger: The value found to be greater than `smaller`
+        :type larger: object
+        :return: None
+        """
+
+        self.answers.append((smaller, larger))
+        edges = self._larger.setdefault(smaller, {})
+        edges[larger] = edges.get(larger, 0) + 1
+        edges = self._smaller.setdefault(larger, {})
+        edges[smaller] = edges.get(smaller, 0) + 1
+        if self._above is not None:
+            self._extend(smaller, larger)
+
+    def add_sorted(self, values):
+        """
+        Add values that are known to be sorted, without adding an answer
+        for each. They can't be undone.
+
+        :param values: Values sorted from least to greatest, none of them
+                       already sorted
+        :type values: list
+        :return: None
+        """
+
+        start = len(self._ranks)
+        self._ranks.update(
+            (value, start + i) for i, value in enumerate(values))
+        self._bits = self._above = None
+
+    def undo(self):
+        """
+        Remove the most recently added answer. Does nothing if the cache
+        is empty.
+
+        :return: None
+        """
+
+        if not self.answers:
+            return
+        smaller, larger = self.answers.pop()
+        self._bits = self._above = None
+        for edges, value, other in ((self._larger, smaller, larger),
+                                    (self._smaller, larger, smaller)):
+            counts = edges[value]
+            counts[other] -= 1
+            if not counts[other]:
+                del counts[other]
+                if not counts:
+                    del edges[value]
+
+    def less(self, value, other, infer=True):
+        """
+        Check whether `value` is known to be less than `other`.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :param infer: Whether to look for the answer through chains of
+                      other answers, defaults to True; if False, only
+                      the same comparison and the sorted values are
+                      checked
+        :type infer: bool
+        :return: True if `value` is known to be less than `other`, False
+                 if it is known to be greater, or None if the answer is
+                 not known
+        :rtype: bool
+        """
+
+        if value == other:
+            return None
+        ranks = self._ranks
+        if value in ranks and other in ranks:
+            return ranks[value] < ranks[other]
+        # check for the same comparison first, in either order
+        if other in self._larger.get(value, ()):
+            return True
+        if value in self._larger.get(other, ()):
+            return False
+        # then through an answer about a sorted value
+        if value in ranks:
+            answer = self._ranked(other, ranks[value])
+            if answer is not None:
+                return not answer
+        elif other in ranks:
+            answer = self._ranked(value, ranks[other])
+            if answer is not None:
+                return answer
+        if not infer:
+            return None
+        if self._above is None:
+            self._build()
+        if self._known(value, other):
+            return True
+        if self._known(other, value):
+            return False
+        return None
+
+    def _ranked(self, value, rank):
+        """
+        Check whether a value is known to be less than the sorted value
+        at `rank`, from its answers about other sorted values.
+
+        :param value: A value that is not sorted
+        :type value: object
+        :param rank: The rank of a sorted value
+        :type rank: int
+        :return: True if `value` is known to be less, False if it is
+                 known to be greater, or None if the answer is not known
+        :rtype: bool
+        """
+
+        ranks = self._ranks
+        for larger in self._larger.get(value, ()):
+            if ranks.get(larger, rank + 1) <= rank:
+                return True
+        for smaller in self._smaller.get(value, ()):
+            if ranks.get(smaller, rank - 1) >= rank:
+                return False
+        return None
+
+    def _known(self, value, other):
+        """
+        Look up in the index whether `value` is known to be less than
+        `other` by transitivity.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is known to be less than `other`,
+                 otherwise False
+        :rtype: bool
+        """
+
+        above = self._above.get(value, 0)
+        rank = self._ranks.get(other)
+        if rank is None:
+            return bool(above & self._bits.get(other, 0))
+        # any sorted value that is not greater than `other` will do
+        return bool(above & ((1 << rank + 1) - 1))
+
+    def _build(self):
+        """
+        Build the index of answers by transitivity from every answer,
+        from the greatest values down.
+
+        :return: None
+        """
+
+        bits = {value: 1 << rank for value, rank in self._ranks.items()}
+        for value in itertools.chain(self._larger, self._smaller):
+            if value not in bits:
+                bits[value] = 1 << len(bits)
+        above = {}
+        # number of greater values each value is waiting for; values in
+        # a cycle of contradicting answers are never indexed
+        left = {value: len(edges) for value, edges in self._larger.items()}
+        queue = [value for value in self._smaller if value not in left]
+        for value in queue:
+            mask = 0
+            for larger in self._larger.get(value, ()):
+                mask |= bits[larger] | above[larger]
+            above[value] = mask
+            for smaller in self._smaller.get(value, ()):
+                left[smaller] -= 1
+                if not left[smaller]:
+                    queue.append(smaller)
+        self._bits = bits
+        self._above = above
+
+    def _extend(self, smaller, larger):
+        """
+        Add an answer to the index: everything known to be greater than
+        `larger` is now known to be greater than `smaller` and every
+        value known to be less than it.
+
+        :param smaller: The value found to be less than `larger`
+        :type smaller: object
+        :param larger: The value found to be greater than `smaller`
+        :type larger: object
+        :return: None
+        """
+
+        bits = self._bits
+        for value in (smaller, larger):
+            if value not in bits:
+                bits[value] = 1 << len(bits)
+        mask = bits[larger] | self._above.get(larger, 0)
+        stack = [smaller]
+        while stack:
+            value = stack.pop()
+            above = self._above.get(value, 0)
+            if above & mask == mask:
+                continue  # so are the values less than it
+            self._above[value] = above | mask
+            stack.extend(self._smaller.get(value, ()))
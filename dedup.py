@@ -0,0 +1,157 @@
+import concurrent.futures
+import hashlib
+import os
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # only exact copies are found
+    PILImage = None
+
+
+def find_duplicates(filenames, perceptual=False, workers=8):
+    """
+    Find files that are copies of each other, so that only one of each
+    has to be sorted.
+
+    Files are first grouped by size, which costs nothing to read, and
+    only files of the same size as another file are hashed, in
+    parallel. With `perceptual`, images that look the same, such as an
+    image saved again at another size or quality, are also grouped, by
+    a hash of their downscaled brightness (which needs Pillow).
+
+    :param filenames: Names of the files
+    :type filenames: list
+    :param perceptual: True to also group images that look the same,
+                       defaults to False
+    :type perceptual: bool
+    :param workers: Number of files hashed at a time, defaults to 8
+    :type workers: int
+    :return: For each file that has copies, the first of them in
+             `filenames`, the names of its copies, in order
+    :rtype: dict
+    """
+
+    by_size = {}
+    for filename in filenames:
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            continue
+        by_size.setdefault(size, []).append(filename)
+    candidates = [filename for group in by_size.values() if len(group) > 1
+                  for filename in group]
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        hashes = dict(zip(candidates, pool.map(_content_hash, candidates)))
+    duplicates = _group(filenames, hashes)
+
+    if perceptual and PILImage is not None:
+        # images are decoded in processes, since decoding holds the GIL
+        copies = {filename for group in duplicates.values()
+                  for filename in group}
+        originals = [filename for filename in filenames
+                     if filename not in copies]
+        with concurrent.futures.ProcessPoolExecutor() as pool:
+            hashes = dict(zip(originals, pool.map(
+                _perceptual_hash, originals, chunksize=16)))
+        for original, group in _group(originals, hashes).items():
+            copies = duplicates.setdefault(original, [])
+            for filename in group:
+                # keep the exact copies of each image with it
+                copies.append(filename)
+                copies.extend(duplicates.pop(filename, []))
+    return duplicates
+
+
+def restore_duplicates(result, duplicates):
+    """
+    Put the copies found by :func:`find_duplicates` back into a sorted
+    list, after the file that was sorted in their place.
+
+    :param result: The sorted files
+    :type result: list
+    :param duplicates: The copies of each file
+    :type duplicates: dict
+    :return: The sorted files with their copies
+    :rtype: list
+    """
+
+    files = []
+    for filename in result:
+        files.append(filename)
+        files.extend(duplicates.get(filename, ()))
+    return files
+
+
+def _group(filenames, hashes):
+    """
+    Group files with the same hash.
+
+    :param filenames: Names of the files, in order
+    :type filenames: list
+    :param hashes: The hash of each file that may have copies, or None
+                   if it could not be hashed
+    :type hashes: dict
+    :return: For each file that has copies, the names of its copies
+    :rtype: dict
+    """
+
+    first = {}  # the first file with each hash
+    duplicates = {}
+    for filename in filenames:
+        digest = hashes.get(filename)
+        if digest is None:
+            continue
+        original = first.setdefault(digest, filename)
+        if original != filename:
+            duplicates.setdefault(original, []).append(filename)
+    return duplicates
+
+
+def _content_hash(filename):
+    """
+    Hash the contents of a file.
+
+    :param filename: Name of the file
+    :type filename: str
+    :return: The hash, or None if the file can't be read
+    :rtype: bytes
+    """
+
+    digest = hashlib.blake2b()
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(2**20)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.digest()
+
+
+def _perceptual_hash(filename):
+    """
+    Hash how an image looks: whether each pixel of the image, reduced to
+    9x8 grey pixels, is brighter than the pixel to its right. Runs in a
+    worker process, so it is not a method.
+
+    :param filename: Name of the image file
+    :type filename: str
+    :return: The hash, or None if the image can't be decoded
+    :rtype: int
+    """
+
+    try:
+        with PILImage.open(filename) as image:
+            image.draft('L', (64, 64))
+            pixels = list(image.convert('L').resize((9, 8)).getdata())
+    except Exception:
+        return None
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            bits = bits << 1 | (left > pixels[row * 9 + column + 1])
+    return bits
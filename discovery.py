@@ -0,0 +1,98 @@
+import threading
+
+
+class Discovery:
+    """
+    Runs a generator of filenames on a background thread, so that files
+    found so far can be sorted while the rest are still being found,
+    e.g. in a large directory tree on a network share.
+
+    Iterating over the discovery yields every file found, in order,
+    waiting for more until the generator is exhausted. It can be
+    iterated more than once, and from several threads at once. It is
+    true once a file is found, and false if none is.
+    """
+
+    def __init__(self, generator):
+        """
+        Create the discovery and start running the generator.
+
+        :param generator: Yields filenames
+        :type generator: iterator
+        """
+
+        self.files = []  # every file found so far
+        self.error = None  # raised by the generator, if it failed
+        self._done = False
+        self._found = threading.Condition()
+        threading.Thread(
+            target=self._run, args=(generator,), daemon=True).start()
+
+    def __iter__(self):
+        """
+        Iterate over the files, waiting for each to be found.
+
+        :return: An iterator over the filenames
+        :rtype: iterator
+        """
+
+        i = 0
+        while True:
+            with self._found:
+                while i == len(self.files) and not self._done:
+                    self._found.wait()
+                if i == len(self.files):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                filename = self.files[i]
+            yield filename
+            i += 1
+
+    def __bool__(self):
+        """
+        Check whether any file is found, waiting for the first file or
+        for the generator to be exhausted.
+
+        :return: True if any file is found, otherwise False
+        :rtype: bool
+        """
+
+        with self._found:
+            while not self.files and not self._done:
+                self._found.wait()
+            if not self.files and self.error is not None:
+                raise self.error
+            return bool(self.files)
+
+    def wait(self):
+        """
+        Wait for every file to be found.
+
+        :return: The filenames
+        :rtype: list
+        """
+
+        return list(self)
+
+    def _run(self, generator):
+        """
+        Run the generator, adding each file to `files`. Runs on the
+        background thread.
+
+        :param generator: Yields filenames
+        :type generator: iterator
+        :return: None
+        """
+
+        try:
+            for filename in generator:
+                with self._found:
+                    self.files.append(filename)
+                    self._found.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._found:
+                self._done = True
+                self._found.notify_all()
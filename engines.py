@@ -0,0 +1,1569 @@
+import abc
+import bisect
+import collections
+import heapq
+import math
+import random
+
+from comparisons import ComparisonCache
+from journal import Journal
+from trees import SaveStateTree
+
+
+class SortEngine(abc.ABC):
+    """
+    Base class for the ways of sorting values by asking the user to
+    compare them. Each engine saves its progress to a file as it goes,
+    so that sorting can be resumed at a later time.
+
+    Values are compared by an oracle, a function called with two values
+    that returns 1 if the first is greater, -1 if it is less, or 0 if
+    they are equal (see :mod:`oracles`), or with the < operator if there
+    is no oracle. Either may raise :class:`SortEngine.UndoClicked` to
+    undo the previous comparison, :class:`SortEngine.Exit` to save and
+    quit, or :class:`SortEngine.Pause` to stop without saving; calling
+    :meth:`sort` again then asks the same comparison again.
+    """
+
+    Exit = SaveStateTree.Exit
+    Pause = SaveStateTree.Pause
+    UndoClicked = SaveStateTree.UndoClicked
+
+    def __init__(self, filename, value_type=None, oracle=None,
+                 metrics=None):
+        """
+        Create the engine. Its progress will be saved to `filename`. If
+        the file exists at the time of initialization, the progress will
+        be loaded from the file.
+
+        :param filename: Name of the file to save to
+        :type filename: str
+        :param value_type: Type of the values sorted, e.g.
+                           :class:`image_sort.CompareImage`, defaults to
+                           None to load plain strings and integers
+        :type value_type: type
+        :param oracle: Answers comparisons, defaults to None to compare
+                       the values themselves
+        :type oracle: function
+        :param metrics: Records the comparisons asked and how long the
+                        user took to answer them, defaults to None to
+                        record nothing
+        :type metrics: metrics.Metrics
+        """
+
+        self.filename = filename
+        self.value_type = value_type
+        self.oracle = oracle
+        self.metrics = metrics
+
+    @abc.abstractmethod
+    def sort(self, values):
+        """
+        Sort `values` together with any values sorted before they were
+        last saved.
+
+        :param values: Values to sort; values already in the engine are
+                       skipped. The tree engine inserts each value as
+                       soon as it is produced, so it can start asking
+                       before all the values are known
+        :type values: iterable
+        :return: The sorted list
+        :rtype: list
+        """
+
+    @abc.abstractmethod
+    def load_sorted(self, values):
+        """
+        Start from values that are already sorted, e.g. the result of an
+        earlier sort, without comparing them, so that :meth:`sort` only
+        asks about the values that are not among them. Only engines
+        that have not sorted anything yet can load values; others raise
+        ValueError.
+
+        :param values: Values sorted from least to greatest
+        :type values: list
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def delete_file(self):
+        """
+        Delete the file that the progress is saved to.
+
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def exit(self):
+        """
+        Save the progress to file and raise the Exit exception.
+
+        :return: None
+        """
+
+    def upcoming(self):
+        """
+        Predict the values that may be compared next, while a comparison
+        is being made, so that they can be prepared in advance.
+
+        :return: The values, most likely first
+        :rtype: list
+        """
+
+        return []
+
+    def _ask(self, value, other):
+        """
+        Ask the oracle, or the < operator, to compare two values,
+        recording how long it took if there are metrics.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is less than `other`, otherwise False
+        :rtype: bool
+        """
+
+        if self.metrics is None:
+            return self._compare(value, other)
+        self.metrics.count('comparisons_asked')
+        return self.metrics.timed(
+            'answer_seconds', self._compare, value, other)
+
+    def _compare(self, value, other):
+        """
+        Ask the oracle, or the < operator, to compare two values.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is less than `other`, otherwise False
+        :rtype: bool
+        """
+
+        if self.oracle is None:
+            return value < other
+        return self.oracle(value, other) < 0
+
+
+class TreeEngine(SortEngine):
+    """
+    Sorts values by inserting them one at a time into a
+    :class:`trees.SaveStateTree`.
+    """
+
+    def __init__(self, filename, value_type=None, oracle=None,
+                 history=None, metrics=None):
+        """
+        Create the engine.
+
+        :param filename: Name of the file to save to
+        :type filename: str
+        :param value_type: Type of the values sorted, defaults to None
+        :type value_type: type
+        :param oracle: Answers comparisons, defaults to None
+        :type oracle: function
+        :param history: Used to store the state of the tree before each
+                        insertion, defaults to a new
+                        :class:`trees.SnapshotHistory`
+        :type history: trees.SnapshotHistory or trees.OperationLog
+        :param metrics: Records metrics, defaults to None
+        :type metrics: metrics.Metrics
+        """
+
+        super().__init__(filename, value_type, oracle, metrics)
+        self.tree = SaveStateTree(
+            filename, history, value_type, oracle, metrics)
+
+    def sort(self, values):
+        self.tree.continue_insert()
+        for value in values:
+            # check if value already in tree, in case the sorting is
+            # being resumed
+            if value not in self.tree:
+                self.tree.insert(value)
+        return self.tree.to_list()
+
+    def load_sorted(self, values):
+        self.tree.load_sorted(values)
+
+    def delete_file(self):
+        self.tree.delete_file()
+
+    def exit(self):
+        self.tree.exit()
+
+    def upcoming(self):
+        return self.tree.upcoming()
+
+
+class MergeInsertionEngine(SortEngine):
+    """
+    Sorts values with Ford-Johnson merge-insertion, which sorts all of
+    the values at once using close to the fewest comparisons possible.
+
+    Each answer is kept in a :class:`comparisons.ComparisonCache` and
+    appended to a :class:`journal.Journal`. The sort runs one comparison
+    at a time, so when it is paused it goes on from the same comparison.
+    Merge-insertion always makes the same comparisons in the same order,
+    so the sort is simply run again from the start whenever it needs to
+    go back: comparisons that were already answered are taken from the
+    cache, and the user is asked from the first comparison that is not
+    known. Undoing removes the last answer from the cache, so that
+    comparison is asked again.
+
+    A run only ever asks a comparison whose answer it can't know, so
+    the cache only looks up inferred answers while it holds answers that
+    the run didn't make, e.g. from before values were added.
+    """
+
+    class _Paused(Exception):
+        """
+        Raised while replaying the journal when the next comparison has
+        not been answered yet.
+        """
+
+        pass
+
+    def __init__(self, filename, value_type=None, oracle=None,
+                 metrics=None):
+        super().__init__(filename, value_type, oracle, metrics)
+        self._journal = Journal(filename, value_type)
+
+        checkpoint, records = self._journal.read(None)
+        self.values = checkpoint.values
+        self.cache = ComparisonCache(checkpoint.answers)
+        self._index = set(self.values)
+        # number of values loaded by load_sorted, which are first in
+        # self.values; the cache compares them by their ranks
+        self.loaded = checkpoint.loaded
+        self.cache.add_sorted(self.values[:self.loaded])
+        # answers in the cache that the current run hasn't used; those
+        # in the checkpoint may have been made before values were added
+        self._foreign = set(checkpoint.answers)
+
+        # records that have not been replayed yet; comparisons that are
+        # not in the cache are answered from these until they run out
+        self._replay = collections.deque(records)
+
+        # the sort being run, from _sort, and the comparison it is
+        # waiting for, kept when it is paused
+        self._steps = None
+        self._pair = None
+
+        # add the answers from the journal to the cache
+        self._replaying = True
+        try:
+            self._run()
+        except self._Paused:
+            pass
+        finally:
+            self._replaying = False
+
+    def sort(self, values):
+        new_values = []
+        for value in values:
+            if value not in self._index:
+                self._index.add(value)
+                new_values.append(value)
+        if new_values:
+            self.values.extend(new_values)
+            self._steps = self._pair = None  # sort the new values too
+            self._foreign = set(self.cache.answers)
+            # the journal only holds answers for the values in the
+            # checkpoint, so save the new values with a new checkpoint
+            self._journal.save(
+                self.values, None, [], [], False, self.cache.answers,
+                self.loaded)
+
+        try:
+            return self._run()
+        except self.Exit:
+            self.exit()
+
+    def load_sorted(self, values):
+        if self.values:
+            raise ValueError(
+                'values can only be loaded into an empty engine')
+        self.values = list(values)
+        self._index = set(self.values)
+        self.loaded = len(self.values)
+        self._steps = self._pair = None
+        self.cache.add_sorted(self.values)
+        self._journal.save(
+            self.values, None, [], [], False, self.cache.answers,
+            self.loaded)
+
+    def _run(self):
+        """
+        Sort `self.values` until the sort finishes, going on from the
+        comparison it was paused at, if any.
+
+        :return: The sorted list
+        :rtype: list
+        """
+
+        while True:
+            if self._steps is None:
+                self._steps = self._sort(self.values)
+            answer = None
+            try:
+                while True:
+                    if self._pair is None:
+                        self._pair = self._steps.send(answer)
+                    answer = self._less(*self._pair)
+                    self._pair = None
+            except StopIteration as e:
+                self._steps = None
+                return e.value
+            except self.UndoClicked:
+                # start again; answers are taken from the cache
+                self._steps = self._pair = None
+
+    @staticmethod
+    def _sort(values):
+        """
+        Start sorting the values, always making the same comparisons in
+        the same order for the same answers.
+
+        :param values: The values to sort
+        :type values: list
+        :return: A generator like :func:`merge_insertion_steps`
+        :rtype: generator
+        """
+
+        return merge_insertion_steps(values)
+
+    def _less(self, value, other):
+        """
+        Compare two values, taking the answer from the cache if it is
+        known, or from the journal if it is being replayed. Otherwise,
+        the user is asked, and the answer is written to the journal.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is less than `other`, otherwise False
+        :rtype: bool
+        """
+
+        answer = self.cache.less(value, other, infer=bool(self._foreign))
+        if answer is not None:
+            if self.metrics is not None and not self._replaying:
+                self.metrics.count('comparisons_cached')
+            self._foreign.discard(
+                (value, other) if answer else (other, value))
+            return answer
+
+        if self._replay:
+            kind, answer = self._replay.popleft()
+            if kind == Journal.UNDO:
+                self._undo_answer()
+                raise self.UndoClicked
+        elif self._replaying:
+            raise self._Paused
+        else:
+            try:
+                answer = self._ask(value, other)
+            except self.UndoClicked:
+                self._journal.append(Journal.UNDO)
+                self._undo_answer()
+                raise
+            self._journal.append(Journal.ANSWER, answer)
+
+        if answer:
+            self.cache.add(value, other)
+        else:
+            self.cache.add(other, value)
+        return answer
+
+    def _undo_answer(self):
+        """
+        Remove the most recent answer from the cache, so that the same
+        comparison is asked again.
+
+        :return: None
+        """
+
+        if self.cache.answers:
+            self._foreign.discard(self.cache.answers[-1])
+        self.cache.undo()
+
+    def delete_file(self):
+        self._journal.delete()
+
+    def exit(self):
+        self._journal.save(
+            self.values, None, [], [], False, self.cache.answers,
+            self.loaded)
+        raise self.Exit
+
+
+class TopKEngine(MergeInsertionEngine):
+    """
+    Finds only the `k` greatest values, in order, with a tournament: the
+    values are compared in pairs, the greater of each pair goes on to
+    the next round, and the winner of the last round is the greatest.
+    Each following value is found by replaying only the matches that
+    the previous winner took part in. This takes about n + k * log2(n)
+    comparisons, rather than the n * log2(n) of a full sort.
+    :meth:`sort` returns only those values, from least to greatest.
+
+    Like :class:`MergeInsertionEngine`, the tournament always makes the
+    same comparisons in the same order, so it is run again from the
+    start with the answers in the cache to undo or resume.
+    """
+
+    def __init__(self, filename, value_type=None, oracle=None, k=20,
+                 metrics=None):
+        """
+        Create the engine.
+
+        :param filename: Name of the file to save to
+        :type filename: str
+        :param value_type: Type of the values sorted, defaults to None
+        :type value_type: type
+        :param oracle: Answers comparisons, defaults to None
+        :type oracle: function
+        :param k: Number of greatest values to find, defaults to 20
+        :type k: int
+        :param metrics: Records metrics, defaults to None
+        :type metrics: metrics.Metrics
+        """
+
+        # needed by the replay in MergeInsertionEngine.__init__
+        self.k = k
+        super().__init__(filename, value_type, oracle, metrics)
+
+    def _sort(self, values):
+        return top_k_steps(values, self.k)
+
+
+class BatchInsertionEngine(SortEngine):
+    """
+    Sorts values by binary insertion, a batch of `width` values at a
+    time: each value in the batch is searched for in the values already
+    sorted, without waiting for the rest of the batch, so up to `width`
+    comparisons can be answered at the same time, e.g. by several
+    people. Values that land between the same two sorted values are
+    then sorted among themselves the same way.
+
+    Comparisons waiting for an answer are listed by :meth:`pending` and
+    answered in any order with :meth:`answer`. :meth:`sort` asks the
+    oracle for them one at a time instead, starting with the comparison
+    undone last, if any.
+
+    The state of the sort moves on with each answer and back with each
+    undo; it is only worked out again from the answers in the cache when
+    values are added. Each answer is journaled with the values it
+    compares, since answers can come in any order.
+
+    A search only waits for a comparison whose answer it can't know, so
+    the cache only looks up inferred answers if some answers were
+    not waited for when the state was worked out, e.g. because they were
+    made before values were added.
+    """
+
+    def __init__(self, filename, value_type=None, oracle=None, width=8,
+                 metrics=None):
+        """
+        Create the engine.
+
+        :param filename: Name of the file to save to
+        :type filename: str
+        :param value_type: Type of the values sorted, defaults to None
+        :type value_type: type
+        :param oracle: Answers comparisons, defaults to None
+        :type oracle: function
+        :param width: Number of values inserted at a time, which is the
+                      most comparisons that can be pending at once,
+                      defaults to 8
+        :type width: int
+        :param metrics: Records metrics, defaults to None
+        :type metrics: metrics.Metrics
+        """
+
+        super().__init__(filename, value_type, oracle, metrics)
+        self.width = width
+        self._journal = Journal(filename, value_type)
+
+        checkpoint, records = self._journal.read(None)
+        self.values = checkpoint.values
+        self.cache = ComparisonCache(checkpoint.answers)
+        # position of each value in self.values, for the journal
+        self._index = {value: i for i, value in enumerate(self.values)}
+        # number of values loaded by load_sorted, which are first in
+        # self.values; the cache compares them by their ranks
+        self.loaded = checkpoint.loaded
+        # the last answer undone, to be asked again first
+        self._undone = None
+        self._order = None
+        self._sort = None
+        # whether the cache looks up inferred answers
+        self._infer = False
+        self._shuffle()
+
+        for kind, value in records:
+            if kind == Journal.ORDER:
+                smaller, larger = value
+                self.cache.add(self.values[smaller], self.values[larger])
+            elif kind == Journal.UNDO:
+                self._undo_answer()
+        self._rebuild()
+
+    def sort(self, values):
+        self.add(values)
+        while True:
+            result = self.result()
+            if result is not None:
+                return result
+            pending = self.pending()
+            value, other = pending[0]
+            if self._undone is not None:
+                smaller, larger = self._undone
+                if (smaller, larger) in self._sort.waiting:
+                    value, other = smaller, larger
+                elif (larger, smaller) in self._sort.waiting:
+                    value, other = larger, smaller
+
+            try:
+                less = self._ask(value, other)
+            except self.UndoClicked:
+                self.undo()
+                continue
+            except self.Exit:
+                self.exit()
+            self.answer(value, other, less)
+
+    def add(self, values):
+        """
+        Add values to be sorted, skipping values already in the engine.
+
+        :param values: Values to sort
+        :type values: list
+        :return: None
+        """
+
+        new_values = []
+        for value in values:
+            if value not in self._index:
+                self._index[value] = len(self.values) + len(new_values)
+                new_values.append(value)
+        if new_values:
+            self.values.extend(new_values)
+            self._shuffle()
+            self._rebuild()
+            # the journal refers to values by their position in the
+            # checkpoint, so save the new values with a new checkpoint
+            self._save()
+
+    def load_sorted(self, values):
+        if self.values:
+            raise ValueError(
+                'values can only be loaded into an empty engine')
+        self.values = list(values)
+        self._index = {value: i for i, value in enumerate(self.values)}
+        self.loaded = len(self.values)
+        self._shuffle()
+        self._rebuild()
+        self._save()
+
+    def pending(self):
+        """
+        Get the comparisons waiting for an answer. Each can be answered
+        without waiting for the others.
+
+        :return: Tuples of two values, or an empty list if sorting is
+                 finished
+        :rtype: list
+        """
+
+        return list(self._sort.waiting)
+
+    def answer(self, value, other, less):
+        """
+        Answer a comparison.
+
+        :param value: A value
+        :type value: object
+        :param other: The value it was compared to
+        :type other: object
+        :param less: True if `value` is less than `other`, otherwise
+                     False
+        :type less: bool
+        :return: None
+        """
+
+        smaller, larger = (value, other) if less else (other, value)
+        self._journal.append(
+            Journal.ORDER, (self._index[smaller], self._index[larger]))
+        self.cache.add(smaller, larger)
+        self._undone = None
+        self._sort.answered(smaller, larger)
+
+    def undo(self):
+        """
+        Undo the most recent answer, whichever comparison it was for.
+
+        :return: None
+        """
+
+        if len(self.cache):
+            self._journal.append(Journal.UNDO)
+            self._undo_answer()
+            self._sort.undo()
+
+    def result(self):
+        """
+        Get the sorted list, if sorting is finished.
+
+        :return: The sorted list, or None if comparisons are pending
+        :rtype: list
+        """
+
+        return self._sort.result
+
+    def delete_file(self):
+        self._journal.delete()
+
+    def exit(self):
+        self._save()
+        raise self.Exit
+
+    def _save(self):
+        """
+        Save a checkpoint of the values and answers. The answer undone
+        last, if it has not been answered again, is saved followed by an
+        undo, so that it is still asked first when the engine is loaded.
+
+        :return: None
+        """
+
+        answers = self.cache.answers
+        if self._undone is not None:
+            answers = answers + [self._undone]
+        self._journal.save(
+            self.values, None, [], [], False, answers, self.loaded)
+        if self._undone is not None:
+            self._journal.append(Journal.UNDO)
+
+    def _undo_answer(self):
+        """
+        Remove the most recent answer from the cache, remembering it to
+        be asked again first.
+
+        :return: None
+        """
+
+        self._undone = self.cache.answers[-1]
+        self.cache.undo()
+
+    def _shuffle(self):
+        """
+        Shuffle the values into the order they are inserted in, so that
+        values given already in order don't all land in the same place.
+        The shuffle is the same every time for the same values, so the
+        comparisons answered before are still the ones needed.
+
+        :return: None
+        """
+
+        self._order = list(self.values)
+        random.Random(0).shuffle(self._order)
+
+    def _rebuild(self):
+        """
+        Work out the state of the sort again, by giving it the answers
+        in the cache one at a time, in the order they were made. If an
+        answer wasn't waited for, it is worked out once more, looking up
+        inferred answers.
+
+        :return: None
+        """
+
+        answers = self.cache.answers
+        for infer in (False, True):
+            self._infer = infer
+            self.cache = ComparisonCache()
+            self.cache.add_sorted(self.values[:self.loaded])
+            self._sort = _BatchSort(self._order, self._less, self.width)
+            waited = True
+            for smaller, larger in answers:
+                self.cache.add(smaller, larger)
+                waited = self._sort.answered(smaller, larger) and waited
+            if waited:
+                return
+
+    def _less(self, value, other):
+        """
+        Check whether `value` is known to be less than `other`, for the
+        sort.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is known to be less than `other`, False
+                 if it is known to be greater, or None if the answer is
+                 not known
+        :rtype: bool
+        """
+
+        return self.cache.less(value, other, self._infer)
+
+
+class ActiveRankingEngine(SortEngine):
+    """
+    Ranks values approximately by learning a score for each value from
+    the answers and asking the comparisons that tell it the most. This
+    only asks fewer comparisons than an exact sort with many values or a
+    low `confidence`: at 0.9, it asks more with fewer than a few hundred
+    values, e.g. about 5.8 per value against 4.3 with 50 values.
+
+    Each value's score is a normal distribution, with a mean and a
+    variance, updated after each answer as in TrueSkill: the two values
+    compared move apart or together by how surprising the answer was,
+    and become more certain. An update only changes the two values
+    compared, so it takes constant time however many values there are.
+
+    The next comparison is between the value whose score is least
+    certain and the value near it in the ranking that the answer is
+    expected to tell the most about: the Fisher information of the
+    answer, weighted by how uncertain the two scores are. Ties are
+    broken by a random key for each value, so that values given already
+    in order aren't only compared to their neighbours in that order.
+
+    Sorting stops once the ranking is estimated to order pairs of
+    values correctly with probability `confidence`, or at any time with
+    :class:`SortEngine.Exit`, and :meth:`sort` returns the values by
+    their mean score. Comparisons can be made one at a time with
+    :meth:`next_pair` and :meth:`answer` instead.
+
+    Every answer is journaled with the values it compares, and the
+    scores are worked out again from the answers when the engine is
+    loaded. Undo restores the scores from before the last answer.
+    """
+
+    MEAN = 25.0  # starting mean of every score
+    VARIANCE = (MEAN / 3) ** 2  # starting variance of every score
+    NOISE = VARIANCE / 4  # variance of how well a user tells values apart
+    WINDOW = 8  # values on each side considered for the next comparison
+    SAMPLES = 200  # pairs sampled to estimate the confidence
+
+    def __init__(self, filename, value_type=None, oracle=None,
+                 confidence=0.9, metrics=None):
+        """
+        Create the engine.
+
+        :param filename: Name of the file to save to
+        :type filename: str
+        :param value_type: Type of the values sorted, defaults to None
+        :type value_type: type
+        :param oracle: Answers comparisons, defaults to None
+        :type oracle: function
+        :param confidence: Probability of a pair of values being ranked
+                           correctly at which to stop, defaults to 0.9
+        :type confidence: float
+        :param metrics: Records metrics, defaults to None
+        :type metrics: metrics.Metrics
+        """
+
+        super().__init__(filename, value_type, oracle, metrics)
+        self.confidence = confidence
+        self._journal = Journal(filename, value_type)
+
+        checkpoint, records = self._journal.read(None)
+        self.values = []
+        self._index = {}
+        self.means = []
+        self.variances = []
+        # random key of each value, to break ties; the keys are the same
+        # every time for the same values
+        self._keys = []
+        self._random = random.Random(0)
+        # (mean, key, position) of every value, sorted
+        self._ranking = []
+        # (-variance, key, position) of values, to find the least
+        # certain; entries whose variance has changed since are skipped
+        self._uncertain = []
+        # (smaller, larger) tuples, in the order they were answered
+        self.answers = []
+        # scores of the two values before each answer, for undo
+        self._previous = []
+        self._samples = []
+        # number of values loaded by load_sorted, which are first in
+        # self.values
+        self.loaded = checkpoint.loaded
+        self._add(checkpoint.values)
+        self._score_loaded()
+
+        for smaller, larger in checkpoint.answers:
+            self._update(self._index[smaller], self._index[larger])
+        for kind, value in records:
+            if kind == Journal.ORDER:
+                self._update(*value)
+            elif kind == Journal.UNDO:
+                self._undo_update()
+
+    def sort(self, values):
+        self.add(values)
+        while True:
+            pair = self.next_pair()
+            if pair is None:
+                return self.result()
+            value, other = pair
+            try:
+                less = self._ask(value, other)
+            except self.UndoClicked:
+                self.undo()
+                continue
+            except self.Exit:
+                self.exit()
+            self.answer(value, other, less)
+
+    def add(self, values):
+        """
+        Add values to be ranked, skipping values already in the engine.
+
+        :param values: Values to rank
+        :type values: list
+        :return: None
+        """
+
+        new_values = [value for value in dict.fromkeys(values)
+                      if value not in self._index]
+        if new_values:
+            self._add(new_values)
+            # the journal refers to values by their position in the
+            # checkpoint, so save the new values with a new checkpoint
+            self._journal.save(
+                self.values, None, [], [], False, self.answers,
+                self.loaded)
+
+    def load_sorted(self, values):
+        if self.values:
+            raise ValueError(
+                'values can only be loaded into an empty engine')
+        self._add(values)
+        self.loaded = len(self.values)
+        self._score_loaded()
+        self._journal.save(
+            self.values, None, [], [], False, self.answers, self.loaded)
+
+    def next_pair(self):
+        """
+        Choose the next comparison to ask.
+
+        :return: A tuple of two values, or None if the ranking is
+                 confident enough
+        :rtype: tuple
+        """
+
+        if len(self.values) < 2 or self.estimate() >= self.confidence:
+            return None
+
+        # the value whose score is least certain
+        while True:
+            variance, _key, i = self._uncertain[0]
+            if -variance == self.variances[i]:
+                break
+            heapq.heappop(self._uncertain)
+
+        # the value near it that an answer tells the most about
+        rank = bisect.bisect_left(
+            self._ranking, (self.means[i], self._keys[i], i))
+        best, best_gain = None, -1.0
+        for _mean, _key, j in self._ranking[
+                max(0, rank - self.WINDOW):rank + self.WINDOW + 1]:
+            if j != i:
+                gain = self._information(i, j)
+                if gain > best_gain:
+                    best, best_gain = j, gain
+        return self.values[i], self.values[best]
+
+    def answer(self, value, other, less):
+        """
+        Answer a comparison, updating the scores of the two values.
+
+        :param value: A value
+        :type value: object
+        :param other: The value it was compared to
+        :type other: object
+        :param less: True if `value` is less than `other`, otherwise
+                     False
+        :type less: bool
+        :return: None
+        """
+
+        smaller, larger = (value, other) if less else (other, value)
+        smaller, larger = self._index[smaller], self._index[larger]
+        self._journal.append(Journal.ORDER, (smaller, larger))
+        self._update(smaller, larger)
+
+    def undo(self):
+        """
+        Undo the most recent answer.
+
+        :return: None
+        """
+
+        if self.answers:
+            self._journal.append(Journal.UNDO)
+            self._undo_update()
+
+    def result(self):
+        """
+        Get the values ranked by their scores.
+
+        :return: The values sorted from least to greatest score
+        :rtype: list
+        """
+
+        return [self.values[i] for _mean, _key, i in self._ranking]
+
+    def estimate(self):
+        """
+        Estimate how likely the ranking is to order two values picked at
+        random correctly, from a fixed sample of pairs of values.
+
+        :return: The probability
+        :rtype: float
+        """
+
+        if not self._samples:
+            return 1.0
+        total = 0.0
+        for i, j in self._samples:
+            spread = math.sqrt(self.variances[i] + self.variances[j])
+            total += _normal_cdf(abs(self.means[i] - self.means[j]) / spread)
+        return total / len(self._samples)
+
+    def delete_file(self):
+        self._journal.delete()
+
+    def exit(self):
+        self._journal.save(
+            self.values, None, [], [], False, self.answers, self.loaded)
+        raise self.Exit
+
+    def _add(self, values):
+        """
+        Add new values with the starting score.
+
+        :param values: Values not in the engine
+        :type values: list
+        :return: None
+        """
+
+        for value in values:
+            i = len(self.values)
+            self._index[value] = i
+            self.values.append(value)
+            self.means.append(self.MEAN)
+            self.variances.append(self.VARIANCE)
+            key = self._random.random()
+            self._keys.append(key)
+            bisect.insort(self._ranking, (self.MEAN, key, i))
+            heapq.heappush(self._uncertain, (-self.VARIANCE, key, i))
+
+        # the sample is the same every time for the same values. Once
+        # values have been loaded by load_sorted, only pairs with a
+        # value that was not among them tell how far ranking has got
+        n = len(self.values)
+        first = self.loaded if self.loaded < n else 0
+        rng = random.Random(0)
+        self._samples = []
+        if n >= 2:
+            for _ in range(self.SAMPLES):
+                i = rng.randrange(first, n)
+                j = rng.randrange(n - 1)
+                self._samples.append((i, j if j < i else j + 1))
+
+    def _score_loaded(self):
+        """
+        Score the values loaded by :meth:`load_sorted` by their rank,
+        spread evenly over the range of the starting scores, each about
+        as certain as the gap to its neighbours.
+
+        :return: None
+        """
+
+        if not self.loaded:
+            return
+        spread = 6 * math.sqrt(self.VARIANCE)
+        step = spread / self.loaded
+        for i in range(self.loaded):
+            self._set(i, self.MEAN - spread / 2 + (i + 0.5) * step,
+                      step * step)
+
+    def _information(self, i, j):
+        """
+        Get how much the answer to a comparison is expected to tell
+        about the scores of two values.
+
+        :param i: Position of a value
+        :type i: int
+        :param j: Position of the other value
+        :type j: int
+        :return: The expected information
+        :rtype: float
+        """
+
+        spread = self.variances[i] + self.variances[j] + 2 * self.NOISE
+        t = (self.means[i] - self.means[j]) / math.sqrt(spread)
+        p = _normal_cdf(t)
+        # Fisher information of the answer about the difference of the
+        # scores, times how uncertain the difference is
+        fisher = _normal_pdf(t) ** 2 / max(p * (1 - p), 1e-300) / spread
+        return fisher * (self.variances[i] + self.variances[j])
+
+    def _update(self, smaller, larger):
+        """
+        Update the scores of two values after an answer.
+
+        :param smaller: Position of the value found to be less
+        :type smaller: int
+        :param larger: Position of the value found to be greater
+        :type larger: int
+        :return: None
+        """
+
+        self.answers.append((self.values[smaller], self.values[larger]))
+        self._previous.append(
+            (smaller, self.means[smaller], self.variances[smaller],
+             larger, self.means[larger], self.variances[larger]))
+
+        spread = (self.variances[smaller] + self.variances[larger]
+                  + 2 * self.NOISE)
+        c = math.sqrt(spread)
+        t = (self.means[larger] - self.means[smaller]) / c
+        p = _normal_cdf(t)
+        # v: how far to move the means; w: how much more certain
+        v = _normal_pdf(t) / p if p > 1e-300 else -t
+        w = v * (v + t)
+        for i, sign in ((larger, 1), (smaller, -1)):
+            variance = self.variances[i]
+            self._set(i, self.means[i] + sign * variance / c * v,
+                      variance * max(1 - variance / spread * w, 1e-6))
+
+    def _undo_update(self):
+        """
+        Restore the scores from before the most recent answer.
+
+        :return: None
+        """
+
+        self.answers.pop()
+        smaller, mean, variance, larger, other_mean, other_variance = (
+            self._previous.pop())
+        self._set(larger, other_mean, other_variance)
+        self._set(smaller, mean, variance)
+
+    def _set(self, i, mean, variance):
+        """
+        Change the score of a value.
+
+        :param i: Position of the value
+        :type i: int
+        :param mean: The new mean
+        :type mean: float
+        :param variance: The new variance
+        :type variance: float
+        :return: None
+        """
+
+        key = self._keys[i]
+        del self._ranking[
+            bisect.bisect_left(self._ranking, (self.means[i], key, i))]
+        bisect.insort(self._ranking, (mean, key, i))
+        self.means[i] = mean
+        if variance != self.variances[i]:
+            heapq.heappush(self._uncertain, (-variance, key, i))
+        self.variances[i] = variance
+
+
+# the engines that can be chosen by name, e.g. on the command line
+ENGINES = {
+    'tree': TreeEngine,
+    'merge-insertion': MergeInsertionEngine,
+    'batch-insertion': BatchInsertionEngine,
+    'active': ActiveRankingEngine,
+}
+
+
+def merge_insertion_steps(values):
+    """
+    Sort a list using Ford-Johnson merge-insertion, one comparison at a
+    time: the generator yields each comparison as a tuple of two values,
+    is sent True if the first is less than the second, and returns the
+    sorted list. It can stop at any comparison and go on later.
+
+    The values are paired up and the larger value of each pair is
+    sorted recursively. The smaller values are then inserted into the
+    sorted list by binary search, in an order chosen so that each
+    search is over a list of nearly 2**k - 1 values, which is where
+    binary search wastes the fewest comparisons.
+
+    The values must be distinct and hashable.
+
+    :param values: The values to sort
+    :type values: list
+    :return: A generator of comparisons, returning the sorted list
+    :rtype: generator
+    """
+
+    if len(values) <= 1:
+        return list(values)
+
+    # compare each pair, keeping the smaller value of each pair with
+    # the larger one
+    smaller = {}
+    for i in range(1, len(values), 2):
+        a, b = values[i - 1], values[i]
+        if (yield b, a):
+            a, b = b, a
+        smaller[b] = a
+    chain = yield from merge_insertion_steps(list(smaller))
+
+    # values still to insert, in the order of their larger values; the
+    # value left over from an odd number of values has no larger value
+    pending = [(smaller[b], b) for b in chain]
+    if len(values) % 2:
+        pending.append((values[-1], None))
+
+    # the smallest value of the first pair needs no comparisons
+    chain.insert(0, pending[0][0])
+
+    # insert in groups, each in reverse order; group sizes follow the
+    # Jacobsthal numbers: 2, 2, 6, 10, 22, ...
+    done = 1
+    end, next_end = 1, 3
+    while done < len(pending):
+        group_end = min(next_end, len(pending))
+        for value, larger in reversed(pending[done:group_end]):
+            # a value is less than its larger value, so only the chain
+            # before it needs to be searched
+            high = len(chain) if larger is None else chain.index(larger)
+            low = 0
+            while low < high:
+                middle = (low + high) // 2
+                if (yield value, chain[middle]):
+                    high = middle
+                else:
+                    low = middle + 1
+            chain.insert(low, value)
+        done = group_end
+        end, next_end = next_end, next_end + 2 * end
+    return chain
+
+
+def top_k_steps(values, k):
+    """
+    Find the `k` greatest values with a tournament tree, one comparison
+    at a time, like :func:`merge_insertion_steps`.
+
+    The tree is stored in a list, like a binary heap: the values are the
+    leaves, at positions n to 2n - 1, and each position i below n holds
+    the winner of the match between positions 2i and 2i + 1, so position
+    1 holds the greatest value. Once a winner is taken, its leaf is
+    emptied and only the matches on its path to the root are played
+    again.
+
+    :param values: The values, which must be distinct and hashable
+    :type values: list
+    :param k: Number of values to find
+    :type k: int
+    :return: A generator of comparisons, returning the `k` greatest
+             values sorted from least to greatest
+    :rtype: generator
+    """
+
+    n = len(values)
+
+    def winner(a, b):
+        # a and b are positions in values, or None for an emptied leaf
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return b if (yield values[a], values[b]) else a
+
+    tree = [None] * n + list(range(n))
+    for i in range(n - 1, 0, -1):
+        tree[i] = yield from winner(tree[2 * i], tree[2 * i + 1])
+
+    result = []
+    for _ in range(min(k, n)):
+        best = tree[1]
+        result.append(values[best])
+        i = best + n
+        tree[i] = None
+        i //= 2
+        while i:
+            tree[i] = yield from winner(tree[2 * i], tree[2 * i + 1])
+            i //= 2
+    result.reverse()
+    return result
+
+
+class _BatchSort:
+    """
+    Sorts a list by binary insertion, `width` values at a time, moving
+    on as each answer comes in, for :class:`BatchInsertionEngine`.
+
+    The first value starts the sorted chain. Each value in a batch is
+    searched for in the chain as it was before the batch, so the values
+    in a batch don't depend on each other. The values that land in the
+    same place are sorted among themselves by a :class:`_BatchTask` of
+    their own, which starts as soon as the first of them is found and
+    takes the others as they are found, so that there are more
+    comparisons to answer. Once every value in the batch is found and
+    every group is sorted, the groups are inserted and the next batch
+    starts. Values that are already nearly in order tend to land in the
+    same place, which takes more comparisons, so shuffle them first.
+
+    Each answer only moves on the search that was waiting for it, and
+    the changes it makes are recorded, so that it can be undone without
+    working out the state again from the start.
+    """
+
+    _MISSING = object()  # an item that was not in a dict
+
+    def __init__(self, values, less, width):
+        """
+        Create the sort and start every search it can without answers.
+
+        :param values: The values to sort
+        :type values: list
+        :param less: Called with two values, returns True if the first is
+                     known to be less than the second, False if it is
+                     known to be greater, or None if the comparison has
+                     not been made
+        :type less: function
+        :param width: Number of values searched for at a time
+        :type width: int
+        """
+
+        self.less = less
+        self.width = width
+        # each comparison waiting for an answer, as a tuple of the value
+        # searched for and a value in the chain, mapped to its task
+        self.waiting = {}
+        self.result = None  # the sorted list, once sorting is finished
+
+        # tasks that may start their next batch; handled in turn rather
+        # than recursively, so that long runs of known answers don't
+        # recurse deeply
+        self._ready = collections.deque()
+        # for each answer, the functions that undo its changes
+        self._history = []
+        self._changes = None
+
+        if values:
+            root = _BatchTask(self, None, values[0])
+            root.add(values[1:])
+            root.close()
+            self._run()
+        else:
+            self.result = []
+
+    def answered(self, smaller, larger):
+        """
+        Move on the search waiting for a comparison that has just been
+        answered; the answer must already be known to `less`.
+
+        :param smaller: The value found to be less than `larger`
+        :type smaller: object
+        :param larger: The value found to be greater than `smaller`
+        :type larger: object
+        :return: True if a search was waiting for the comparison,
+                 otherwise False
+        :rtype: bool
+        """
+
+        self._changes = []
+        waited = False
+        for pair in ((smaller, larger), (larger, smaller)):
+            task = self.waiting.get(pair)
+            if task is not None:
+                self.set_item(self.waiting, pair)
+                task.search(pair[0])
+                waited = True
+        self._run()
+        self._history.append(self._changes)
+        self._changes = None
+        return waited
+
+    def undo(self):
+        """
+        Undo the changes made by the most recent call to
+        :meth:`answered`.
+
+        :return: None
+        """
+
+        for undo in reversed(self._history.pop()):
+            undo()
+
+    def ready(self, task):
+        """
+        Let a task start its next batch once the current change is
+        finished.
+
+        :param task: The task
+        :type task: _BatchTask
+        :return: None
+        """
+
+        self._ready.append(task)
+
+    def record(self, undo):
+        """
+        Record how to undo a change made while handling an answer.
+
+        :param undo: Called with no arguments to undo the change
+        :type undo: function
+        :return: None
+        """
+
+        if self._changes is not None:
+            self._changes.append(undo)
+
+    def set(self, obj, name, value):
+        """
+        Set an attribute, recording how to undo it.
+
+        :param obj: The object
+        :type obj: object
+        :param name: Name of the attribute
+        :type name: str
+        :param value: The new value
+        :type value: object
+        :return: None
+        """
+
+        old = getattr(obj, name)
+        setattr(obj, name, value)
+        self.record(lambda: setattr(obj, name, old))
+
+    def set_item(self, mapping, key, value=_MISSING):
+        """
+        Set or delete an item of a dict, recording how to undo it.
+
+        :param mapping: The dict
+        :type mapping: dict
+        :param key: The key
+        :type key: object
+        :param value: The new value, or nothing to delete the item
+        :type value: object
+        :return: None
+        """
+
+        old = mapping.pop(key, self._MISSING)
+        if value is not self._MISSING:
+            mapping[key] = value
+
+        def undo():
+            mapping.pop(key, None)
+            if old is not self._MISSING:
+                mapping[key] = old
+        self.record(undo)
+
+    def _run(self):
+        """
+        Let each ready task start its next batch, until none are ready.
+
+        :return: None
+        """
+
+        while self._ready:
+            self._ready.popleft().next_batch()
+
+
+class _BatchTask:
+    """
+    Sorts one group of values for a :class:`_BatchSort`: every value,
+    or the values that landed in the same place in the chain of its
+    parent task. Every change is made through the sort, so that it can
+    be undone.
+    """
+
+    def __init__(self, sort, parent, value):
+        """
+        Create the task, with its first value as its chain.
+
+        :param sort: The sort the task belongs to
+        :type sort: _BatchSort
+        :param parent: The task whose chain the values landed in, or None
+                       for the task sorting every value
+        :type parent: _BatchTask
+        :param value: The first value
+        :type value: object
+        """
+
+        self.sort = sort
+        self.parent = parent
+        self.values = [value]  # every value given, in the order given
+        self.chain = [value]  # the values sorted so far
+        self.next = 1  # position in `values` of the next batch
+        # (low, high) for each value of the batch still being searched
+        # for, the range of the chain where it may go
+        self.searches = {}
+        # the group of values that landed at each place in the chain
+        self.groups = {}
+        self.running = 0  # number of groups not sorted yet
+        self.closed = False  # True once no more values will be given
+        self.finished = False
+
+    def add(self, values):
+        """
+        Give the task more values to sort.
+
+        :param values: The values
+        :type values: list
+        :return: None
+        """
+
+        if not values:
+            return
+        self.values.extend(values)
+        count = len(values)
+        self.sort.record(lambda: self.values.__delitem__(slice(-count, None)))
+        if not self.searches and not self.groups:
+            self.sort.ready(self)
+
+    def close(self):
+        """
+        Tell the task that it has been given all of its values.
+
+        :return: None
+        """
+
+        self.sort.set(self, 'closed', True)
+        if not self.searches and not self.groups:
+            self.sort.ready(self)
+
+    def next_batch(self):
+        """
+        Start searching for the next batch of values, if the last batch
+        is finished, or finish the task if every value is sorted.
+
+        :return: None
+        """
+
+        if self.finished or self.searches or self.groups:
+            return
+        batch = self.values[self.next:self.next + self.sort.width]
+        if not batch:
+            if self.closed:
+                self.sort.set(self, 'finished', True)
+                if self.parent is None:
+                    self.sort.set(self.sort, 'result', self.chain)
+                else:
+                    self.parent.group_finished()
+            return
+
+        self.sort.set(self, 'next', self.next + len(batch))
+        for value in batch:
+            self.sort.set_item(self.searches, value, (0, len(self.chain)))
+        for value in batch:
+            self.search(value)
+
+    def search(self, value):
+        """
+        Go on searching for a value in the chain, as far as the known
+        comparisons allow.
+
+        :param value: A value in the batch
+        :type value: object
+        :return: None
+        """
+
+        low, high = self.searches[value]
+        while low < high:
+            middle = (low + high) // 2
+            answer = self.sort.less(value, self.chain[middle])
+            if answer is None:
+                self.sort.set_item(self.searches, value, (low, high))
+                self.sort.set_item(
+                    self.sort.waiting, (value, self.chain[middle]), self)
+                return
+            if answer:
+                high = middle
+            else:
+                low = middle + 1
+        self.sort.set_item(self.searches, value)
+        self.place(value, low)
+
+    def place(self, value, place):
+        """
+        Add a value that has been found to the group at its place.
+
+        :param value: The value
+        :type value: object
+        :param place: Position in the chain that the value goes before
+        :type place: int
+        :return: None
+        """
+
+        group = self.groups.get(place)
+        if group is None:
+            self.sort.set_item(
+                self.groups, place, _BatchTask(self.sort, self, value))
+            self.sort.set(self, 'running', self.running + 1)
+        else:
+            group.add([value])
+        if not self.searches:
+            # every value of the batch is found
+            for group in self.groups.values():
+                group.close()
+
+    def group_finished(self):
+        """
+        Called when one of the groups is sorted. Once they all are, they
+        are inserted into the chain.
+
+        :return: None
+        """
+
+        self.sort.set(self, 'running', self.running - 1)
+        if self.running:
+            return
+        chain = list(self.chain)
+        for place in sorted(self.groups, reverse=True):
+            chain[place:place] = self.groups[place].chain
+        self.sort.set(self, 'chain', chain)
+        self.sort.set(self, 'groups', {})
+        self.sort.ready(self)
+
+
+def _normal_cdf(x):
+    """
+    Get the cumulative distribution function of the standard normal
+    distribution.
+
+    :param x: A number
+    :type x: float
+    :return: The probability of a standard normal value being less than
+             `x`
+    :rtype: float
+    """
+
+    return 0.5 * math.erfc(-x / math.sqrt(2))
+
+
+def _normal_pdf(x):
+    """
+    Get the probability density function of the standard normal
+    distribution.
+
+    :param x: A number
+    :type x: float
+    :return: The density at `x`
+    :rtype: float
+    """
+
+    return math.exp(-x * x / 2) / math.sqrt(2 * math.pi)
@@ -0,0 +1,55 @@
+from engines import SortEngine, TreeEngine
+
+
+def headless_sort(values, oracle, filename='tree.pickle', engine=TreeEngine,
+                  metrics=None, library=None):
+    """
+    Sort a list of values using answers from `oracle`, without showing
+    a window. The oracle can be any function called with two values,
+    returning 1 if the first is greater, -1 if it is less, or 0 if they
+    are equal, such as those in :mod:`oracles`.
+
+    Each comparison is saved to the file `filename` as soon as it is
+    made. If the oracle raises :class:`SortEngine.Exit` before sorting
+    is finished, the sorting will be resumed from this file at a later
+    time, and this function will return an empty list.
+
+    :param values: Strings or integers, which may still be being found,
+                   like the files from :func:`parse_args.args_files`
+    :type values: iterable
+    :param oracle: Answers comparisons
+    :type oracle: function
+    :param filename: Name of the file to store the progress, defaults to
+                     'tree.pickle'
+    :type filename: str
+    :param engine: The :class:`engines.SortEngine` subclass used to
+                   sort, defaults to :class:`engines.TreeEngine`
+    :type engine: type
+    :param metrics: Records the comparisons asked and more, defaults to
+                    None to record nothing
+    :type metrics: metrics.Metrics
+    :param library: Ranking of the values from an earlier sort, to
+                    start from and to save the result to, defaults to
+                    None; the values must be filenames
+    :type library: library.Library
+    :return: The sorted list
+    :rtype: list
+    """
+
+    if not values:
+        return list(values)
+
+    try:
+        sorter = engine(filename, oracle=oracle, metrics=metrics)
+        if library is not None:
+            values = list(values)
+            library.load_into(sorter, values)
+        result = sorter.sort(values)
+    except SortEngine.Exit:
+        return []
+
+    if library is not None:
+        library.save(result)
+
+    sorter.delete_file()  # delete the file that stored the progress
+    return result
@@ -1,28 +1,8 @@
+import sys
 import threading
 
-from kivy.app import App
-from kivy.clock import Clock
-from kivy.core.window import Window
-from kivy.lang import Builder
-from kivy.properties import StringProperty
-from kivy.uix.boxlayout import BoxLayout
-
-from trees import SaveStateTree
-
-Builder.load_string("""
-<SelectionLayout>:
-    button_left: button_left
-    button_right: button_right
-    orientation: 'horizontal'
-    ImageButton:
-        id: button_left
-        on_release: root.select_left()
-    ImageButton:
-        id: button_right
-        on_release: root.select_right()
-
-<ImageButton@ButtonBehavior+Image>:
-""")
+from engines import SortEngine, TreeEngine
+from thumbnails import ThumbnailCache
 
 
 class CompareImage(str):
@@ -36,6 +16,7 @@ class CompareImage(str):
     UNDO = object()  # change response to this to undo
     EXIT = object()  # change response to this to exit
     event = threading.Event()  # so the thread can wait for response
+    engine = None  # the SortEngine, to predict the next comparisons
 
     def compare(self, other):
         """
@@ -55,20 +36,27 @@ class CompareImage(str):
         :rtype: int
         """
 
+        from kivy.app import App
+
         # get the layout from the running Kivy app
         layout = App.get_running_app().root
         # set left and right image
         layout.left_image = str(self)
         layout.right_image = str(other)
+        # start decoding the images that may be compared next
+        engine = CompareImage.engine
+        predicted = engine.upcoming() if engine is not None else []
+        layout.prefetcher.request(
+            [str(self), str(other)], [str(image) for image in predicted])
         CompareImage.response = None
         while CompareImage.response is None:
             # wait for response
             CompareImage.event.clear()
             CompareImage.event.wait()
             if CompareImage.response == CompareImage.UNDO:
-                raise SaveStateTree.UndoClicked
+                raise SortEngine.UndoClicked
             if CompareImage.response == CompareImage.EXIT:
-                raise SaveStateTree.Exit
+                raise SortEngine.Exit
             if CompareImage.response is not None:
                 return CompareImage.response
 
@@ -85,199 +73,57 @@ class CompareImage(str):
         return self.compare(other) in [1, 0]
 
 
-class SelectionLayout(BoxLayout):
-    """
-    Kivy layout which presents two images so the user can choose one.
-    """
-
-    left_image = StringProperty('')  # left image source
-    right_image = StringProperty('')  # right image source
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self._keyboard = None
-        self.get_keyboard()  # for keyboard shortcuts
-        # resume thread waiting for layout to be created
-        CompareImage.event.set()
-
-    def on_left_image(self, _instance, _value):
-        """
-        Update the left image in the layout when the attribute
-        `left_image` is changed.
-
-        :param _instance: The SelectionLayout instance
-        :type _instance: SelectionLayout
-        :param _value: The new value of `left_image`
-        :type _value: str
-        :return: None
-        """
-
-        # Use Clock to schedule setting the left button's source image
-        # to self.left_image. this ensures that the UI is updated from
-        # the main thread.
-        def update(_dt):
-            self.button_left.source = self.left_image
-        Clock.schedule_once(update)
-
-    def on_right_image(self, _instance, _value):
-        """
-        Update the right image in the layout when the attribute
-        `right_image` is changed.
-
-        :param _instance: The SelectionLayout instance
-        :type _instance: SelectionLayout
-        :param _value: The new value of `right_image`
-        :type _value: str
-        :return: None
-        """
-
-        # Use Clock to schedule setting the right button's source image
-        # to self.right_image. This ensures that the UI is updated from
-        # the main thread.
-        def update(_dt):
-            self.button_right.source = self.right_image
-        Clock.schedule_once(update)
-
-    @staticmethod
-    def select_left():
-        """
-        Set `CompareImage.response` to 1 to indicate that the left image
-        is "greater than" the right image.
-
-        :return: None
-        """
-
-        CompareImage.response = 1
-        CompareImage.event.set()  # resume the waiting thread
-
-    @staticmethod
-    def select_right():
-        """
-        Set `CompareImage.response` to -1 to indicate that the left
-        image is "less than" the right image.
-
-        :return: None
-        """
-
-        CompareImage.response = -1
-        CompareImage.event.set()  # resume the waiting thread
-
-    @staticmethod
-    def undo():
-        """
-        Undo the last comparison.
-
-        :return: None
-        """
-
-        CompareImage.response = CompareImage.UNDO
-        CompareImage.event.set()  # resume the waiting thread
-
-    def get_keyboard(self):
-        """
-        Get keyboard focus.
-
-        :return: None
-        """
-
-        # get the keyboard instance
-        self._keyboard = Window.request_keyboard(
-            self._keyboard_closed, self)
-        # bind to run _on_keyboard_down when a key is pressed
-        self._keyboard.bind(on_key_down=self._on_keyboard_down)
-
-    def _on_keyboard_down(self, _keyboard, keycode, _text, modifiers):
-        """
-        Receive keypresses. Pressing '1' on will select the left image,
-        pressing '2' will select the right image, and pressing 'Ctrl+Z'
-        will undo.
-
-        :param _keyboard: A Keyboard instance
-        :type _keyboard: kivy.core.window.Keyboard
-        :param keycode: An integer and a string representing the keycode
-        :type keycode: tuple
-        :param _text: The text of the pressed key
-        :type _text: str
-        :param modifiers: A list of modifier keys pressed
-        :type modifiers: list
-        :return: True to consume the key, otherwise False
-        :rtype: bool
-        """
-
-        if keycode[1] in ['1', 'numpad1']:
-            self.select_left()
-            return True
-        elif keycode[1] in ['2', 'numpad2']:
-            self.select_right()
-            return True
-        elif keycode[1] == 'z' and 'ctrl' in modifiers:
-            self.undo()
-            return True
-        return False
-
-    def _keyboard_closed(self):
-        """
-        Remove keyboard binding when the keyboard is closed.
-
-        :return: None
-        """
-
-        # unbind _on_keyboard_down
-        self._keyboard.unbind(on_key_down=self._on_keyboard_down)
-        self._keyboard = None
-
-
-class SortApp(App):
-    """A Kivy App with a SelectionLayout as its root layout."""
-    def build(self):
-        """
-        Build the root layout of the app.
-
-        :return: The root layout
-        :rtype: SelectionLayout
-        """
-
-        return SelectionLayout()
-
-    def on_stop(self):
-        """
-        When the app is closed, save the tree to file.
-
-        :return:
-        """
-
-        CompareImage.response = CompareImage.EXIT
-        CompareImage.event.set()
-
-
-def image_sort(image_list, filename='tree.pickle'):
+def image_sort(image_list, filename='tree.pickle', engine=TreeEngine,
+               metrics=None, library=None):
     """
     Sort a list of images based on user input. The images will be
     presented in a Kivy app two at a time, so that the user can select
     which image is "greater than" the other.
 
-    If the app is closed before sorting is finished, the tree used to
-    sort the images will be written to the file `filename` to be
-    resumed at a later time, and this function will return an empty
-    list.
+    Each comparison is saved to the file `filename` as soon as it is
+    made. If the app is closed (or the program is killed) before
+    sorting is finished, the sorting will be resumed from this file at
+    a later time, and this function will return an empty list.
+
+    Thumbnails of the images are kept in the directory `.thumbnails`
+    next to `filename`, so that later sessions don't have to decode the
+    original images again.
 
-    :param image_list: List of image filenames
-    :type image_list: list
+    :param image_list: Image filenames; with the tree engine, sorting
+                       starts while they are still being found, e.g.
+                       from a :class:`discovery.Discovery`
+    :type image_list: iterable
     :param filename: Name of the file to store the tree, defaults to
                      'tree.pickle'
     :type filename: str
+    :param engine: The :class:`engines.SortEngine` subclass used to
+                   sort, defaults to :class:`engines.TreeEngine`
+    :type engine: type
+    :param metrics: Records the comparisons asked, how long the user
+                    took to answer, how long images took to appear and
+                    more, defaults to None to record nothing
+    :type metrics: metrics.Metrics
+    :param library: Ranking of the images from an earlier sort; images
+                    already in it keep their place and only the others
+                    are compared, and the result is saved to it,
+                    defaults to None
+    :type library: library.Library
     :return: The sorted list
     :rtype: list
     """
 
     if not image_list:
-        return image_list
+        return list(image_list)
+
+    # importing Kivy takes a long time, so it is only imported once a
+    # window is needed
+    from kivy.core.window import Window
+    from sort_app import SortApp
 
     def _sort():
         """
-        Insert each string from image_list into a :class:`SaveStateTree`
-        and then get the sorted list from the tree, placing the result
-        in `sorted_list`.
+        Sort the strings from image_list with the sort engine, placing
+        the result in `sorted_list`.
 
         :return: None
         """
@@ -286,18 +132,35 @@ def image_sort(image_list, filename='tree.pickle'):
         CompareImage.event.clear()
         CompareImage.event.wait()
 
+        # make the missing thumbnails in the background
+        threading.Thread(
+            target=thumbnails.make_all, args=(image_list,),
+            daemon=True).start()
+
         try:
-            tree = SaveStateTree(filename)
-            for image in image_list:
-                # check if image already in tree, in case the sorting is
-                # being resumed
-                if image not in tree.values:
-                    tree.insert(CompareImage(image))
-        except SaveStateTree.Exit:
+            sorter = engine(
+                filename, value_type=CompareImage, metrics=metrics)
+            CompareImage.engine = sorter
+            images = (CompareImage(image) for image in image_list)
+            if library is not None:
+                # every image is needed to know which have been deleted
+                images = list(images)
+                library.load_into(sorter, images)
+            result = sorter.sort(images)
+        except SortEngine.Exit:
             return
+        except ValueError as e:
+            # e.g. the save file can't be read; close the window rather
+            # than leaving it blank
+            print(e, file=sys.stderr)
+            app.stop()
+            return
+
+        if library is not None:
+            library.save(result)
 
-        tree.delete_file()  # delete the file that stored the tree
-        sorted_list.extend(tree.to_list())
+        sorter.delete_file()  # delete the file that stored the progress
+        sorted_list.extend(result)
         sort_event.set()  # resume the waiting thread
         app.stop()  # close the window
 
@@ -308,7 +171,8 @@ def image_sort(image_list, filename='tree.pickle'):
     thread = threading.Thread(target=_sort)
     thread.start()
 
-    app = SortApp()
+    thumbnails = ThumbnailCache.for_state_file(filename, Window.size)
+    app = SortApp(thumbnails, metrics)
     # make sure the thread doesn't keep waiting if the app closes
     app.bind(on_stop=lambda instance: sort_event.set())
     app.run()
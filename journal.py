@@ -0,0 +1,600 @@
+import array
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+
+class Journal:
+    """
+    The file used to save a :class:`trees.SaveStateTree` or an
+    :class:`engines.MergeInsertionEngine`.
+
+    The file begins with a checkpoint: a header holding the file format
+    version, followed by arrays describing the tree when it was last
+    saved (a table of values, the value, left child, right child and
+    heights of each node, the comparisons made for the value being
+    inserted, the values waiting to be resumed, and the answers in the
+    comparison cache).
+
+    The checkpoint is followed by a journal of records, each added as
+    soon as it happens, so if the program is killed, at most the record
+    being written at that moment is lost. Loading the file maps it into
+    memory and reads the arrays directly, without unpickling anything.
+
+    Only strings and integers can be stored as values.
+    """
+
+    # kinds of record
+    INSERT = 0  # a value was inserted
+    ANSWER = 1  # a comparison was answered
+    UNDO = 2  # a comparison was undone
+    ORDER = 3  # a comparison between two saved values was answered
+
+    MAGIC = b'SSRT'
+    VERSION = 4
+    # version 1 files have no cached answers; that field was reserved.
+    # version 2 files have no ORDER records. Versions before 4 have no
+    # number of values loaded
+    _VERSIONS = (1, 2, 3, 4)
+
+    # magic, version, flags, number of values, number of nodes, root
+    # node, length of path, number of values to resume, size of the
+    # table of values in bytes, number of cached answers, number of
+    # values loaded already sorted
+    _HEADER = struct.Struct('<4sHHiiiiiqii')
+    _OLD_HEADER = struct.Struct('<4sHHiiiiiqi')  # before version 4
+    _IN_PROGRESS = 1  # flag: the last value was being inserted
+
+    _LENGTH = struct.Struct('<I')
+    # indices of the smaller and the larger value in the saved values
+    _ORDER = struct.Struct('<II')
+
+    # kinds of value
+    _STR = 0
+    _INT = 1
+
+    # one byte per record, followed by the value for an insertion
+    _CODES = {b'i': INSERT, b't': ANSWER, b'f': ANSWER, b'u': UNDO,
+              b'o': ORDER}
+
+    # older versions pickled the whole tree; pickles start with this
+    _PICKLE = b'\x80'
+
+    class Checkpoint:
+        """The state of the tree read from the start of the file."""
+        def __init__(self):
+            """Create an empty checkpoint."""
+            self.values = []  # every value inserted, in order
+            self.root = None  # root node of the tree
+            self.path = []  # comparisons made for the last value
+            self.resume = []  # values waiting to be resumed
+            self.in_progress = False  # whether path is in use
+            self.answers = []  # (smaller, larger) tuples for the cache
+            # number of values at the start of `values` that were loaded
+            # already sorted, rather than compared
+            self.loaded = 0
+
+    def __init__(self, filename, value_type=None):
+        """
+        Create the journal.
+
+        :param filename: Name of the file
+        :type filename: str
+        :param value_type: Called with each value loaded from the file,
+                           to convert it from a string or integer to
+                           the type that was inserted, defaults to None
+        :type value_type: type
+        """
+
+        self.filename = filename
+        self.value_type = value_type
+        self._file = None
+
+    def read(self, new_node):
+        """
+        Read the checkpoint and all records from the file. If the last
+        record is incomplete, because the program was killed while
+        writing it, it is removed from the file.
+
+        :param new_node: Called with a value to create each node of the
+                         tree
+        :type new_node: function
+        :return: The checkpoint, and a list of records, each a tuple of
+                 the kind of record and its value
+        :rtype: tuple
+        """
+
+        checkpoint = self.Checkpoint()
+        records = []
+        try:
+            f = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return checkpoint, records  # nothing has been written yet
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return checkpoint, records
+            legacy = f.read(1) == self._PICKLE
+            if not legacy:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if legacy:
+            # saved by an older version; convert the file, then read it
+            # like any other
+            self._convert_legacy()
+            return self.read(new_node)
+
+        with mm:
+            view = memoryview(mm)
+            try:
+                position = self._read_checkpoint(view, checkpoint, new_node)
+                end = self._read_records(view, position, records)
+            finally:
+                view.release()
+
+        if end < size:
+            # discard the incomplete record
+            os.truncate(self.filename, end)
+        return checkpoint, records
+
+    def _convert_legacy(self):
+        """
+        Replace a file saved by an older version, which pickled the
+        whole :class:`trees.SaveStateTree`, with a checkpoint holding
+        the same tree, the comparisons made for the value being
+        inserted, and the values waiting to be resumed. The old undo
+        history is left out; it is rebuilt if it is needed.
+
+        :return: None
+        """
+
+        try:
+            with open(self.filename, 'rb') as f:
+                tree = _LegacyUnpickler(f).load()
+            values = list(tree.values)
+            resume = list(tree.resume)
+            path = list(tree.nodes[-1]) if tree.nodes else []
+            root = tree.root
+        except (pickle.UnpicklingError, AttributeError, EOFError,
+                IndexError, TypeError) as e:
+            raise ValueError(
+                '{} is not a save file: {}'.format(self.filename, e))
+
+        # values were copied along with the old states of the tree, so
+        # refer to each by the first value equal to it
+        canonical = {}
+        for value in values + resume:
+            canonical.setdefault(value, value)
+        path = [canonical.get(value, value) for value in path]
+        stack = [root] if root is not None else []
+        while stack:
+            node = stack.pop()
+            node.value = canonical.get(node.value, node.value)
+            stack.extend(child for child in (node.left, node.right)
+                         if child is not None)
+
+        # the old version only saved while asking a comparison for the
+        # last value inserted
+        self.save(values, root, path, resume, bool(path), [])
+
+    def _read_checkpoint(self, view, checkpoint, new_node):
+        """
+        Read the checkpoint from the start of the file.
+
+        :param view: The contents of the file
+        :type view: memoryview
+        :param checkpoint: Filled in with the contents of the checkpoint
+        :type checkpoint: Journal.Checkpoint
+        :param new_node: Called with a value to create each node
+        :type new_node: function
+        :return: The position of the first record in the file
+        :rtype: int
+        """
+
+        if len(view) < self._OLD_HEADER.size:
+            raise ValueError('{} is not a save file'.format(self.filename))
+        (magic, version, flags, n_values, n_nodes, root, n_path, n_resume,
+         table_size, n_answers) = self._OLD_HEADER.unpack_from(view)
+        if magic != self.MAGIC:
+            raise ValueError('{} is not a save file'.format(self.filename))
+        if version not in self._VERSIONS:
+            raise ValueError('{} has unsupported version {}'.format(
+                self.filename, version))
+        header = self._OLD_HEADER
+        if version >= 4:
+            header = self._HEADER
+            if len(view) < header.size:
+                raise ValueError('save file is incomplete')
+            checkpoint.loaded = header.unpack_from(view)[-1]
+
+        reader = _ArrayReader(view, header.size)
+        try:
+            self._read_arrays(
+                reader, checkpoint, new_node, n_values, n_nodes, root,
+                n_path, n_resume, table_size, n_answers)
+        finally:
+            reader.release()
+        checkpoint.in_progress = bool(flags & self._IN_PROGRESS)
+        return reader.position
+
+    def _read_arrays(self, reader, checkpoint, new_node, n_values, n_nodes,
+                     root, n_path, n_resume, table_size, n_answers):
+        """
+        Read the arrays of the checkpoint that follow the header.
+
+        :param reader: Reads arrays from the file
+        :type reader: _ArrayReader
+        :param checkpoint: Filled in with the contents of the checkpoint
+        :type checkpoint: Journal.Checkpoint
+        :param new_node: Called with a value to create each node
+        :type new_node: function
+        :param n_values: Number of values inserted
+        :type n_values: int
+        :param n_nodes: Number of nodes in the tree
+        :type n_nodes: int
+        :param root: Number of the root node, or -1 if there is none
+        :type root: int
+        :param n_path: Number of values in the path
+        :type n_path: int
+        :param n_resume: Number of values to resume
+        :type n_resume: int
+        :param table_size: Size of the table of values in bytes
+        :type table_size: int
+        :param n_answers: Number of cached answers
+        :type n_answers: int
+        :return: None
+        """
+
+        n_table = n_values + n_resume
+        offsets = reader.read('q', n_table + 1)
+        node_values = reader.read('i', n_nodes)
+        lefts = reader.read('i', n_nodes)
+        rights = reader.read('i', n_nodes)
+        path = reader.read('i', n_path)
+        resume = reader.read('i', n_resume)
+        answers = reader.read('i', 2 * n_answers)
+        kinds = reader.read('B', n_table)
+        heights = reader.read('B', n_nodes)
+        min_heights = reader.read('B', n_nodes)
+        table = reader.read('B', table_size)
+
+        values = [
+            self._decode(kinds[i], table[offsets[i]:offsets[i + 1]])
+            for i in range(n_table)]
+        nodes = [new_node(values[i]) for i in node_values]
+        for node, left, right, height, min_height in zip(
+                nodes, lefts, rights, heights, min_heights):
+            node.left = nodes[left] if left >= 0 else None
+            node.right = nodes[right] if right >= 0 else None
+            node.height = height
+            node.min_height = min_height
+
+        checkpoint.values = values[:n_values]
+        checkpoint.root = nodes[root] if root >= 0 else None
+        checkpoint.path = [values[i] for i in path]
+        checkpoint.resume = [values[i] for i in resume]
+        checkpoint.answers = [
+            (values[answers[i]], values[answers[i + 1]])
+            for i in range(0, len(answers), 2)]
+
+    def _read_records(self, view, position, records):
+        """
+        Read the records that follow the checkpoint.
+
+        :param view: The contents of the file
+        :type view: memoryview
+        :param position: The position of the first record
+        :type position: int
+        :param records: Each record read is appended to this list
+        :type records: list
+        :return: The position after the last complete record
+        :rtype: int
+        """
+
+        size = len(view)
+        while position < size:
+            code = bytes(view[position:position + 1])
+            kind = self._CODES.get(code)
+            if kind == self.INSERT:
+                start = position + 2 + self._LENGTH.size
+                if start > size:
+                    break  # incomplete record
+                (length,) = self._LENGTH.unpack_from(view, position + 2)
+                if start + length > size:
+                    break  # incomplete record
+                value = self._decode(
+                    view[position + 1], view[start:start + length])
+                records.append((kind, value))
+                position = start + length
+            elif kind == self.ANSWER:
+                records.append((kind, code == b't'))
+                position += 1
+            elif kind == self.UNDO:
+                records.append((kind, None))
+                position += 1
+            elif kind == self.ORDER:
+                if position + 1 + self._ORDER.size > size:
+                    break  # incomplete record
+                records.append(
+                    (kind, self._ORDER.unpack_from(view, position + 1)))
+                position += 1 + self._ORDER.size
+            else:
+                break  # not a record; treat as incomplete
+        return position
+
+    def append(self, kind, value=None):
+        """
+        Add a record to the end of the file.
+
+        :param kind: The kind of record, :attr:`INSERT`, :attr:`ANSWER`,
+                     :attr:`UNDO` or :attr:`ORDER`
+        :type kind: int
+        :param value: The inserted value, the answer to a comparison,
+                      or for :attr:`ORDER`, the indices of the smaller
+                      and the larger value in the saved values, defaults
+                      to None
+        :type value: object
+        :return: None
+        """
+
+        if kind == self.INSERT:
+            value_kind, data = self._encode(value)
+            record = (b'i' + bytes([value_kind])
+                      + self._LENGTH.pack(len(data)) + data)
+        elif kind == self.ANSWER:
+            record = b't' if value else b'f'
+        elif kind == self.ORDER:
+            record = b'o' + self._ORDER.pack(*value)
+        else:
+            record = b'u'
+
+        if self._file is None:
+            if not os.path.exists(self.filename):
+                self.save([], None, [], [], False, [])
+            self._file = open(self.filename, 'ab')
+        self._file.write(record)
+        self._file.flush()
+
+    def save(self, values, root, path, resume, in_progress, answers,
+             loaded=0):
+        """
+        Replace the file with a new checkpoint holding the current state
+        of the tree, followed by no records.
+
+        :param values: Every value inserted, in order
+        :type values: list
+        :param root: The root node of the tree
+        :type root: MyTree._Node
+        :param path: The values compared to the last value
+        :type path: list
+        :param resume: Values waiting to be resumed
+        :type resume: list
+        :param in_progress: True if the last value is being inserted,
+                            and `path` is in use
+        :type in_progress: bool
+        :param answers: The answers in the comparison cache, each a
+                        tuple of a value and a value it is less than
+        :type answers: list
+        :param loaded: Number of values at the start of `values` that
+                       were loaded already sorted, defaults to 0
+        :type loaded: int
+        :return: None
+        """
+
+        self.close()
+
+        # number each value; values in resume follow the inserted ones
+        table = list(values) + list(resume)
+        indices = {id(value): i for i, value in enumerate(table)}
+        kinds = array.array('B')
+        offsets = array.array('q', [0])
+        data = []
+        for value in table:
+            value_kind, encoded = self._encode(value)
+            kinds.append(value_kind)
+            data.append(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+
+        # number each node in pre-order
+        nodes = []
+        stack = [root] if root is not None else []
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            if node.right is not None:
+                stack.append(node.right)
+            if node.left is not None:
+                stack.append(node.left)
+        numbers = {id(node): i for i, node in enumerate(nodes)}
+
+        def number(node):
+            return -1 if node is None else numbers[id(node)]
+
+        arrays = [
+            offsets,
+            array.array('i', (indices[id(node.value)] for node in nodes)),
+            array.array('i', (number(node.left) for node in nodes)),
+            array.array('i', (number(node.right) for node in nodes)),
+            array.array('i', (indices[id(value)] for value in path)),
+            array.array('i', (indices[id(value)] for value in resume)),
+            array.array('i', (
+                indices[id(value)] for answer in answers
+                for value in answer)),
+            kinds,
+            array.array('B', (node.height for node in nodes)),
+            array.array('B', (node.min_height for node in nodes)),
+        ]
+        if sys.byteorder != 'little':
+            for a in arrays:
+                a.byteswap()
+
+        header = self._HEADER.pack(
+            self.MAGIC, self.VERSION,
+            self._IN_PROGRESS if in_progress else 0,
+            len(values), len(nodes), number(root), len(path), len(resume),
+            offsets[-1], len(answers), loaded)
+
+        # write to a temporary file first, so that the old file is kept
+        # if the program is killed while writing
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(header)
+            for a in arrays:
+                a.tofile(f)
+            f.write(b''.join(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename)
+
+    def close(self):
+        """
+        Close the file.
+
+        :return: None
+        """
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def delete(self):
+        """
+        Close and delete the file.
+
+        :return: None
+        """
+
+        self.close()
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def _encode(self, value):
+        """
+        Convert a value to bytes.
+
+        :param value: A string or integer
+        :type value: str or int
+        :return: The kind of value and its bytes
+        :rtype: tuple
+        """
+
+        if isinstance(value, str):
+            return self._STR, value.encode('utf-8', 'surrogateescape')
+        if isinstance(value, int):
+            return self._INT, str(int(value)).encode('ascii')
+        raise TypeError(
+            'cannot save value of type {}'.format(type(value).__name__))
+
+    def _decode(self, value_kind, data):
+        """
+        Convert bytes read from the file back to a value.
+
+        :param value_kind: The kind of value
+        :type value_kind: int
+        :param data: The bytes of the value
+        :type data: memoryview
+        :return: The value
+        :rtype: object
+        """
+
+        if value_kind == self._STR:
+            value = str(data, 'utf-8', 'surrogateescape')
+        else:
+            value = int(bytes(data))
+        if self.value_type is not None:
+            value = self.value_type(value)
+        return value
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """
+    Unpickles a save file from an older version, without importing
+    anything: the tree and its nodes are loaded as plain objects, and
+    values of a subclass of str, e.g. :class:`image_sort.CompareImage`,
+    as strings.
+    """
+
+    class Object:
+        """A tree or node from the save file."""
+        pass
+
+    class String(str):
+        """A value from the save file."""
+        pass
+
+    def find_class(self, module, name):
+        """
+        Get the class to load an object as.
+
+        :param module: The module that the object's class was in
+        :type module: str
+        :param name: The name of the class
+        :type name: str
+        :return: The class
+        :rtype: type
+        """
+
+        if module == 'trees':
+            return self.Object
+        if module == 'image_sort' and name == 'CompareImage':
+            return self.String
+        raise pickle.UnpicklingError(
+            'unexpected class {}.{}'.format(module, name))
+
+
+class _ArrayReader:
+    """Reads consecutive arrays from a memoryview without copying."""
+    def __init__(self, view, position):
+        """
+        Create the reader.
+
+        :param view: The bytes to read from
+        :type view: memoryview
+        :param position: The position of the first array
+        :type position: int
+        """
+
+        self.view = view
+        self.position = position
+        self._views = []
+
+    def read(self, typecode, length):
+        """
+        Read the next array.
+
+        :param typecode: The type of the items, as for :mod:`array`
+        :type typecode: str
+        :param length: The number of items
+        :type length: int
+        :return: The array
+        :rtype: memoryview or array.array
+        """
+
+        size = struct.calcsize(typecode) * length
+        end = self.position + size
+        if end > len(self.view):
+            raise ValueError('save file is incomplete')
+        data = self.view[self.position:end]
+        self.position = end
+        if sys.byteorder != 'little' and size > length:
+            # stored as little-endian, so the bytes must be swapped
+            items = array.array(typecode, data)
+            items.byteswap()
+            return items
+        data = data.cast(typecode)
+        self._views.append(data)
+        return data
+
+    def release(self):
+        """
+        Release every array read, so that the file can be closed.
+
+        :return: None
+        """
+
+        for data in self._views:
+            data.release()
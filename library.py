@@ -0,0 +1,130 @@
+import json
+import os
+
+
+class Library:
+    """
+    The final ranking of a sort, kept between runs so that sorting the
+    same files again only compares the files added since.
+
+    Files are recorded by their identity (device and inode number, with
+    the size and modification time, since inode numbers of deleted
+    files are reused) rather than their name, so a file keeps its place
+    in the ranking if it is renamed or moved within the same file
+    system. A file that is modified is ranked again. Where a file system
+    has no inode numbers, the absolute path is used instead.
+
+    The library is a JSON file holding the files from least to greatest.
+    """
+
+    VERSION = 1
+
+    def __init__(self, filename):
+        """
+        Create the library.
+
+        :param filename: Name of the library file; it is created by
+                         :meth:`save` if it does not exist
+        :type filename: str
+        """
+
+        self.filename = filename
+
+    def ranked(self, files):
+        """
+        Get the files that are already in the library, in the order they
+        were ranked. Files in the library that are not in `files`, e.g.
+        because they were deleted, are left out.
+
+        :param files: Names of the files being sorted
+        :type files: list
+        :return: The files from `files` that are in the library, sorted
+                 from least to greatest
+        :rtype: list
+        """
+
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return []
+        if data.get('version') != self.VERSION:
+            raise ValueError('{} has unsupported version {}'.format(
+                self.filename, data.get('version')))
+
+        by_identity = {}
+        for filename in files:
+            identity = _identity(filename)
+            if identity is not None:
+                by_identity.setdefault(identity, filename)
+        ranked = []
+        for entry in data['files']:
+            filename = by_identity.pop(tuple(entry['identity']), None)
+            if filename is not None:
+                ranked.append(filename)
+        return ranked
+
+    def load_into(self, sorter, files):
+        """
+        Start a new sort from the ranking of the files that are already
+        in the library, so that only the other files are compared. If
+        the sort is being resumed from its save file, it already holds
+        them, and nothing is loaded.
+
+        :param sorter: The sort engine
+        :type sorter: engines.SortEngine
+        :param files: Names of the files being sorted
+        :type files: list
+        :return: None
+        """
+
+        ranked = self.ranked(files)
+        try:
+            sorter.load_sorted(ranked)
+        except ValueError:
+            pass  # the sort is being resumed
+
+    def save(self, ranked):
+        """
+        Replace the library with a new ranking. Files that no longer
+        exist are left out.
+
+        :param ranked: Names of the files sorted from least to greatest
+        :type ranked: list
+        :return: None
+        """
+
+        entries = []
+        for filename in ranked:
+            identity = _identity(str(filename))
+            if identity is not None:
+                entries.append(
+                    {'identity': list(identity), 'name': str(filename)})
+
+        # write to a temporary file first, so that the old library is
+        # kept if the program is killed while writing
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump({'version': self.VERSION, 'files': entries}, f)
+        os.replace(temp_filename, self.filename)
+
+
+def _identity(filename):
+    """
+    Get the identity of a file.
+
+    :param filename: Name of the file
+    :type filename: str
+    :return: The device and inode number, or the absolute path if the
+             file system has no inode numbers, followed by the size and
+             modification time, or None if the file does not exist
+    :rtype: tuple
+    """
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if stat.st_ino:
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+    return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+import time
+
+
+class Metrics:
+    """
+    Counts and times what happens while sorting, to see where the time
+    goes in a real session.
+
+    Trees and engines only record metrics if one is given, e.g.
+    ``SaveStateTree(filename, metrics=Metrics())``. Three kinds of
+    metric are recorded:
+
+    counters
+        Totals that only go up, e.g. comparisons asked; see
+        :meth:`count`.
+    gauges
+        The latest value of something, e.g. the number of saved states
+        in the undo history; see :meth:`set`.
+    summaries
+        Each value observed, e.g. how long the user took to answer; see
+        :meth:`observe`.
+
+    The metrics can be written as a Prometheus text file with
+    :meth:`write`. If `log` is given, each value observed is also
+    appended to it as a line of JSON as it happens.
+
+    Metrics may be recorded from any thread.
+    """
+
+    PREFIX = 'ssort_'
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, log=None):
+        """
+        Create the metrics.
+
+        :param log: Name of a file to append each value observed to, as
+                    a line of JSON, defaults to None
+        :type log: str
+        """
+
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {}  # name: list of values observed
+        self._log = open(log, 'a') if log else None
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter.
+
+        :param name: Name of the counter
+        :type name: str
+        :param amount: Amount to add, defaults to 1
+        :type amount: int
+        :return: None
+        """
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        """
+        Set a gauge.
+
+        :param name: Name of the gauge
+        :type name: str
+        :param value: The value
+        :type value: float
+        :return: None
+        """
+
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        """
+        Add a value to a summary, and to the log.
+
+        :param name: Name of the summary
+        :type name: str
+        :param value: The value
+        :type value: float
+        :return: None
+        """
+
+        with self._lock:
+            self.summaries.setdefault(name, []).append(value)
+            if self._log is not None:
+                self._log.write(json.dumps(
+                    {'time': time.time(), 'metric': name, 'value': value})
+                    + '\n')
+
+    def timed(self, name, function, *args):
+        """
+        Call a function, adding the number of seconds it took to a
+        summary. Nothing is added if it raises an exception.
+
+        :param name: Name of the summary
+        :type name: str
+        :param function: The function
+        :type function: function
+        :return: The result of the function
+        :rtype: object
+        """
+
+        start = time.perf_counter()
+        result = function(*args)
+        self.observe(name, time.perf_counter() - start)
+        return result
+
+    def write(self, filename):
+        """
+        Write the metrics to a file in the Prometheus text format, e.g.
+        for the node exporter's textfile collector. The file is replaced
+        all at once, so it is never read half-written.
+
+        :param filename: Name of the file
+        :type filename: str
+        :return: None
+        """
+
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                name = self.PREFIX + name + '_total'
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, value))
+            for name, value in sorted(self.gauges.items()):
+                name = self.PREFIX + name
+                lines.append('# TYPE {} gauge'.format(name))
+                lines.append('{} {}'.format(name, value))
+            for name, values in sorted(self.summaries.items()):
+                name = self.PREFIX + name
+                ordered = sorted(values)
+                lines.append('# TYPE {} summary'.format(name))
+                for quantile in self.QUANTILES:
+                    index = min(int(quantile * len(ordered)),
+                                len(ordered) - 1)
+                    lines.append('{}{{quantile="{}"}} {}'.format(
+                        name, quantile, ordered[index]))
+                lines.append('{}_sum {}'.format(name, sum(ordered)))
+                lines.append('{}_count {}'.format(name, len(ordered)))
+            if self._log is not None:
+                self._log.flush()
+
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_filename, filename)
+
+    def close(self):
+        """
+        Close the log, if there is one.
+
+        :return: None
+        """
+
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
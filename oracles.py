@@ -0,0 +1,90 @@
+from engines import SortEngine
+
+
+class ScriptedOracle:
+    """
+    An oracle that reads its answers from a text file, one per line:
+    ``1`` if the first value is greater, ``-1`` if it is less, ``0`` if
+    they are equal, or ``undo`` to undo the previous comparison. Blank
+    lines and lines starting with ``#`` are ignored.
+
+    When the answers run out, :class:`SortEngine.Exit` is raised, so the
+    progress is saved, and the comparison that was not answered is kept
+    in `pending`. Sorting can then be resumed with another file.
+    """
+
+    UNDO = 'undo'
+
+    def __init__(self, filename):
+        """
+        Create the oracle.
+
+        :param filename: Name of the answer file
+        :type filename: str
+        """
+
+        with open(filename) as f:
+            lines = [line.strip() for line in f]
+        self.answers = [line for line in lines
+                        if line and not line.startswith('#')]
+        self.position = 0  # index of the next answer
+        self.pending = None  # (value, other) if the answers ran out
+
+    def __call__(self, value, other):
+        """
+        Answer a comparison with the next answer in the file.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: 1 if `value` is greater than `other`, -1 if it is less,
+                 or 0 if they are equal
+        :rtype: int
+        """
+
+        if self.position == len(self.answers):
+            self.pending = (value, other)
+            raise SortEngine.Exit
+        answer = self.answers[self.position]
+        self.position += 1
+        if answer == self.UNDO:
+            raise SortEngine.UndoClicked
+        if answer not in ('1', '-1', '0'):
+            raise ValueError('invalid answer on line {}: {!r}'.format(
+                self.position, answer))
+        return int(answer)
+
+
+class ScoreOracle:
+    """
+    An oracle that compares values by a score, e.g. to simulate a user
+    who knows the true order of the values.
+    """
+
+    def __init__(self, score):
+        """
+        Create the oracle.
+
+        :param score: Called with a value to get its score; values with
+                      higher scores are greater
+        :type score: function
+        """
+
+        self.score = score
+
+    def __call__(self, value, other):
+        """
+        Compare the scores of two values.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: 1 if `value` has the higher score, -1 if it has the
+                 lower score, or 0 if the scores are equal
+        :rtype: int
+        """
+
+        score, other_score = self.score(value), self.score(other)
+        return (score > other_score) - (score < other_score)
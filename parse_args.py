@@ -2,30 +2,67 @@ import argparse
 import os
 import sys
 
+from discovery import Discovery
 
-def args_files():
-    """
-    Parse command line arguments, returning a list of files.
 
-    :return: A list of filenames
-    :rtype: list
+# extensions of the image files found in directories, and the bytes
+# that each kind of image file starts with
+IMAGE_EXTENSIONS = {'.bmp', '.gif', '.jpe', '.jpeg', '.jpg', '.png', '.tif',
+                    '.tiff', '.webp'}
+_MAGIC = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a',
+          b'BM', b'II*\x00', b'MM\x00*')
+
+
+def args_files(args):
     """
+    Get the files to sort from the parsed command line arguments. Files
+    in directories are found on a background thread, so sorting can
+    start before they have all been found.
+
+    :param args: The arguments from :func:`parse`
+    :type args: argparse.Namespace
+    :return: The filenames, which can be iterated over as they are
+             found
+    :rtype: discovery.Discovery
+    """
+
+    return Discovery(_find_files(
+        args.files, args.batch_file, args.include_subdirs,
+        not args.all_files))
 
-    files_or_dirs = args.files
 
-    if args.batch_file:
-        files_or_dirs.extend(_from_file(args.batch_file))
-    elif not args.files:
+def _find_files(files_or_dirs, batch_file, subdir, images_only):
+    """
+    Generate the files to sort. Files named on the command line or in
+    the batch file are always included; files in directories are only
+    included if they are images, unless `images_only` is False.
+
+    :param files_or_dirs: Files and directories from the command line
+    :type files_or_dirs: list
+    :param batch_file: Text file containing filenames, or None
+    :type batch_file: str
+    :param subdir: True to include subdirectories, otherwise False
+    :type subdir: bool
+    :param images_only: True to skip files in directories that are not
+                        images, otherwise False
+    :type images_only: bool
+    :return: A generator of filenames
+    :rtype: generator
+    """
+
+    files_or_dirs = list(files_or_dirs)
+    if batch_file:
+        files_or_dirs.extend(_from_file(batch_file))
+    elif not files_or_dirs:
         files_or_dirs.append(os.getcwd())
 
-    files = []
     for f in files_or_dirs:
         if os.path.isdir(f):
-            files.extend(_from_directory(f, args.include_subdirs))
+            for filename in _from_directory(f, subdir):
+                if not images_only or is_image(filename):
+                    yield filename
         else:
-            files.append(f)
-
-    return files
+            yield f
 
 
 def _from_file(filename):
@@ -44,27 +81,68 @@ def _from_file(filename):
 
 def _from_directory(path, subdir):
     """
-    Get filenames from a directory. If `subdir` is True, include files
-    from subdirectories.
+    Generate filenames from a directory, as they are found. If `subdir`
+    is True, include files from subdirectories. Directories that can't
+    be read are skipped.
 
     :param path: Path to the directory
     :type path: str
     :param subdir: True to include subdirectories, otherwise False
     :type subdir: bool
-    :return: A list of filenames
-    :rtype: list
+    :return: A generator of filenames
+    :rtype: generator
+    """
+
+    directories = [path]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            continue
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        yield entry.path
+                    elif subdir and entry.is_dir():
+                        subdirectories.append(entry.path)
+                except OSError:
+                    pass
+        # visit subdirectories in the order they were found
+        directories.extend(reversed(subdirectories))
+
+
+def is_image(filename):
     """
-    walk = os.walk(path)
-    if subdir:
-        return [os.path.join(r, f) for r, d, fs in walk for f in fs]
-    else:
-        return [os.path.join(path, f) for f in next(walk)[2]]
+    Check whether a file is an image, by its extension and then by the
+    bytes it starts with.
 
+    :param filename: Name of the file
+    :type filename: str
+    :return: True if the file is an image, otherwise False
+    :rtype: bool
+    """
+
+    if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+        return False
+    try:
+        with open(filename, 'rb') as f:
+            start = f.read(12)
+    except OSError:
+        return False
+    return (start.startswith(_MAGIC)
+            or (start[:4] == b'RIFF' and start[8:12] == b'WEBP'))
 
-def _parse_args():
+
+def parse(argv=None):
     """
-    Parse command line arguments.
+    Parse command line arguments. Arguments that are not recognized are
+    left in `sys.argv` for Kivy, and Kivy's logging is disabled unless
+    it was asked for, so this must be called before Kivy is imported.
 
+    :param argv: The arguments, defaults to None for `sys.argv[1:]`
+    :type argv: list
     :return: The parsed arguments
     :rtype: argparse.Namespace
     """
@@ -81,19 +159,70 @@ def _parse_args():
         '-i', '--include-subdirs',
         action='store_true',
         help='whether to include files in subdirectories')
+    parser.add_argument(
+        '--all-files',
+        action='store_true',
+        help='include every file in the directories, not just images')
+    parser.add_argument(
+        '-d', '--dedup', nargs='?', const='exact',
+        choices=['exact', 'perceptual'],
+        help='sort only one of each group of identical files, and put the '
+             'others after it in the result; with perceptual, also group '
+             'images that look the same (needs Pillow)')
+    parser.add_argument(
+        '-e', '--engine',
+        choices=['tree', 'merge-insertion', 'batch-insertion', 'active'],
+        default='tree',
+        help='how to sort: insert into a tree one file at a time, sort all '
+             'files at once with merge-insertion, which needs fewer '
+             'comparisons, insert files in batches, whose comparisons can '
+             'be answered in any order, or rank files approximately by '
+             'learning a score for each; at the default confidence, that '
+             'only needs fewer comparisons than the exact engines with '
+             'more than a few hundred files, and needs more with fewer '
+             'files, unless the confidence is lowered')
+    parser.add_argument(
+        '-c', '--confidence', type=float, default=0.9,
+        help='with the active engine, stop once pairs of files are '
+             'estimated to be ranked correctly with this probability, '
+             'defaults to 0.9')
+    parser.add_argument(
+        '-k', '--top', type=int, metavar='K',
+        help='instead of sorting every file, only find the K greatest '
+             'files, in order, which takes far fewer comparisons')
+    parser.add_argument(
+        '-u', '--undo-limit', type=int, default=1000, metavar='N',
+        help='with the tree engine, keep only the states before the last N '
+             'files inserted in memory; undoing further back takes longer, '
+             'as the older states are rebuilt; 0 to keep every state, '
+             'defaults to 1000')
+    parser.add_argument(
+        '-a', '--answers',
+        help='sort without a window, reading answers from this text file: '
+             '1 if the first file is greater, -1 if it is less, 0 if equal, '
+             'or undo, one per line')
+    parser.add_argument(
+        '--library',
+        help='keep the final ranking in this file; files ranked in it '
+             'before keep their place, so only new files are compared')
+    parser.add_argument(
+        '-m', '--metrics',
+        help='write metrics about the session, such as how long each '
+             'comparison took to answer, to this file in the Prometheus '
+             'text format when sorting stops')
+    parser.add_argument(
+        '--metrics-log',
+        help='append each timing measured to this file as a line of JSON')
     parser.add_argument(
         '-l', '--enable-logging',
         action='store_true',
         help='whether to enable Kivy logging')
 
     # remove consumed args from sys.argv
-    known_args, unknown_args = parser.parse_known_args()
+    known_args, unknown_args = parser.parse_known_args(argv)
     sys.argv = sys.argv[:1] + unknown_args
 
     if not known_args.enable_logging:
         os.environ['KIVY_NO_CONSOLELOG'] = '1'
 
     return known_args
-
-
-args = _parse_args()
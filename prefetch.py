@@ -0,0 +1,294 @@
+import collections
+import itertools
+import queue
+import threading
+
+from kivy.clock import Clock
+from kivy.core.image import ImageLoader
+from kivy.graphics.texture import Texture
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # images are decoded at full size by Kivy instead
+    PILImage = None
+
+
+class TextureCache:
+    """
+    A least recently used cache of textures, keyed by filename. When the
+    textures take up more than `max_bytes`, the least recently used
+    textures are removed.
+
+    The cache is not thread-safe.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Create the cache.
+
+        :param max_bytes: Maximum total size of the textures in bytes
+        :type max_bytes: int
+        """
+
+        self.max_bytes = max_bytes
+        self._textures = collections.OrderedDict()
+        self._bytes = 0
+
+    def __contains__(self, filename):
+        return filename in self._textures
+
+    def get(self, filename):
+        """
+        Get the texture for a file, marking it as recently used.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :return: The texture, or None if it is not in the cache
+        :rtype: kivy.graphics.texture.Texture
+        """
+
+        texture = self._textures.get(filename)
+        if texture is not None:
+            self._textures.move_to_end(filename)
+        return texture
+
+    def put(self, filename, texture):
+        """
+        Add the texture for a file, removing the least recently used
+        textures if the cache is full.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :param texture: The texture
+        :type texture: kivy.graphics.texture.Texture
+        :return: None
+        """
+
+        if filename in self._textures:
+            self._bytes -= self._size(self._textures.pop(filename))
+        self._textures[filename] = texture
+        self._bytes += self._size(texture)
+        # keep at least the texture just added
+        while self._bytes > self.max_bytes and len(self._textures) > 1:
+            _filename, old = self._textures.popitem(last=False)
+            self._bytes -= self._size(old)
+
+    @staticmethod
+    def _size(texture):
+        """
+        Get the size of a texture in bytes.
+
+        :param texture: A texture
+        :type texture: kivy.graphics.texture.Texture
+        :return: The size in bytes
+        :rtype: int
+        """
+
+        width, height = texture.size
+        return width * height * 4
+
+
+class Prefetcher:
+    """
+    Decodes images on a pool of worker threads before they are shown,
+    keeping the results in a :class:`TextureCache`.
+
+    Each time a comparison is shown, the two images being compared are
+    requested first, followed by the images predicted to be compared
+    next. Predictions from earlier comparisons that have not been
+    started yet are dropped.
+
+    If Pillow is installed, images are downscaled to fit `size` as they
+    are decoded, so large photos take little time and memory, and are
+    read from a :class:`thumbnails.ThumbnailCache` if one is given, so
+    they are only decoded at full size once. Textures
+    can only be created on the main thread, so the workers only decode,
+    and the textures are created from the decoded pixels with
+    :class:`kivy.clock.Clock`.
+    """
+
+    def __init__(self, size, on_loaded, workers=4, max_bytes=512 * 2**20,
+                 thumbnails=None, metrics=None):
+        """
+        Create the prefetcher and start its worker threads.
+
+        :param size: Width and height that images are downscaled to fit
+        :type size: tuple
+        :param on_loaded: Called on the main thread with the filename
+                          and texture of each requested image once it is
+                          loaded; the texture is None if the image could
+                          not be decoded
+        :type on_loaded: function
+        :param workers: Number of worker threads, defaults to 4
+        :type workers: int
+        :param max_bytes: Maximum total size of the cached textures in
+                          bytes, defaults to 512 MiB
+        :type max_bytes: int
+        :param thumbnails: Thumbnails to decode instead of the original
+                           images, defaults to None
+        :type thumbnails: thumbnails.ThumbnailCache
+        :param metrics: Records how long each image took to decode,
+                        defaults to None to record nothing
+        :type metrics: metrics.Metrics
+        """
+
+        self.size = tuple(size)
+        self.metrics = metrics
+        self._textures = TextureCache(max_bytes)
+        self._on_loaded = on_loaded
+        self._thumbnails = thumbnails
+
+        # (priority, newest first, order, filename); priority 0 is for
+        # the images being compared
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._generation = 0
+
+        # for each filename waiting in the queue, the order of its most
+        # recent entry; older entries are skipped
+        self._requested = {}
+        self._decoding = set()
+        # guards the cache, the requested and the decoding filenames
+        self._lock = threading.Lock()
+
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def request(self, current, predicted=()):
+        """
+        Request images to be decoded. May be called from any thread.
+
+        :param current: Filenames of the images being compared
+        :type current: list
+        :param predicted: Filenames of the images that may be compared
+                          next, most likely first, defaults to ()
+        :type predicted: list
+        :return: None
+        """
+
+        filenames = [(0, f) for f in current]
+        filenames.extend(
+            (priority, f) for priority, f in enumerate(predicted, 1))
+        with self._lock:
+            self._generation += 1
+            self._put(filenames)
+
+    def get(self, filename):
+        """
+        Get the texture for an image, requesting it if it is not in the
+        cache. The predictions of the latest request are kept.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :return: The texture, or None if it is not loaded yet
+        :rtype: kivy.graphics.texture.Texture
+        """
+
+        with self._lock:
+            texture = self._textures.get(filename)
+            if texture is None:
+                self._put([(0, filename)])
+        return texture
+
+    def _put(self, filenames):
+        """
+        Add images to the queue in the current generation, unless they
+        are cached or being decoded. Hold the lock.
+
+        :param filenames: Tuples of the priority and filename of each
+                          image
+        :type filenames: list
+        :return: None
+        """
+
+        for priority, filename in filenames:
+            if filename in self._textures or filename in self._decoding:
+                continue
+            order = next(self._order)
+            self._requested[filename] = order
+            self._queue.put((priority, -self._generation, order, filename))
+
+    def _work(self):
+        """
+        Decode requested images, forever. Run on each worker thread.
+
+        :return: None
+        """
+
+        while True:
+            priority, newest, order, filename = self._queue.get()
+            with self._lock:
+                if self._requested.get(filename) != order:
+                    continue  # requested again since
+                del self._requested[filename]
+                if priority and -newest < self._generation:
+                    # an old prediction; it will be requested again if
+                    # it is still likely to be compared
+                    continue
+                self._decoding.add(filename)
+            try:
+                if self.metrics is None:
+                    image = self._decode(filename)
+                else:
+                    image = self.metrics.timed(
+                        'image_decode_seconds', self._decode, filename)
+            except Exception:
+                image = None  # let Kivy report the error when shown
+            Clock.schedule_once(
+                lambda _dt, f=filename, i=image: self._loaded(f, i))
+
+    def _decode(self, filename):
+        """
+        Decode an image. Runs on a worker thread.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :return: The width and height, and the RGBA pixels, if Pillow is
+                 installed; otherwise, the image loaded by Kivy
+        :rtype: tuple or kivy.core.image.ImageLoaderBase
+        """
+
+        if PILImage is None:
+            # Kivy creates the texture from the loaded data later
+            return ImageLoader.load(filename, keep_data=True, nocache=True)
+
+        if self._thumbnails is not None:
+            filename = self._thumbnails.get(filename) or filename
+        with PILImage.open(filename) as image:
+            # let JPEG images be decoded at a smaller size to start with
+            image.draft('RGB', self.size)
+            image.thumbnail(self.size)
+            image = image.convert('RGBA')
+            return image.size, image.tobytes()
+
+    def _loaded(self, filename, image):
+        """
+        Create the texture for a decoded image and add it to the cache.
+        Runs on the main thread.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :param image: The result of :meth:`_decode`, or None if decoding
+                      failed
+        :type image: tuple or kivy.core.image.ImageLoaderBase
+        :return: None
+        """
+
+        if image is None:
+            with self._lock:
+                self._decoding.discard(filename)
+            self._on_loaded(filename, None)
+            return
+
+        if PILImage is None:
+            texture = image.texture
+        else:
+            size, pixels = image
+            texture = Texture.create(size=size, colorfmt='rgba')
+            texture.blit_buffer(pixels, colorfmt='rgba', bufferfmt='ubyte')
+            # Pillow's first row is the top; a texture's is the bottom
+            texture.flip_vertical()
+        with self._lock:
+            self._decoding.discard(filename)
+            self._textures.put(filename, texture)
+        self._on_loaded(filename, texture)
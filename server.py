@@ -0,0 +1,592 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import urllib.parse
+
+from engines import ENGINES
+from parse_args import is_image
+from session import SortSession
+
+
+class HTTPError(Exception):
+    """Raise this exception to send an error response."""
+
+    def __init__(self, status, message):
+        """
+        Create the exception.
+
+        :param status: The HTTP status code
+        :type status: int
+        :param message: Description of the error
+        :type message: str
+        """
+
+        super().__init__(message)
+        self.status = status
+
+
+class SortServer:
+    """
+    Serves many sorting sessions over HTTP, so that many people can
+    sort at the same time, each in their own browser or client.
+
+    Every session is a :class:`session.SortSession` with its own save
+    file, named after the session, in `state_dir`. All sessions run on
+    one event loop. Connections are kept alive between requests.
+
+    Only images in `image_dir`, or in its subdirectories, can be sorted
+    and served. Files are named relative to it; a file whose real path,
+    after following symbolic links, is outside it is rejected.
+
+    Requests and responses are JSON:
+
+    ``POST /sessions/NAME`` with ``{"files": [...], "engine": "tree"}``
+        Start the session, or resume it from its save file. Every file
+        must be an image in the image directory.
+    ``GET /sessions/NAME``
+        Get the state of the session.
+    ``GET /sessions/NAME/comparisons``
+        Get every comparison that can be answered now, as
+        ``{"comparisons": [[a, b], ...]}``, the pending comparison
+        first. With the batch-insertion engine there can be several,
+        answered by different people at once.
+    ``POST /sessions/NAME/answer`` with ``{"answer": 1, "pair": [...]}``
+        Answer a comparison: 1 if the first file is greater, -1 if it is
+        less, or 0 if they are equal. The pair is optional and defaults
+        to the pending comparison; if it is not one of the comparisons
+        that can be answered now, the answer is rejected, e.g. when two
+        clients answer the same comparison at once.
+    ``POST /sessions/NAME/undo``
+        Undo the previous comparison.
+    ``POST /sessions/NAME/close``
+        Save the session to its file and stop serving it.
+    ``GET /sessions/NAME/image?file=FILE``
+        Get the contents of one of the session's files.
+
+    The state of a session is ``{"pair": [a, b]}`` while a comparison is
+    pending, or ``{"result": [...]}`` once it is sorted. Errors are
+    ``{"error": "..."}``. If a session fails, e.g. because its save file
+    can't be written, the error has status 500 and the session is no
+    longer served; starting it again resumes it from its save file.
+    """
+
+    MAX_BODY = 8 * 2**20  # largest request body accepted, in bytes
+
+    _NAME = re.compile(r'[A-Za-z0-9_-]+$')
+    _REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                405: 'Method Not Allowed', 409: 'Conflict',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+    class _Session:
+        """A session being served, with the state needed to drive it."""
+        def __init__(self, name, session):
+            """
+            Create the entry for a session.
+
+            :param name: Name of the session
+            :type name: str
+            :param session: The session
+            :type session: session.SortSession
+            """
+
+            self.name = name
+            self.session = session
+            self.pending = session.pending()
+            self.pair = None  # the comparison waiting for an answer
+            self.files = set(session.values)
+            # only one request moves the session on at a time
+            self.lock = asyncio.Lock()
+
+    def __init__(self, state_dir, image_dir):
+        """
+        Create the server.
+
+        :param state_dir: Directory for the sessions' save files,
+                          created if it does not exist
+        :type state_dir: str
+        :param image_dir: Directory holding the images that can be
+                          sorted
+        :type image_dir: str
+        """
+
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        self.image_dir = os.path.realpath(image_dir)
+        if not os.path.isdir(self.image_dir):
+            raise ValueError('{} is not a directory'.format(image_dir))
+        self._sessions = {}
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        """
+        Serve requests until cancelled, then save every session.
+
+        :param host: Address to listen on, defaults to '127.0.0.1'
+        :type host: str
+        :param port: Port to listen on, defaults to 8000
+        :type port: int
+        :return: None
+        """
+
+        server = await asyncio.start_server(self._handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """
+        Save every session to its file and stop serving them. The files
+        are written off the event loop.
+
+        :return: None
+        """
+
+        entries = list(self._sessions.values())
+        self._sessions.clear()
+        # a session that can't be saved doesn't stop the others
+        await asyncio.gather(
+            *(self._close(entry) for entry in entries),
+            return_exceptions=True)
+
+    @staticmethod
+    async def _close(entry):
+        """
+        Save a session to its file, off the event loop.
+
+        :param entry: The session
+        :type entry: SortServer._Session
+        :return: None
+        """
+
+        async with entry.lock:
+            await asyncio.get_running_loop().run_in_executor(
+                None, entry.session.close)
+
+    async def _handle(self, reader, writer):
+        """
+        Handle the requests on one connection until it is closed.
+
+        :param reader: Reads from the connection
+        :type reader: asyncio.StreamReader
+        :param writer: Writes to the connection
+        :type writer: asyncio.StreamWriter
+        :return: None
+        """
+
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as e:
+                    # the body was not read, so the connection can't be
+                    # used for another request
+                    await self._send(
+                        writer, self._json({'error': str(e)}, e.status),
+                        False)
+                    break
+                if request is None:
+                    break  # the client closed the connection
+                method, target, headers, body = request
+                try:
+                    response = await self._route(method, target, body)
+                except HTTPError as e:
+                    response = self._json({'error': str(e)}, e.status)
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._send(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # the connection broke, or the request was malformed
+        finally:
+            writer.close()
+
+    async def _send(self, writer, response, keep_alive):
+        """
+        Send a response.
+
+        :param writer: Writes to the connection
+        :type writer: asyncio.StreamWriter
+        :param response: The status code, content type and content
+        :type response: tuple
+        :param keep_alive: Whether the connection is kept open for
+                           another request
+        :type keep_alive: bool
+        :return: None
+        """
+
+        status, content_type, content = response
+        writer.write(
+            'HTTP/1.1 {} {}\r\nContent-Type: {}\r\n'
+            'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                status, self._REASONS[status], content_type, len(content),
+                'keep-alive' if keep_alive else 'close'
+            ).encode('latin-1') + content)
+        await writer.drain()
+
+    async def _read_request(self, reader):
+        """
+        Read one request from a connection.
+
+        :param reader: Reads from the connection
+        :type reader: asyncio.StreamReader
+        :return: The method, target, headers (with lowercase names) and
+                 body, or None if the connection was closed
+        :rtype: tuple
+        :raises HTTPError: If the body is too large, before it is read
+        """
+
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _version = line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HTTPError(400, 'invalid Content-Length')
+        if length > self.MAX_BODY:
+            raise HTTPError(413, 'the request body is too large')
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    async def _route(self, method, target, body):
+        """
+        Respond to a request.
+
+        :param method: The HTTP method
+        :type method: str
+        :param target: The path and query string
+        :type target: str
+        :param body: The body of the request
+        :type body: bytes
+        :return: The status code, content type and content
+        :rtype: tuple
+        """
+
+        url = urllib.parse.urlsplit(target)
+        parts = url.path.strip('/').split('/')
+        if len(parts) not in (2, 3) or parts[0] != 'sessions':
+            raise HTTPError(404, 'not found')
+        name, action = parts[1], parts[2] if len(parts) == 3 else None
+        if not self._NAME.match(name):
+            raise HTTPError(404, 'invalid session name')
+
+        if action is None and method == 'POST':
+            return self._json(await self._start(name, self._load(body)))
+        if action == 'image' and method == 'GET':
+            return await self._image(name, url.query)
+
+        entry = self._get(name)
+        if action is None and method == 'GET':
+            async with entry.lock:
+                return self._json(await self._state(entry))
+        if action == 'comparisons' and method == 'GET':
+            async with entry.lock:
+                state = await self._state(entry)
+                if 'pair' in state:
+                    state = {'comparisons': [
+                        list(pair) for pair in entry.session.comparisons()]}
+                return self._json(state)
+        if action == 'answer' and method == 'POST':
+            data = self._load(body)
+            answer = data.get('answer')
+            if answer not in (1, -1, 0) or isinstance(answer, bool):
+                raise HTTPError(400, 'answer must be 1, -1 or 0')
+            pair = data.get('pair')
+            if pair is not None and (
+                    not isinstance(pair, list) or len(pair) != 2
+                    or not all(isinstance(f, str) for f in pair)):
+                raise HTTPError(400, 'pair must be a list of two files')
+            async with entry.lock:
+                await self._state(entry)
+                if pair is not None:
+                    if entry.session.done:
+                        raise HTTPError(409, 'the session is finished')
+                    if tuple(pair) not in entry.session.comparisons():
+                        raise HTTPError(
+                            409, 'not a comparison waiting for an answer')
+                self._respond(entry, entry.session.answer, answer, pair)
+                return self._json(await self._state(entry))
+        if action == 'undo' and method == 'POST':
+            async with entry.lock:
+                await self._state(entry)
+                self._respond(entry, entry.session.undo)
+                return self._json(await self._state(entry))
+        if action == 'close' and method == 'POST':
+            if self._sessions.get(name) is entry:
+                del self._sessions[name]
+            try:
+                await self._close(entry)
+            except Exception as e:
+                raise HTTPError(
+                    500, 'the session could not be saved: {}'.format(e))
+            return self._json({})
+        if action in (None, 'comparisons', 'answer', 'undo', 'close'):
+            raise HTTPError(405, 'method not allowed')
+        raise HTTPError(404, 'not found')
+
+    async def _start(self, name, data):
+        """
+        Start a session, or resume it from its save file.
+
+        :param name: Name of the session
+        :type name: str
+        :param data: The files to sort and the engine to use
+        :type data: dict
+        :return: The state of the session
+        :rtype: dict
+        """
+
+        if name not in self._sessions:
+            files = data.get('files')
+            if not isinstance(files, list) or not all(
+                    isinstance(f, str) for f in files):
+                raise HTTPError(400, 'files must be a list of strings')
+            engine = ENGINES.get(data.get('engine', 'tree'))
+            if engine is None:
+                raise HTTPError(400, 'unknown engine')
+            # checking the files reads them, so it is done off the loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._check_files, files)
+            # another request may have started the session meanwhile
+            if name not in self._sessions:
+                filename = os.path.join(self.state_dir, name + '.tree')
+                try:
+                    session = SortSession(files, filename, engine)
+                except Exception as e:
+                    raise HTTPError(
+                        500, 'the session could not be loaded: {}'.format(e))
+                self._sessions[name] = self._Session(name, session)
+        entry = self._sessions[name]
+        async with entry.lock:
+            return await self._state(entry)
+
+    def _check_files(self, files):
+        """
+        Check that every file is an image in the image directory.
+
+        :param files: Names of the files, relative to the image
+                      directory
+        :type files: list
+        :return: None
+        """
+
+        for filename in files:
+            path = self._resolve(filename)
+            if not os.path.isfile(path) or not is_image(path):
+                raise HTTPError(
+                    400, '{!r} is not an image'.format(filename))
+
+    def _resolve(self, filename):
+        """
+        Get the real path of a file in the image directory.
+
+        :param filename: Name of the file, relative to the image
+                         directory
+        :type filename: str
+        :return: The real path, following symbolic links
+        :rtype: str
+        """
+
+        try:
+            path = os.path.realpath(os.path.join(self.image_dir, filename))
+            inside = os.path.commonpath([self.image_dir, path])
+        except ValueError:
+            inside = None  # e.g. a null byte, or on another drive
+        if inside != self.image_dir:
+            raise HTTPError(
+                400, '{!r} is not in the image directory'.format(filename))
+        return path
+
+    def _get(self, name):
+        """
+        Get a session being served.
+
+        :param name: Name of the session
+        :type name: str
+        :return: The session
+        :rtype: SortServer._Session
+        """
+
+        try:
+            return self._sessions[name]
+        except KeyError:
+            raise HTTPError(404, 'no session named {!r}'.format(name))
+
+    async def _state(self, entry):
+        """
+        Get the state of a session, moving it on to the next comparison
+        if the last one was answered. Hold the session's lock.
+
+        :param entry: The session
+        :type entry: SortServer._Session
+        :return: The state of the session
+        :rtype: dict
+        """
+
+        if entry.pair is None and not entry.session.done:
+            try:
+                entry.pair = await entry.pending.__anext__()
+            except StopAsyncIteration:
+                pass
+            except Exception as e:
+                raise self._failed(entry, e)
+        if entry.session.done:
+            return {'result': entry.session.result}
+        return {'pair': list(entry.pair)}
+
+    def _respond(self, entry, respond, *args):
+        """
+        Answer or undo the pending comparison of a session.
+
+        :param entry: The session
+        :type entry: SortServer._Session
+        :param respond: :meth:`SortSession.answer` or
+                        :meth:`SortSession.undo`
+        :type respond: function
+        :return: None
+        """
+
+        if entry.session.done:
+            raise HTTPError(409, 'the session is finished')
+        try:
+            respond(*args)
+        except Exception as e:
+            raise self._failed(entry, e)
+        entry.pair = None
+
+    def _failed(self, entry, error):
+        """
+        Stop serving a session whose engine raised an exception, as its
+        state is not known any more.
+
+        :param entry: The session
+        :type entry: SortServer._Session
+        :param error: The exception
+        :type error: Exception
+        :return: The error to send
+        :rtype: HTTPError
+        """
+
+        if self._sessions.get(entry.name) is entry:
+            del self._sessions[entry.name]
+        return HTTPError(500, 'the session failed: {}'.format(error))
+
+    async def _image(self, name, query):
+        """
+        Get the contents of one of a session's files.
+
+        :param name: Name of the session
+        :type name: str
+        :param query: The query string, holding the filename
+        :type query: str
+        :return: The status code, content type and content
+        :rtype: tuple
+        """
+
+        entry = self._get(name)
+        filename = urllib.parse.parse_qs(query).get('file', [''])[0]
+        if filename not in entry.files:
+            raise HTTPError(404, 'not one of the session\'s files')
+        # a link may have been changed since the session was started
+        try:
+            path = self._resolve(filename)
+        except HTTPError:
+            raise HTTPError(404, 'not in the image directory')
+
+        def read():
+            with open(path, 'rb') as f:
+                return f.read()
+        try:
+            content = await asyncio.get_running_loop().run_in_executor(
+                None, read)
+        except OSError:
+            raise HTTPError(404, 'can\'t read {}'.format(filename))
+        return 200, 'application/octet-stream', content
+
+    @staticmethod
+    def _load(body):
+        """
+        Decode the JSON body of a request.
+
+        :param body: The body of the request
+        :type body: bytes
+        :return: The decoded object
+        :rtype: dict
+        """
+
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            raise HTTPError(400, 'invalid JSON')
+        if not isinstance(data, dict):
+            raise HTTPError(400, 'expected a JSON object')
+        return data
+
+    @staticmethod
+    def _json(data, status=200):
+        """
+        Encode a JSON response.
+
+        :param data: The object to send
+        :type data: dict
+        :param status: The HTTP status code, defaults to 200
+        :type status: int
+        :return: The status code, content type and content
+        :rtype: tuple
+        """
+
+        return status, 'application/json', json.dumps(data).encode('utf-8')
+
+
+def main():
+    """
+    Run the server from the command line, saving every session when it
+    is stopped.
+
+    :return: None
+    """
+
+    parser = argparse.ArgumentParser(
+        description='serve sorting sessions over HTTP')
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='address to listen on, defaults to 127.0.0.1')
+    parser.add_argument(
+        '-p', '--port', type=int, default=8000,
+        help='port to listen on, defaults to 8000')
+    parser.add_argument(
+        '-s', '--state-dir', default='sessions',
+        help='directory for the save file of each session, defaults to '
+             'sessions')
+    parser.add_argument(
+        '-i', '--image-dir', required=True,
+        help='directory holding the images that can be sorted; files '
+             'are named relative to it')
+    args = parser.parse_args()
+
+    try:
+        server = SortServer(args.state_dir, args.image_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        # the sessions are saved as serving stops
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+# the start of a PNG file, enough for the server to accept it as an image
+_PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class Client:
+    """
+    A client for :class:`server.SortServer` that sends every request on
+    one kept-alive connection.
+    """
+
+    def __init__(self, host, port):
+        """
+        Create the client. Call :meth:`connect` before sending requests.
+
+        :param host: Address of the server
+        :type host: str
+        :param port: Port of the server
+        :type port: int
+        """
+
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        """
+        Open the connection.
+
+        :return: None
+        """
+
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port)
+
+    async def close(self):
+        """
+        Close the connection.
+
+        :return: None
+        """
+
+        self._writer.close()
+        await self._writer.wait_closed()
+
+    async def request(self, method, path, data=None):
+        """
+        Send a request and wait for the response.
+
+        :param method: The HTTP method
+        :type method: str
+        :param path: The path
+        :type path: str
+        :param data: Object to send as JSON, defaults to None
+        :type data: dict
+        :return: The status code and the decoded response
+        :rtype: tuple
+        """
+
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self._writer.write(
+            '{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                method, path, self.host, len(body)).encode('latin-1') + body)
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = (await self._reader.readline()).strip()
+            if not line:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return status, json.loads(await self._reader.readexactly(length))
+
+
+async def rate(host, port, name, n_items, engine, raters=1, think=0.0):
+    """
+    Sort files named after random numbers, made by :func:`make_files`,
+    in a session of the server, answering each comparison correctly,
+    like users who never make a mistake.
+
+    :param host: Address of the server
+    :type host: str
+    :param port: Port of the server
+    :type port: int
+    :param name: Name of the session
+    :type name: str
+    :param n_items: Number of values to sort
+    :type n_items: int
+    :param engine: Name of the sort engine
+    :type engine: str
+    :param raters: Number of users answering at once, each on their own
+                   connection, defaults to 1
+    :type raters: int
+    :param think: Seconds each user takes to answer, defaults to 0.0
+    :type think: float
+    :return: Number of comparisons answered
+    :rtype: int
+    """
+
+    values = ['{}.png'.format(x)
+              for x in random.sample(range(10 * n_items), n_items)]
+    path = '/sessions/' + name
+    client = Client(host, port)
+    await client.connect()
+    try:
+        _status, state = await client.request(
+            'POST', path, {'files': values, 'engine': engine})
+        if 'error' in state:
+            raise RuntimeError(state['error'])
+        answered = await asyncio.gather(*(
+            _rater(host, port, path, i, think) for i in range(raters)))
+        _status, state = await client.request('GET', path)
+        if state['result'] != sorted(values, key=_number):
+            raise AssertionError('session {} sorted wrongly'.format(name))
+        await client.request('POST', path + '/close')
+        return sum(answered)
+    finally:
+        await client.close()
+
+
+async def _rater(host, port, path, i, think):
+    """
+    Answer comparisons of a session until it is sorted, as one of
+    several users: the user takes the `i`-th comparison that can be
+    answered, or the first if there are fewer.
+
+    :param host: Address of the server
+    :type host: str
+    :param port: Port of the server
+    :type port: int
+    :param path: Path of the session
+    :type path: str
+    :param i: Number of the user
+    :type i: int
+    :param think: Seconds the user takes to answer
+    :type think: float
+    :return: Number of comparisons answered
+    :rtype: int
+    """
+
+    client = Client(host, port)
+    await client.connect()
+    try:
+        answered = 0
+        while True:
+            _status, state = await client.request(
+                'GET', path + '/comparisons')
+            if 'error' in state:
+                raise RuntimeError(state['error'])
+            if 'result' in state:
+                return answered
+            comparisons = state['comparisons']
+            pair = comparisons[i % len(comparisons)]
+            if think:
+                await asyncio.sleep(think)
+            a, b = (_number(value) for value in pair)
+            status, state = await client.request(
+                'POST', path + '/answer',
+                {'answer': (a > b) - (a < b), 'pair': pair})
+            if status == 200:
+                answered += 1
+            elif status != 409:  # 409: answered by another user first
+                raise RuntimeError(state['error'])
+    finally:
+        await client.close()
+
+
+def make_files(directory, n_items):
+    """
+    Make a file for each number that :func:`rate` may sort, in the
+    server's image directory.
+
+    :param directory: The image directory
+    :type directory: str
+    :param n_items: Number of values each session sorts
+    :type n_items: int
+    :return: None
+    """
+
+    for x in range(10 * n_items):
+        filename = os.path.join(directory, '{}.png'.format(x))
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as f:
+                f.write(_PNG)
+
+
+def _number(filename):
+    """
+    Get the number that a file made by :func:`make_files` is named after.
+
+    :param filename: Name of the file
+    :type filename: str
+    :return: The number
+    :rtype: int
+    """
+
+    return int(os.path.splitext(filename)[0])
+
+
+async def main():
+    """
+    Run many scripted sessions against a server at once, printing how
+    long they took.
+
+    :return: None
+    """
+
+    parser = argparse.ArgumentParser(
+        description='run scripted sorting sessions against a server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument(
+        '-n', '--sessions', type=int, default=100,
+        help='number of sessions to run at once, defaults to 100')
+    parser.add_argument(
+        '-i', '--items', type=int, default=200,
+        help='number of values each session sorts, defaults to 200')
+    parser.add_argument(
+        '-e', '--engine', default='tree',
+        choices=['tree', 'merge-insertion', 'batch-insertion'])
+    parser.add_argument(
+        '-r', '--raters', type=int, default=1,
+        help='number of users answering each session at once, defaults '
+             'to 1; with batch-insertion, they answer different '
+             'comparisons')
+    parser.add_argument(
+        '-t', '--think', type=float, default=0.0,
+        help='seconds each user takes to answer, defaults to 0')
+    parser.add_argument(
+        '-d', '--image-dir', required=True,
+        help='the image directory of the server, where the files sorted '
+             'are made')
+    args = parser.parse_args()
+
+    make_files(args.image_dir, args.items)
+
+    start = time.perf_counter()
+    answered = await asyncio.gather(*(
+        rate(args.host, args.port, 'scripted-{}'.format(i), args.items,
+             args.engine, args.raters, args.think)
+        for i in range(args.sessions)))
+    seconds = time.perf_counter() - start
+    print('{} sessions, {} comparisons in {:.2f} seconds ({:.0f} per '
+          'second)'.format(len(answered), sum(answered), seconds,
+                           sum(answered) / seconds))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
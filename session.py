@@ -0,0 +1,214 @@
+import asyncio
+
+from engines import BatchInsertionEngine, SortEngine, TreeEngine
+
+
+class SortSession:
+    """
+    Sorts values with asyncio, taking the answer to each comparison from
+    :meth:`answer` instead of blocking a thread, so one event loop can
+    run many sessions at once::
+
+        session = SortSession(values, 'session.tree')
+        async for value, other in session.pending():
+            session.answer(await ask_user(value, other))
+        print(session.result)
+
+    The engine stops with :class:`SortEngine.Pause` whenever it needs an
+    answer that has not been given, keeping its place, and goes on from
+    there once the answer arrives. Between comparisons, sorting runs on
+    the event loop, which only takes as long as deciding on the next
+    comparison.
+
+    With :class:`engines.BatchInsertionEngine`, several people can
+    answer at once: :meth:`comparisons` lists every comparison that can
+    be answered now, and :meth:`answer` takes the answer to any of them.
+
+    Progress is saved to `filename` as it goes, like :func:`image_sort`,
+    so a session can be resumed after :meth:`close` or a crash.
+    """
+
+    _UNDO = object()  # response to undo the previous comparison
+
+    def __init__(self, values, filename, engine=TreeEngine,
+                 value_type=None):
+        """
+        Create the session, loading its progress from `filename` if the
+        file exists.
+
+        :param values: The values to sort
+        :type values: list
+        :param filename: Name of the file to store the progress
+        :type filename: str
+        :param engine: The :class:`engines.SortEngine` subclass used to
+                       sort, defaults to :class:`engines.TreeEngine`
+        :type engine: type
+        :param value_type: Type of the values sorted, defaults to None
+        :type value_type: type
+        """
+
+        self.values = values
+        self.filename = filename
+        self.pair = None  # the comparison waiting for an answer
+        self.result = None  # the sorted list, once sorting is finished
+        self._response = None
+        self._answered = asyncio.Event()
+        # may already ask for the comparison that was being made when
+        # the progress was saved
+        self.engine = engine(
+            filename, value_type=value_type, oracle=self._oracle)
+
+    @property
+    def done(self):
+        """
+        Whether sorting is finished.
+
+        :return: True if sorting is finished, otherwise False
+        :rtype: bool
+        """
+
+        return self.result is not None
+
+    async def pending(self):
+        """
+        Yield each comparison that needs an answer, as a tuple of two
+        values, waiting for :meth:`answer` or :meth:`undo` to be called
+        before yielding the next. Stops when sorting is finished.
+
+        :return: An asynchronous iterator of comparisons
+        :rtype: collections.abc.AsyncIterator
+        """
+
+        if self.pair is None:
+            self._step()
+        while not self.done:
+            self._answered.clear()
+            yield self.pair
+            await self._answered.wait()
+
+    def comparisons(self):
+        """
+        Get every comparison that can be answered now: the pending
+        comparison, and with :class:`engines.BatchInsertionEngine`,
+        every other comparison it is waiting for.
+
+        :return: Tuples of two values, the pending comparison first, or
+                 an empty list if sorting is finished
+        :rtype: list
+        """
+
+        if self.pair is None:
+            return []
+        if not isinstance(self.engine, BatchInsertionEngine):
+            return [self.pair]
+        # the pending comparison may be the other way round, if it was
+        # undone
+        return [self.pair] + [
+            pair for pair in self.engine.pending()
+            if pair != self.pair and pair[::-1] != self.pair]
+
+    def answer(self, response, pair=None):
+        """
+        Answer the pending comparison, or another of the comparisons
+        from :meth:`comparisons`.
+
+        :param response: 1 if the first value is greater, -1 if it is
+                         less, or 0 if they are equal
+        :type response: int
+        :param pair: The comparison answered, defaults to None for the
+                     pending comparison
+        :type pair: tuple
+        :return: None
+        """
+
+        if response not in (1, -1, 0):
+            raise ValueError('invalid answer: {!r}'.format(response))
+        if pair is None or tuple(pair) == self.pair:
+            self._respond(response)
+            return
+        pair = tuple(pair)
+        if pair not in self.comparisons():
+            raise ValueError('not a comparison waiting for an answer')
+        # the engine is paused between comparisons, so it can be given
+        # the answer directly
+        self.engine.answer(*pair, response < 0)
+        self.pair = None
+        self._step()
+        self._answered.set()
+
+    def undo(self):
+        """
+        Undo the comparison answered before the pending one.
+
+        :return: None
+        """
+
+        self._respond(self._UNDO)
+
+    def close(self):
+        """
+        Save the progress to file, to be resumed by a new session.
+
+        :return: None
+        """
+
+        if self.done:
+            return
+        self.pair = None
+        try:
+            self.engine.exit()
+        except SortEngine.Exit:
+            pass
+
+    def _respond(self, response):
+        """
+        Give the response to the pending comparison to the engine, sort
+        until the next comparison, and wake up :meth:`pending`.
+
+        :param response: The response
+        :type response: object
+        :return: None
+        """
+
+        if self.pair is None:
+            raise RuntimeError('no comparison is waiting for an answer')
+        self._response = response
+        self.pair = None
+        self._step()
+        self._answered.set()
+
+    def _step(self):
+        """
+        Sort until a comparison needs an answer or sorting is finished.
+
+        :return: None
+        """
+
+        try:
+            result = self.engine.sort(self.values)
+        except SortEngine.Pause:
+            return
+        self.engine.delete_file()
+        self.result = result
+
+    def _oracle(self, value, other):
+        """
+        Answer a comparison with the response from :meth:`answer`, or
+        pause the engine until there is one.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: 1 if `value` is greater than `other`, -1 if it is less,
+                 or 0 if they are equal
+        :rtype: int
+        """
+
+        response, self._response = self._response, None
+        if response is None:
+            self.pair = (value, other)
+            raise SortEngine.Pause
+        if response is self._UNDO:
+            raise SortEngine.UndoClicked
+        return response
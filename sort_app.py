@@ -0,0 +1,264 @@
+import time
+
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.core.window import Window
+from kivy.lang import Builder
+from kivy.properties import StringProperty
+from kivy.uix.boxlayout import BoxLayout
+
+from image_sort import CompareImage
+from prefetch import Prefetcher
+
+Builder.load_string("""
+<SelectionLayout>:
+    button_left: button_left
+    button_right: button_right
+    orientation: 'horizontal'
+    ImageButton:
+        id: button_left
+        on_release: root.select_left()
+    ImageButton:
+        id: button_right
+        on_release: root.select_right()
+
+<ImageButton@ButtonBehavior+Image>:
+""")
+
+
+class SelectionLayout(BoxLayout):
+    """
+    Kivy layout which presents two images so the user can choose one.
+    """
+
+    left_image = StringProperty('')  # left image source
+    right_image = StringProperty('')  # right image source
+
+    def __init__(self, thumbnails=None, metrics=None, **kwargs):
+        super().__init__(**kwargs)
+        self._keyboard = None
+        self.get_keyboard()  # for keyboard shortcuts
+        self.metrics = metrics
+        # for metrics: when each image shown before it was loaded was
+        # shown, to record how long it took to appear
+        self._waiting = {}
+        # decode images in the background, downscaled to the window
+        self.prefetcher = Prefetcher(
+            Window.size, self._on_image_loaded, thumbnails=thumbnails,
+            metrics=metrics)
+        # resume thread waiting for layout to be created
+        CompareImage.event.set()
+
+    def on_left_image(self, _instance, _value):
+        """
+        Update the left image in the layout when the attribute
+        `left_image` is changed.
+
+        :param _instance: The SelectionLayout instance
+        :type _instance: SelectionLayout
+        :param _value: The new value of `left_image`
+        :type _value: str
+        :return: None
+        """
+
+        # Use Clock to schedule setting the left button's image to
+        # self.left_image. this ensures that the UI is updated from the
+        # main thread.
+        def update(_dt):
+            self._show(self.button_left, self.left_image)
+        Clock.schedule_once(update)
+
+    def on_right_image(self, _instance, _value):
+        """
+        Update the right image in the layout when the attribute
+        `right_image` is changed.
+
+        :param _instance: The SelectionLayout instance
+        :type _instance: SelectionLayout
+        :param _value: The new value of `right_image`
+        :type _value: str
+        :return: None
+        """
+
+        # Use Clock to schedule setting the right button's image to
+        # self.right_image. This ensures that the UI is updated from the
+        # main thread.
+        def update(_dt):
+            self._show(self.button_right, self.right_image)
+        Clock.schedule_once(update)
+
+    def _show(self, button, filename):
+        """
+        Show an image on a button, using the texture from the prefetcher.
+        If the image is still being decoded, the button is left blank
+        until :meth:`_on_image_loaded` shows it.
+
+        :param button: The left or right button
+        :type button: ImageButton
+        :param filename: Name of the image file
+        :type filename: str
+        :return: None
+        """
+
+        button.source = ''
+        button.texture = self.prefetcher.get(filename)
+        if self.metrics is not None:
+            if button.texture is None:
+                self.metrics.count('images_not_prefetched')
+                self._waiting.setdefault(filename, time.perf_counter())
+            else:
+                self.metrics.count('images_prefetched')
+
+    def _on_image_loaded(self, filename, texture):
+        """
+        Show an image once the prefetcher has loaded it, if it is still
+        being compared.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :param texture: The texture, or None if the prefetcher could not
+                        decode the image
+        :type texture: kivy.graphics.texture.Texture
+        :return: None
+        """
+
+        shown = self._waiting.pop(filename, None)
+        if shown is not None:
+            self.metrics.observe(
+                'image_wait_seconds', time.perf_counter() - shown)
+
+        for button, image in [(self.button_left, self.left_image),
+                              (self.button_right, self.right_image)]:
+            if image == filename:
+                if texture is None:
+                    button.source = filename  # let Kivy load the image
+                else:
+                    button.texture = texture
+
+    @staticmethod
+    def select_left():
+        """
+        Set `CompareImage.response` to 1 to indicate that the left image
+        is "greater than" the right image.
+
+        :return: None
+        """
+
+        CompareImage.response = 1
+        CompareImage.event.set()  # resume the waiting thread
+
+    @staticmethod
+    def select_right():
+        """
+        Set `CompareImage.response` to -1 to indicate that the left
+        image is "less than" the right image.
+
+        :return: None
+        """
+
+        CompareImage.response = -1
+        CompareImage.event.set()  # resume the waiting thread
+
+    @staticmethod
+    def undo():
+        """
+        Undo the last comparison.
+
+        :return: None
+        """
+
+        CompareImage.response = CompareImage.UNDO
+        CompareImage.event.set()  # resume the waiting thread
+
+    def get_keyboard(self):
+        """
+        Get keyboard focus.
+
+        :return: None
+        """
+
+        # get the keyboard instance
+        self._keyboard = Window.request_keyboard(
+            self._keyboard_closed, self)
+        # bind to run _on_keyboard_down when a key is pressed
+        self._keyboard.bind(on_key_down=self._on_keyboard_down)
+
+    def _on_keyboard_down(self, _keyboard, keycode, _text, modifiers):
+        """
+        Receive keypresses. Pressing '1' on will select the left image,
+        pressing '2' will select the right image, and pressing 'Ctrl+Z'
+        will undo.
+
+        :param _keyboard: A Keyboard instance
+        :type _keyboard: kivy.core.window.Keyboard
+        :param keycode: An integer and a string representing the keycode
+        :type keycode: tuple
+        :param _text: The text of the pressed key
+        :type _text: str
+        :param modifiers: A list of modifier keys pressed
+        :type modifiers: list
+        :return: True to consume the key, otherwise False
+        :rtype: bool
+        """
+
+        if keycode[1] in ['1', 'numpad1']:
+            self.select_left()
+            return True
+        elif keycode[1] in ['2', 'numpad2']:
+            self.select_right()
+            return True
+        elif keycode[1] == 'z' and 'ctrl' in modifiers:
+            self.undo()
+            return True
+        return False
+
+    def _keyboard_closed(self):
+        """
+        Remove keyboard binding when the keyboard is closed.
+
+        :return: None
+        """
+
+        # unbind _on_keyboard_down
+        self._keyboard.unbind(on_key_down=self._on_keyboard_down)
+        self._keyboard = None
+
+
+class SortApp(App):
+    """A Kivy App with a SelectionLayout as its root layout."""
+    def __init__(self, thumbnails=None, metrics=None, **kwargs):
+        """
+        Create the app.
+
+        :param thumbnails: Thumbnails to show instead of the original
+                           images, defaults to None
+        :type thumbnails: thumbnails.ThumbnailCache
+        :param metrics: Records how long images take to appear, defaults
+                        to None
+        :type metrics: metrics.Metrics
+        """
+
+        super().__init__(**kwargs)
+        self.thumbnails = thumbnails
+        self.metrics = metrics
+
+    def build(self):
+        """
+        Build the root layout of the app.
+
+        :return: The root layout
+        :rtype: SelectionLayout
+        """
+
+        return SelectionLayout(
+            thumbnails=self.thumbnails, metrics=self.metrics)
+
+    def on_stop(self):
+        """
+        When the app is closed, save the tree to file.
+
+        :return:
+        """
+
+        CompareImage.response = CompareImage.EXIT
+        CompareImage.event.set()
@@ -0,0 +1,205 @@
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import threading
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # no thumbnails are made
+    PILImage = None
+
+
+class ThumbnailCache:
+    """
+    A directory of downscaled copies of images, so that an image only
+    has to be decoded at full size the first time it is shown.
+
+    Each thumbnail is named after a hash of the image's path,
+    modification time and size, and the size of the thumbnail, so a
+    thumbnail is made again if the image changes. When the thumbnails
+    take up more than `max_bytes`, the least recently used are deleted.
+
+    Thumbnails are made with Pillow; if it is not installed, the cache
+    is always empty.
+    """
+
+    def __init__(self, directory, size, max_bytes=512 * 2**20):
+        """
+        Create the cache.
+
+        :param directory: Directory to keep the thumbnails in, created
+                          if it does not exist
+        :type directory: str
+        :param size: Width and height that thumbnails are downscaled to
+                     fit
+        :type size: tuple
+        :param max_bytes: Maximum total size of the thumbnails in bytes,
+                          defaults to 512 MiB
+        :type max_bytes: int
+        """
+
+        self.directory = directory
+        self.size = tuple(int(x) for x in size)
+        self.max_bytes = max_bytes
+        # only one eviction at a time
+        self._evict_lock = threading.Lock()
+
+    @classmethod
+    def for_state_file(cls, filename, size):
+        """
+        Create the cache in the directory `.thumbnails` next to a save
+        file.
+
+        :param filename: Name of the file that saves the sort's progress
+        :type filename: str
+        :param size: Width and height that thumbnails are downscaled to
+                     fit
+        :type size: tuple
+        :return: The cache
+        :rtype: ThumbnailCache
+        """
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        return cls(os.path.join(directory, '.thumbnails'), size)
+
+    def get(self, filename):
+        """
+        Get the thumbnail of an image, making it if it does not exist.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :return: Name of the thumbnail file, or None if there is none
+        :rtype: str
+        """
+
+        thumbnail = self._path(filename)
+        if thumbnail is None:
+            return None
+        try:
+            os.utime(thumbnail)  # mark as recently used
+            return thumbnail
+        except FileNotFoundError:
+            pass
+        try:
+            return _make_thumbnail(filename, thumbnail, self.size)
+        except Exception:
+            return None  # the original will be shown
+
+    def make_all(self, filenames, processes=None):
+        """
+        Make the thumbnails that do not exist yet, in parallel, then
+        delete the least recently used thumbnails if the cache is full.
+
+        :param filenames: Names of the image files, which may still be
+                          being found
+        :type filenames: iterable
+        :param processes: Number of processes, defaults to None for the
+                          number of processors
+        :type processes: int
+        :return: None
+        """
+
+        if PILImage is None:
+            return
+
+        # processes are only started once a thumbnail is missing; each
+        # thumbnail is started as soon as its image is found. They are
+        # spawned rather than forked, since a forked child could wait
+        # forever on a lock held by another thread, e.g. Kivy's
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=context) as pool:
+            futures = []
+            for filename in filenames:
+                thumbnail = self._path(filename)
+                if thumbnail is not None and not os.path.exists(thumbnail):
+                    futures.append(pool.submit(
+                        _make_thumbnail, filename, thumbnail, self.size))
+            # images that can't be decoded are left to the viewer
+            concurrent.futures.wait(futures)
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used thumbnails until they take up at
+        most `max_bytes`.
+
+        :return: None
+        """
+
+        with self._evict_lock:
+            try:
+                entries = [entry for entry in os.scandir(self.directory)
+                           if entry.name.endswith('.jpg')]
+            except FileNotFoundError:
+                return
+            stats = []
+            for entry in entries:
+                try:
+                    stats.append((entry.stat(), entry.path))
+                except FileNotFoundError:
+                    pass
+            total = sum(stat.st_size for stat, _path in stats)
+            stats.sort(key=lambda item: item[0].st_mtime)
+            for stat, path in stats:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= stat.st_size
+
+    def _path(self, filename):
+        """
+        Get the name of the thumbnail file for an image.
+
+        :param filename: Name of the image file
+        :type filename: str
+        :return: Name of the thumbnail file, or None if Pillow is not
+                 installed or the image does not exist
+        :rtype: str
+        """
+
+        if PILImage is None:
+            return None
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        key = '{}\0{}\0{}\0{}x{}'.format(
+            os.path.abspath(filename), stat.st_mtime_ns, stat.st_size,
+            *self.size)
+        name = hashlib.sha1(key.encode('utf-8', 'surrogateescape'))
+        return os.path.join(self.directory, name.hexdigest() + '.jpg')
+
+
+def _make_thumbnail(filename, thumbnail, size):
+    """
+    Downscale an image and save it as a JPEG file. Runs in a worker
+    process, so it is not a method.
+
+    :param filename: Name of the image file
+    :type filename: str
+    :param thumbnail: Name of the thumbnail file
+    :type thumbnail: str
+    :param size: Width and height that the thumbnail is downscaled to fit
+    :type size: tuple
+    :return: `thumbnail`
+    :rtype: str
+    """
+
+    os.makedirs(os.path.dirname(thumbnail), exist_ok=True)
+    with PILImage.open(filename) as image:
+        # let JPEG images be decoded at a smaller size to start with
+        image.draft('RGB', size)
+        image.thumbnail(size)
+        image = image.convert('RGB')
+        # write to a temporary file first, so that a thumbnail being
+        # made by another thread or process is never read half-written
+        temp_filename = '{}.{}.{}.tmp'.format(
+            thumbnail, os.getpid(), threading.get_ident())
+        image.save(temp_filename, 'JPEG', quality=90)
+    os.replace(temp_filename, thumbnail)
+    return thumbnail
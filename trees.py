@@ -1,12 +1,21 @@
-import copy
-import os
-import pickle
+import collections
+
+from comparisons import ComparisonCache
+from journal import Journal
 
 
 class AVLTree:
     """A basic AVL tree supporting insertions and deletions."""
     class _Node:
-        """A single node in the AVL tree."""
+        """
+        A single node in the AVL tree.
+        Nodes use __slots__ rather than a __dict__, which keeps them
+        small and fast to create and copy. A subclass adding attributes
+        must list them in its own __slots__.
+        """
+
+        __slots__ = ('value', 'left', 'right', 'height')
+
         def __init__(self, value):
             """
             Create the node.
@@ -20,9 +29,43 @@ class AVLTree:
             self.right = None
             self.height = 1
 
-    def __init__(self):
-        """Create the tree."""
+        def copy(self):
+            """
+            Get a shallow copy of the node.
+
+            :return: The copy
+            :rtype: AVLTree._Node
+            """
+
+            node = object.__new__(type(self))
+            node.assign(self)
+            return node
+
+        def assign(self, other):
+            """
+            Set each attribute of this node to the value of the same
+            attribute of `other`.
+
+            :param other: A node of the same type
+            :type other: AVLTree._Node
+            :return: None
+            """
+
+            for cls in type(self).__mro__[:-1]:
+                for name in cls.__slots__:
+                    setattr(self, name, getattr(other, name))
+
+    def __init__(self, metrics=None):
+        """
+        Create the tree.
+
+        :param metrics: Records how often the tree is rebalanced,
+                        defaults to None to record nothing
+        :type metrics: metrics.Metrics
+        """
+
         self.root = None
+        self.metrics = metrics
 
     def insert(self, value):
         """
@@ -47,18 +90,16 @@ class AVLTree:
         :rtype: AVLTree._Node
         """
 
-        if node is None:
-            # create new leaf node
-            return self._Node(value)
-        elif value < node.value:
-            # insert into left subtree
-            node.left = self._insert(node.left, value)
-        else:
-            # insert into right subtree
-            node.right = self._insert(node.right, value)
+        # find the place for the new leaf, keeping track of the path
+        # down the tree
+        path = []
+        while node is not None:
+            left = self._less(value, node.value)
+            path.append((node, left))
+            node = node.left if left else node.right
 
-        # balance and return
-        return self._balance(node)
+        # create new leaf node, then balance each node on the path
+        return self._rebalance_path(path, self._new_node(value))
 
     def delete(self, value):
         """
@@ -83,31 +124,175 @@ class AVLTree:
         :rtype: AVLTree._Node
         """
 
-        if node is None:
-            return node
-        elif value < node.value:
-            # delete from left subtree
-            node.left = self._delete(node.left, value)
-        elif value > node.value:
-            # delete from right subtree
-            node.right = self._delete(node.right, value)
-        else:
+        # find the node to delete, keeping track of the path down the
+        # tree
+        path = []
+        while node is not None:
+            if self._less(value, node.value):
+                path.append((node, True))
+                node = node.left
+            elif self._greater(value, node.value):
+                path.append((node, False))
+                node = node.right
+            else:
+                break
+
+        if node is not None:
             # delete current node
-            # if node has one child, return that child
+            # if node has one child, replace it with that child
             if node.left is None:
-                return node.right
+                node = node.right
             elif node.right is None:
-                return node.left
+                node = node.left
             else:
                 # node has 2 children;
                 # replace this node's value with the smallest value from
                 # the right subtree, then delete that value from the
                 # right subtree
+                node = self._mutable(node)
                 node.value = self._get_min_node(node.right).value
-                node.right = self._delete(node.right, node.value)
+                node.right = self._delete_min(node.right)
+                node = self._balance(node)
 
-        # balance and return
-        return self._balance(node)
+        # balance each node on the path
+        return self._rebalance_path(path, node)
+
+    def load_sorted(self, values):
+        """
+        Fill an empty tree with values that are already sorted from
+        least to greatest, e.g. the result of an earlier sort, without
+        comparing them. The tree is built perfectly balanced in O(n)
+        time, rather than inserting each value in O(log n).
+
+        :param values: Values sorted from least to greatest
+        :type values: list
+        :return: None
+        """
+
+        if self.root is not None:
+            raise ValueError('values can only be loaded into an empty tree')
+        self.root = self._build(values, 0, len(values))
+
+    def _build(self, values, start, end):
+        """
+        Build a perfectly balanced subtree from the sorted values
+        `values[start:end]`, with the middle value at its root.
+
+        :param values: Values sorted from least to greatest
+        :type values: list
+        :param start: Index of the first value in the subtree
+        :type start: int
+        :param end: Index after the last value in the subtree
+        :type end: int
+        :return: The root of the subtree, or None if it is empty
+        :rtype: AVLTree._Node
+        """
+
+        if start == end:
+            return None
+        middle = (start + end) // 2
+        node = self._new_node(values[middle])
+        node.left = self._build(values, start, middle)
+        node.right = self._build(values, middle + 1, end)
+        self._update_height(node)
+        return node
+
+    def _rebalance_path(self, path, node):
+        """
+        Attach `node` at the bottom of a path down the tree, then
+        balance each node on the path from the bottom up.
+
+        :param path: List of tuples, one for each node on the path from
+                     the top down: the node, and True if the path goes
+                     to its left child or False if it goes to its right
+        :type path: list
+        :param node: The node to attach as the last child on the path
+        :type node: AVLTree._Node
+        :return: The node at the top of the path after balancing
+        :rtype: AVLTree._Node
+        """
+
+        for parent, left in reversed(path):
+            parent = self._mutable(parent)
+            if left:
+                parent.left = node
+            else:
+                parent.right = node
+            node = self._balance(parent)
+        return node
+
+    def _delete_min(self, node):
+        """
+        Delete the smallest value from the subtree with the root `node`,
+        without comparing it to any other values.
+
+        :param node: The root node of the subtree
+        :type node: AVLTree._Node
+        :return: The root node after deletion
+        :rtype: AVLTree._Node
+        """
+
+        path = []
+        while node is not None and node.left is not None:
+            path.append((node, True))
+            node = node.left
+        if node is not None:
+            # this is the minimum node, replace with its right child
+            node = node.right
+        return self._rebalance_path(path, node)
+
+    def _delete_max(self, node):
+        """
+        Delete the largest value from the subtree with the root `node`,
+        without comparing it to any other values.
+
+        :param node: The root node of the subtree
+        :type node: AVLTree._Node
+        :return: The root node after deletion
+        :rtype: AVLTree._Node
+        """
+
+        path = []
+        while node is not None and node.right is not None:
+            path.append((node, False))
+            node = node.right
+        if node is not None:
+            # this is the maximum node, replace with its left child
+            node = node.left
+        return self._rebalance_path(path, node)
+
+    @staticmethod
+    def _less(value, other):
+        """
+        Compare two values. All comparisons made by the tree go through
+        this method or :meth:`_greater`.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is less than `other`, otherwise False
+        :rtype: bool
+        """
+
+        return value < other
+
+    @staticmethod
+    def _greater(value, other):
+        """
+        Compare two values. All comparisons made by the tree go through
+        this method or :meth:`_less`.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is greater than `other`, otherwise
+                 False
+        :rtype: bool
+        """
+
+        return value > other
 
     def _balance(self, node):
         """
@@ -120,8 +305,11 @@ class AVLTree:
         :rtype: AVLTree._Node
         """
 
+        node = self._mutable(node)
         self._update_height(node)
         balance = self._get_balance(node)
+        if (balance > 1 or balance < -1) and self.metrics is not None:
+            self.metrics.count('rotations')
         if balance > 1:  # left heavy
             if self._get_balance(node.left) < 0:  # left right
                 node.left = self._left_rotate(node.left)
@@ -143,7 +331,8 @@ class AVLTree:
         :rtype: AVLTree._Node
         """
 
-        right_node = node.right
+        node = self._mutable(node)
+        right_node = self._mutable(node.right)
         right_left_node = right_node.left
 
         # rotate
@@ -166,7 +355,8 @@ class AVLTree:
         :rtype: AVLTree._Node
         """
 
-        left_node = node.left
+        node = self._mutable(node)
+        left_node = self._mutable(node.left)
         left_right_node = left_node.right
 
         # rotate
@@ -179,6 +369,33 @@ class AVLTree:
 
         return left_node
 
+    def _new_node(self, value):
+        """
+        Create a new leaf node holding `value`.
+
+        :param value: The value of the node
+        :type value: object
+        :return: The new node
+        :rtype: AVLTree._Node
+        """
+
+        return self._Node(value)
+
+    def _mutable(self, node):
+        """
+        Get a version of `node` that may be modified in place.
+        Every method that changes the attributes of an existing node
+        calls this first, and uses the returned node in place of
+        `node`.
+
+        :param node: A node
+        :type node: AVLTree._Node
+        :return: A node that may be modified
+        :rtype: AVLTree._Node
+        """
+
+        return node
+
     @staticmethod
     def _get_height(node):
         """
@@ -221,7 +438,8 @@ class AVLTree:
 
         return self._get_height(node.left) - self._get_height(node.right)
 
-    def _get_min_node(self, node):
+    @staticmethod
+    def _get_min_node(node):
         """
         Get the node with the smallest value from the subtree with the
         root `node`.
@@ -232,9 +450,36 @@ class AVLTree:
         :rtype: AVLTree._Node
         """
 
-        if node.left is None:
-            return node
-        return self._get_min_node(node.left)
+        while node.left is not None:
+            node = node.left
+        return node
+
+    @staticmethod
+    def _get_max_node(node):
+        """
+        Get the node with the largest value from the subtree with the
+        root `node`.
+
+        :param node: A node
+        :type node: AVLTree._Node
+        :return: The node with the largest value
+        :rtype: AVLTree._Node
+        """
+
+        while node.right is not None:
+            node = node.right
+        return node
+
+    def __iter__(self):
+        """
+        Iterate over the values in the tree, from least to greatest.
+        The tree should not be changed during iteration.
+
+        :return: An iterator over the values
+        :rtype: iterator
+        """
+
+        return self._iterate(self.root)
 
     def to_list(self, preorder=False):
         """
@@ -251,35 +496,48 @@ class AVLTree:
         :rtype: list
         """
 
-        return self._to_list(self.root, preorder=preorder)
+        return list(self._iterate(self.root, preorder=preorder))
 
-    def _to_list(self, node, preorder=False):
+    @staticmethod
+    def _iterate(node, preorder=False):
         """
-        Get a list of all values in the subtree with the root `node`.
-        If `preorder` is True, the order of the list will represent a
-        pre-order traversal of the tree.
-        If `preorder` is False, the list will be sorted from least to
+        Generate all values in the subtree with the root `node`.
+        If `preorder` is True, the values are generated in the order of
+        a pre-order traversal of the tree.
+        If `preorder` is False, the values are generated from least to
         greatest.
 
         :param node: A node
         :type node: AVLTree._Node
-        :param preorder: True to get pre-order list, otherwise False,
-                         defaults to False
+        :param preorder: True to generate values in pre-order,
+                         otherwise False, defaults to False
         :type preorder: bool
-        :return: List of values
-        :rtype: list
+        :return: A generator of values
+        :rtype: generator
         """
 
-        if node is None:
-            return []
-
-        left = self._to_list(node.left, preorder=preorder)
-        right = self._to_list(node.right, preorder=preorder)
-        root = [node.value]
-
+        stack = []
         if preorder:
-            return root + left + right
-        return left + root + right
+            if node is not None:
+                stack.append(node)
+            while stack:
+                node = stack.pop()
+                yield node.value
+                # push right first, so that left is visited first
+                if node.right is not None:
+                    stack.append(node.right)
+                if node.left is not None:
+                    stack.append(node.left)
+        else:
+            while stack or node is not None:
+                if node is not None:
+                    # go as far left as possible
+                    stack.append(node)
+                    node = node.left
+                else:
+                    node = stack.pop()
+                    yield node.value
+                    node = node.right
 
 
 class MyTree(AVLTree):
@@ -311,6 +569,8 @@ class MyTree(AVLTree):
         attribute `min_height`.
         """
 
+        __slots__ = ('min_height',)
+
         def __init__(self, value):
             """
             Create the node.
@@ -339,6 +599,8 @@ class MyTree(AVLTree):
 
         if (self._get_height(node) - self._get_min_height(node)) > 1:
             # the tree is a valid AVL tree, but not perfectly balanced
+            if self.metrics is not None:
+                self.metrics.count('shifts')
             if (
                     self._get_min_height(node.left)
                     - self._get_min_height(node.right)
@@ -365,55 +627,16 @@ class MyTree(AVLTree):
         :rtype: MyTree._Node
         """
 
-        def insert_min(node, value):
-            """
-            Insert a value into a subtree, assuming that it is the
-            smallest value without comparing it to any other nodes.
-
-            :param node: The root node of the subtree
-            :type node: MyTree._Node
-            :param value: The value to be inserted
-            :type value: object
-            :return: The root node after insertion
-            :rtype: MyTree._Node
-            """
-
-            if node is None:
-                # create new leaf node
-                return self._Node(value)
-            # insert into left subtree
-            node.left = insert_min(node.left, value)
-            # balance and return
-            return self._balance(node)
-
-        def delete_max(node):
-            """
-            Delete the largest value from the subtree with the root
-            `node`.
-
-            :param node: The root node of the subtree
-            :type node: MyTree._Node
-            :return: The root node after deletion
-            :rtype: MyTree._Node
-            """
-
-            if node is None:
-                return node
-            if node.right is None:
-                # this is the maximum node, replace with its left child
-                return node.left
-            node.right = delete_max(node.right)
-            return self._balance(node)
-
         # copy next greatest value to root node
+        root = self._mutable(root)
         root_value = root.value
         root.value = self._get_max_node(root.left).value
 
         # delete value from left tree
-        root.left = delete_max(root.left)
+        root.left = self._delete_max(root.left)
 
         # insert old root value into right tree
-        root.right = insert_min(root.right, root_value)
+        root.right = self._insert_min(root.right, root_value)
 
         self._update_height(root)
         return root
@@ -431,59 +654,58 @@ class MyTree(AVLTree):
         :rtype: MyTree._Node
         """
 
-        def insert_max(node, value):
-            """
-            Insert a value into a subtree, assuming that it is the
-            largest value without comparing it to any other nodes.
-
-            :param node: The root node of the subtree
-            :type node: MyTree._Node
-            :param value: The value to be inserted
-            :type value: object
-            :return: The root node after insertion
-            :rtype: MyTree._Node
-            """
-
-            if node is None:
-                # create new leaf node
-                return self._Node(value)
-            # insert into right subtree
-            node.right = insert_max(node.right, value)
-            # balance and return
-            return self._balance(node)
-
-        def delete_min(node):
-            """
-            Delete the smallest value from the subtree with the root
-            `node`.
-
-            :param node: The root node of the subtree
-            :type node: MyTree._Node
-            :return: The root node after deletion
-            :rtype: MyTree._Node
-            """
-
-            if node is None:
-                return node
-            if node.left is None:
-                # this is the minimum node, replace with its right child
-                return node.right
-            node.left = delete_min(node.left)
-            return self._balance(node)
-
         # copy next lowest value to root node
+        root = self._mutable(root)
         root_value = root.value
         root.value = self._get_min_node(root.right).value
 
         # delete value from right tree
-        root.right = delete_min(root.right)
+        root.right = self._delete_min(root.right)
 
         # insert old root value into left tree
-        root.left = insert_max(root.left, root_value)
+        root.left = self._insert_max(root.left, root_value)
 
         self._update_height(root)
         return root
 
+    def _insert_min(self, node, value):
+        """
+        Insert a value into a subtree, assuming that it is the smallest
+        value without comparing it to any other nodes.
+
+        :param node: The root node of the subtree
+        :type node: MyTree._Node
+        :param value: The value to be inserted
+        :type value: object
+        :return: The root node after insertion
+        :rtype: MyTree._Node
+        """
+
+        path = []
+        while node is not None:
+            path.append((node, True))
+            node = node.left
+        return self._rebalance_path(path, self._new_node(value))
+
+    def _insert_max(self, node, value):
+        """
+        Insert a value into a subtree, assuming that it is the largest
+        value without comparing it to any other nodes.
+
+        :param node: The root node of the subtree
+        :type node: MyTree._Node
+        :param value: The value to be inserted
+        :type value: object
+        :return: The root node after insertion
+        :rtype: MyTree._Node
+        """
+
+        path = []
+        while node is not None:
+            path.append((node, False))
+            node = node.right
+        return self._rebalance_path(path, self._new_node(value))
+
     @staticmethod
     def _get_min_height(node):
         """
@@ -513,61 +735,258 @@ class MyTree(AVLTree):
             self._get_min_height(node.left),
             self._get_min_height(node.right))
 
-    def _get_max_node(self, node):
+
+class SnapshotHistory:
+    """
+    Undo history for an :class:`UndoTree` which keeps the state of the
+    tree before each insertion as a persistent tree.
+
+    Rather than copying the whole tree, an insertion copies only the
+    nodes that it changes, and shares every other node with the saved
+    states. Each node records the generation (the number of saved
+    states) at which it was created, so that a node belonging to a
+    saved state is never modified in place.
+
+    If `limit` is given and not 0, only the most recent `limit` states
+    are kept, so that memory stays bounded however long the session is.
+    The tree rebuilds older states if an undo goes back further.
+    """
+
+    def __init__(self, limit=None):
         """
-        Get the node with the largest value from the subtree with the
-        root `node`.
+        Create the history.
+
+        :param limit: Maximum number of states to keep, defaults to None
+                      to keep every state, as does 0
+        :type limit: int
+        """
+
+        if limit is not None and limit < 0:
+            raise ValueError('limit must not be negative')
+        self.limit = limit or None
+
+        # root of the tree before each insertion
+        self.roots = collections.deque()
+
+        # nodes from an earlier generation may be shared with a state
+        # in self.roots, and are copied before being modified
+        self.generation = 0
+
+    def __len__(self):
+        """
+        Get the number of saved states.
+
+        :return: The number of saved states
+        :rtype: int
+        """
+
+        return len(self.roots)
+
+    def save(self, root):
+        """
+        Save the state of the tree with the root `root`, before a new
+        value is added to it.
+
+        :param root: The root of the tree
+        :type root: UndoTree._Node
+        :return: None
+        """
+
+        self.roots.append(root)
+        self.generation += 1
+        if self.limit is not None and len(self.roots) > self.limit:
+            self.roots.popleft()
+
+    def restore(self):
+        """
+        Discard the most recent insertion, returning the root of the
+        tree as it was before that insertion.
+
+        :return: The root of the tree
+        :rtype: UndoTree._Node
+        """
+
+        return self.roots.pop()
+
+    def mutable(self, node):
+        """
+        Get a version of `node` that may be modified in place.
+        If `node` belongs to an earlier generation, it may be part of a
+        saved state, so a shallow copy is returned instead.
 
         :param node: A node
-        :type node: MyTree._Node
-        :return: The node with the largest value
-        :rtype: MyTree._Node
+        :type node: UndoTree._Node
+        :return: A node that may be modified
+        :rtype: UndoTree._Node
         """
 
-        if node.right is None:
+        if node is None or node.generation == self.generation:
             return node
-        return self._get_max_node(node.right)
+        node = node.copy()
+        node.generation = self.generation
+        return node
 
 
-class UndoTree(MyTree):
-    """A MyTree that allows any comparison to be undone."""
-    class UndoClicked(Exception):
-        """Raise this exception to undo a comparison."""
-        pass
+class OperationLog:
+    """
+    Undo history for an :class:`UndoTree` which modifies the tree in
+    place, keeping a log of the changes made by each insertion.
+
+    Each entry in the log holds the root of the tree before an
+    insertion, and the previous attributes of every node that the
+    insertion changed (when rebalancing, rotating or shifting). Undoing
+    an insertion writes those attributes back, so its cost depends only
+    on how much the insertion changed, not on the size of the tree.
 
-    class _Undo(Exception):
+    Like :class:`SnapshotHistory`, only the most recent `limit` entries
+    are kept if `limit` is given and not 0.
+    """
+
+    def __init__(self, limit=None):
         """
-        Raised by the recursive method :meth:`_insert` after an
-        :class:`UndoClicked` exception is caught, so that the previous
-        iteration can handle it.
+        Create the history.
+
+        :param limit: Maximum number of entries to keep, defaults to None
+                      to keep every entry, as does 0
+        :type limit: int
         """
 
-        pass
+        if limit is not None and limit < 0:
+            raise ValueError('limit must not be negative')
+        self.limit = limit or None
+
+        # tuples: for each insertion, the root of the tree before the
+        # insertion and a list of (node, old node) pairs
+        self.entries = collections.deque()
+
+        # a node from an earlier generation has not yet been changed by
+        # the current insertion, so its attributes need to be logged
+        self.generation = 0
+
+    def __len__(self):
+        """
+        Get the number of saved states.
 
-    class _Redo(Exception):
+        :return: The number of saved states
+        :rtype: int
         """
-        Raised by the recursive method :meth:`_redo` if it catches an
-        :class:`_Undo` exception, so that the previous iteration can
-        handle it.
+
+        return len(self.entries)
+
+    def save(self, root):
         """
+        Start a new log entry for the tree with the root `root`, before
+        a new value is added to it.
+
+        :param root: The root of the tree
+        :type root: UndoTree._Node
+        :return: None
+        """
+
+        self.entries.append((root, []))
+        self.generation += 1
+        if self.limit is not None and len(self.entries) > self.limit:
+            self.entries.popleft()
+
+    def restore(self):
+        """
+        Reverse the changes made by the most recent insertion, returning
+        the root of the tree as it was before that insertion.
+
+        :return: The root of the tree
+        :rtype: UndoTree._Node
+        """
+
+        root, changes = self.entries.pop()
+        for node, old in reversed(changes):
+            node.assign(old)
+        return root
+
+    def mutable(self, node):
+        """
+        Get a version of `node` that may be modified in place.
+        The node itself is returned; the first time it is changed by
+        the current insertion, its attributes are added to the log.
+
+        :param node: A node
+        :type node: UndoTree._Node
+        :return: A node that may be modified
+        :rtype: UndoTree._Node
+        """
+
+        if node is None or node.generation == self.generation:
+            return node
+        self.entries[-1][1].append((node, node.copy()))
+        node.generation = self.generation
+        return node
 
-        pass
 
-    class _Cancel(Exception):
+class UndoTree(MyTree):
+    """
+    A MyTree that allows any comparison to be undone.
+
+    The state of the tree before each insertion is kept by a history
+    object, either a :class:`SnapshotHistory` or an
+    :class:`OperationLog`.
+
+    Comparisons are answered by an oracle if one is given: any function
+    called with two values, returning 1 if the first is greater, -1 if
+    it is less, or 0 if they are equal, like
+    :meth:`image_sort.CompareImage.compare`. The oracle may raise
+    :class:`UndoTree.UndoClicked` to undo the previous comparison.
+    Otherwise, the values are compared with the < and > operators.
+    """
+
+    class _Node(MyTree._Node):
         """
-        Raised when an undo operation has to go back past the current
-        root of the tree, so that the :meth:`insert` method does not
-        change the root again when the function finishes.
+        A single node in the tree.
+        This is the same as a MyTree node except that it also has the
+        attribute `generation`.
         """
 
+        __slots__ = ('generation',)
+
+        def __init__(self, value, generation=0):
+            """
+            Create the node.
+
+            :param value: The value of the node
+            :type value: object
+            :param generation: The generation of the tree in which the
+                               node was created, defaults to 0
+            :type generation: int
+            """
+
+            super().__init__(value)
+            self.generation = generation
+
+    class UndoClicked(Exception):
+        """Raise this exception to undo a comparison."""
         pass
 
-    def __init__(self):
-        """Create the tree."""
-        super().__init__()
+    def __init__(self, history=None, oracle=None, metrics=None):
+        """
+        Create the tree.
+
+        :param history: Used to store the state of the tree before each
+                        insertion, defaults to a new
+                        :class:`SnapshotHistory`
+        :type history: SnapshotHistory or OperationLog
+        :param oracle: Answers comparisons, defaults to None to compare
+                       the values themselves
+        :type oracle: function
+        :param metrics: Records rebalancing, undos and the size of the
+                        history, defaults to None to record nothing
+        :type metrics: metrics.Metrics
+        """
+
+        super().__init__(metrics)
+        self.oracle = oracle
 
         # store the state of the tree before each insertion
-        self.roots = []
+        if history is None:
+            history = SnapshotHistory()
+        self.history = history
 
         # list of lists: for each value inserted, keep a list of nodes
         # that the value was compared to
@@ -580,6 +999,89 @@ class UndoTree(MyTree):
         # current value to this list to be resumed later
         self.resume = []
 
+        # number of values at the start of self.values that were loaded
+        # by load_sorted; their insertions can't be undone
+        self.loaded = 0
+
+        # number of times each value appears in self.values or
+        # self.resume, so that membership can be checked without
+        # searching either list
+        self._index = {}
+
+        # for metrics: number of undos in a row, and number of existing
+        # nodes changed by the current insertion
+        self._undos = 0
+        self._changed = 0
+
+    def __contains__(self, value):
+        """
+        Check whether `value` has been inserted into the tree, including
+        values waiting to be resumed after an undo.
+
+        :param value: A value
+        :type value: object
+        :return: True if the value has been inserted, otherwise False
+        :rtype: bool
+        """
+
+        return value in self._index
+
+    def load_sorted(self, values):
+        """
+        Fill an empty tree with values that are already sorted from
+        least to greatest, without comparing them, as if they had been
+        inserted in that order. The user never compared them, so undo
+        stops at the first value inserted after them, as it does at the
+        first value of a tree.
+
+        :param values: Values sorted from least to greatest
+        :type values: list
+        :return: None
+        """
+
+        if self.values or self.resume:
+            raise ValueError('values can only be loaded into an empty tree')
+        super().load_sorted(values)
+        self.values = list(values)
+        self.loaded = len(self.values)
+        for value in self.values:
+            self._index[value] = self._index.get(value, 0) + 1
+        # comparisons for these values are rebuilt with the history
+        self.nodes = [None] * len(self.values)
+
+    def upcoming(self, depth=2):
+        """
+        Get the values that the value being inserted may be compared to
+        next: the values below the node it is being compared to, down to
+        `depth` levels.
+
+        :param depth: Number of levels to look down, defaults to 2
+        :type depth: int
+        :return: The values, nearest levels first
+        :rtype: list
+        """
+
+        if not self.nodes or not self.nodes[-1]:
+            return []
+
+        # follow the path of comparisons to the current node
+        node = self.root
+        for value in self.nodes[-1][1:]:
+            if node is None:
+                return []  # not inserting; the path is out of date
+            left = node.left is not None and node.left.value == value
+            node = node.left if left else node.right
+        if node is None:
+            return []
+
+        values = []
+        level = [node]
+        for _ in range(depth):
+            level = [child for n in level for child in (n.left, n.right)
+                     if child is not None]
+            values.extend(child.value for child in level)
+        return values
+
     def insert(self, value):
         """
         Insert a new value into the tree.
@@ -591,114 +1093,281 @@ class UndoTree(MyTree):
 
         self.nodes.append([])  # new sub-list of comparisons
         self.values.append(value)
+        self._index[value] = self._index.get(value, 0) + 1
 
-        try:
-            super().insert(value)
-        except self._Cancel:
-            pass  # root has already been affected elsewhere
+        self._insert_last()
 
         # check if any values were moved to self.resume
         if self.resume:
-            self.insert(self.resume.pop())
+            self._reinsert(self.resume)
 
-    def _insert(self, node, value):
+    def _reinsert(self, values):
         """
-        Insert a new value into the subtree with the root `node`.
+        Remove the last value from `values` and insert it again.
 
-        :param node: A node
-        :type node: MyTree._Node
-        :param value: A new value
-        :type value: object
-        :return: The root of the subtree after insertion
-        :rtype: MyTree._Node
+        :param values: Either `self.values` or `self.resume`
+        :type values: list
+        :return: None
         """
 
-        if node is None:
-            if self.root:
-                # store a copy of the current root before insertion
-                self.roots.append(copy.deepcopy(self.root))
+        value = values.pop()
+        count = self._index.pop(value) - 1
+        if count:
+            self._index[value] = count
+        self.insert(value)
+
+    def _insert_last(self, redo=False):
+        """
+        Insert the last value in `self.values` into the tree.
+
+        If the user undoes a comparison, the previous comparison is
+        asked again. Undoing the first comparison goes back to the
+        insertion of the previous value, moving the current value to
+        `self.resume`.
+
+        :param redo: True if the comparisons in the last list in
+                     `self.nodes` have already been made, and the last of
+                     them should be asked again, defaults to False
+        :type redo: bool
+        :return: None
+        """
+
+        value = self.values[-1]
+        if redo:
+            path, node = self._follow(self.nodes[-1])
+            self.nodes[-1].pop()  # discard the last comparison
         else:
+            path, node = [], self.root
+
+        while node is not None:
             # keep track of the comparison to this node
             self.nodes[-1].append(node.value)
-
-        try:
-            return super()._insert(node, value)
-        except self.UndoClicked:
-            if node == self.root:  # need to undo past the current root
-                # get rid of comparisons to the current value
-                self.nodes.pop()
-
-                if not self.roots:
-                    # this is the first value, can't go back further
-                    # just do insertion again
-                    self.insert(self.values.pop())
-                else:
+            try:
+                left = self._less(value, node.value)
+            except self.UndoClicked:
+                self._undos += 1
+                self.nodes[-1].pop()  # discard this comparison
+                if path:
+                    # just go back to parent node; discard its
+                    # comparison since it will be added again
+                    node = path.pop()[0]
+                    self.nodes[-1].pop()
+                elif len(self.values) > max(2, self.loaded + 1):
+                    # need to undo past the current root
+                    if self.metrics is not None:
+                        self.metrics.count('undos_past_value')
+                    # get rid of comparisons to the current value
+                    self.nodes.pop()
                     # move current value to self.resume
                     self.resume.append(self.values.pop())
+                    if not self.history:
+                        # the earlier states were never recorded, or
+                        # were discarded to keep within the limit
+                        self._rebuild()
                     # go back to previous state of root
-                    self.root = self.roots.pop()
+                    self.root = self.history.restore()
                     # redo insertion of the previous value
-                    self.root = self._redo(
-                        self.root, self.values[-1], self.nodes[-1])
+                    value = self.values[-1]
+                    path, node = self._follow(self.nodes[-1])
+                    self.nodes[-1].pop()  # discard the last comparison
+                # otherwise this is the first value, or the first
+                # after the values loaded by load_sorted, can't go back
+                # further; just do the comparison again
+                continue
+            if self._undos:
+                if self.metrics is not None:
+                    self.metrics.count('undos', self._undos)
+                    self.metrics.observe('undo_depth', self._undos)
+                self._undos = 0
+            path.append((node, left))
+            node = node.left if left else node.right
+
+        if self.root:
+            # store the state of the tree before insertion
+            self.history.save(self.root)
+        self.root = self._rebalance_path(path, self._new_node(value))
+
+        limit = self.history.limit
+        if limit is not None and len(self.nodes) > limit + 1:
+            # the comparisons are only needed to redo the insertions
+            # whose states are still in the history
+            self.nodes[-limit - 2] = None
+
+        if self.metrics is not None:
+            # the size of the state saved for this insertion
+            self.metrics.observe('history_nodes', self._changed)
+            self.metrics.set('history_states', len(self.history))
+        self._changed = 0
+
+    def _follow(self, values):
+        """
+        Follow a path down the tree from the root, without comparing any
+        values. The list `values` gives the value of each node on the
+        path; the first should equal the value of the root.
+
+        :param values: List of values representing the path down the
+                       tree
+        :type values: list
+        :return: A list of tuples for every node on the path but the
+                 last, each holding the node and True if the path goes
+                 to its left child or False if it goes to its right, and
+                 the last node on the path
+        :rtype: tuple
+        """
 
-                # prevent insert method from assigning root again
-                raise self._Cancel
-            else:
-                # just go back to parent node
-                self.nodes[-1].pop()  # discard this comparison
-                raise self._Undo  # caught by _insert on parent node
-        except self._Undo:
-            # discard this comparison since it will be added again
-            self.nodes[-1].pop()
-            return self._insert(node, value)  # do comparison again
+        path = []
+        node = self.root
+        for value in values[1:]:
+            left = node.left is not None and node.left.value == value
+            path.append((node, left))
+            node = node.left if left else node.right
+        return path, node
+
+    def _rebuild(self):
+        """
+        Rebuild the history, and the comparisons for each value in
+        `self.nodes`, by inserting every value into a new tree in the
+        order they were originally inserted. Instead of asking for
+        comparisons again, the new tree orders values by their position
+        in this tree.
 
-    def _redo(self, node, value, path):
+        This is needed when the tree was loaded without its history, or
+        when an undo goes back past the states kept by a history with a
+        limit.
+
+        :return: None
         """
-        Redo the insertion of `value` into `node`.
 
-        To avoid comparing any values on the way down the tree, the list
-        `path` is used to specify the path from the root `node` down to
-        the desired node. The first value of `path` should equal the
-        value of the root `node`, and the last value will be the value
-        compared to the parameter `value`.
+        tree = _OrderedTree(
+            self.to_list(), type(self.history)(self.history.limit))
+        for value in self.values:
+            tree.insert(value)
+        self.root = tree.root
+        self.history = tree.history
+        self.nodes = tree.nodes
+
+    def _less(self, value, other):
+        """
+        Compare two values, asking the oracle if there is one.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is less than `other`, otherwise False
+        :rtype: bool
+        """
+
+        if self.oracle is None:
+            return super()._less(value, other)
+        return self.oracle(value, other) < 0
+
+    def _greater(self, value, other):
+        """
+        Compare two values, asking the oracle if there is one.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is greater than `other`, otherwise
+                 False
+        :rtype: bool
+        """
+
+        if self.oracle is None:
+            return super()._greater(value, other)
+        return self.oracle(value, other) > 0
+
+    def _new_node(self, value):
+        """
+        Create a new leaf node holding `value`, belonging to the
+        current generation.
+
+        :param value: The value of the node
+        :type value: object
+        :return: The new node
+        :rtype: UndoTree._Node
+        """
+
+        return self._Node(value, self.history.generation)
+
+    def _mutable(self, node):
+        """
+        Get a version of `node` that may be modified in place, as
+        decided by the history.
 
         :param node: A node
-        :type node: MyTree._Node
-        :param value: The value to insert
+        :type node: UndoTree._Node
+        :return: A node that may be modified
+        :rtype: UndoTree._Node
+        """
+
+        if (self.metrics is not None and node is not None
+                and node.generation != self.history.generation):
+            self._changed += 1
+        return self.history.mutable(node)
+
+
+class _OrderedTree(UndoTree):
+    """
+    An UndoTree that compares values by their position in a list that
+    is already sorted, used to rebuild the history of another tree.
+    """
+
+    def __init__(self, sorted_values, history):
+        """
+        Create the tree.
+
+        :param sorted_values: Every value that will be inserted, sorted
+                              from least to greatest
+        :type sorted_values: list
+        :param history: Used to store the state of the tree before each
+                        insertion
+        :type history: SnapshotHistory or OperationLog
+        """
+
+        super().__init__(history)
+        self.positions = {
+            id(value): i for i, value in enumerate(sorted_values)}
+
+    def _less(self, value, other):
+        """
+        Compare two values by their positions in the sorted list.
+
+        :param value: A value
         :type value: object
-        :param path: List of values representing the path down the tree
-        :type path: list
-        :return: The root node after insertion
-        :rtype: MyTree._Node
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is less than `other`, otherwise False
+        :rtype: bool
         """
 
-        try:
-            if len(path) <= 1:  # last node in path reached
-                self.nodes[-1].pop()  # discard the last comparison
-                return self._insert(node, value)  # insert node
-            if node.left and node.left.value == path[1]:
-                # next value in path is on the left
-                # call redo on left child
-                node.left = self._redo(node.left, value, path[1:])
-            elif node.right and node.right.value == path[1]:
-                # next value in path is on the right
-                # call redo on right child
-                node.right = self._redo(node.right, value, path[1:])
-
-            # balance and return
-            return self._balance(node)
-        except self._Undo:
-            # go back to previous/parent node
-            raise self._Redo
-        except self._Redo:
-            # insert into this node
-            return self._redo(node, value, path[:1])
+        return self.positions[id(value)] < self.positions[id(other)]
 
 
 class SaveStateTree(UndoTree):
     """
-    An UndoTree that can save its current state to a file, to be resumed
+    An UndoTree that saves its state to a file as it goes, to be resumed
     at a later time.
+
+    The file is a :class:`Journal`: each inserted value, comparison
+    answer and undo is appended to it as soon as it happens, and when
+    the tree exits, a checkpoint of the whole tree replaces the records.
+    When the tree is created from an existing file, the checkpoint is
+    loaded and any records after it are replayed, so the user is asked
+    only the comparisons that were not answered before.
+
+    The history is not saved; if the user undoes past the values
+    inserted since the tree was loaded, the history is rebuilt.
+
+    Every answer is also kept in a :class:`ComparisonCache`, which is
+    saved with the tree. Before asking the user, the tree checks
+    whether the same comparison was answered before, e.g. before an
+    undo. It doesn't search for answers by transitivity: a value being
+    inserted is only compared with the nodes on its path, and the
+    answers so far place it between two of them, so no answer about the
+    next node can be inferred.
     """
 
     class Exit(Exception):
@@ -708,51 +1377,264 @@ class SaveStateTree(UndoTree):
 
         pass
 
-    def __init__(self, filename):
+    class Pause(Exception):
+        """
+        Raise this exception to stop inserting, without saving, until
+        :meth:`continue_insert` is called. The comparison being made is
+        asked again then.
+        """
+
+        pass
+
+    def __init__(self, filename, history=None, value_type=None,
+                 oracle=None, metrics=None):
         """
-        Create the tree. When necessary, the tree will be saved to
-        `filename`. If the file exists at the time of initialization,
-        the tree will be loaded from the file.
+        Create the tree. The tree will be saved to `filename`. If the
+        file exists at the time of initialization, the tree will be
+        loaded from the file.
+
+        Only strings and integers can be saved; values loaded from the
+        file are converted back with `value_type`.
 
         :param filename: Name of the file to save to
         :type filename: str
+        :param history: Used to store the state of the tree before each
+                        insertion, defaults to a new
+                        :class:`SnapshotHistory`
+        :type history: SnapshotHistory or OperationLog
+        :param value_type: Type of the values inserted, e.g.
+                           :class:`image_sort.CompareImage`, defaults to
+                           None to load plain strings and integers
+        :type value_type: type
+        :param oracle: Answers comparisons, defaults to None to compare
+                       the values themselves
+        :type oracle: function
+        :param metrics: Also records the comparisons answered from the
+                        cache, and how long the user took to answer the
+                        rest, defaults to None to record nothing
+        :type metrics: metrics.Metrics
         """
 
-        super().__init__()
+        super().__init__(history, oracle, metrics)
         self.filename = filename
+        self._journal = Journal(filename, value_type)
+
+        # True while inside a call to insert, so that values resumed
+        # after an undo are not written to the journal again
+        self._inserting = False
+
+        # True after an undo, so that the comparison asked again goes to
+        # the user even if its answer could be inferred
+        self._undone = False
+
+        # True if an insertion was stopped by the Pause exception
+        self._paused = False
+
+        checkpoint, records = self._journal.read(self._new_node)
+        self.cache = ComparisonCache(checkpoint.answers)
+        self.root = checkpoint.root
+        self.values = checkpoint.values
+        self.resume = checkpoint.resume
+        self.loaded = checkpoint.loaded
+        for value in self.values + self.resume:
+            self._index[value] = self._index.get(value, 0) + 1
+        # comparisons for earlier values are rebuilt with the history
+        self.nodes = [None] * len(self.values)
+
+        # records that have not been replayed yet; comparisons are
+        # answered from these until they run out, then the user is asked
+        self._replay = collections.deque(records)
+
         try:
-            with open(self.filename, 'rb') as f:
-                # get tree from file
-                tree = pickle.load(f)
-                # copy tree to self
-                self.__dict__ = tree.__dict__
+            if checkpoint.in_progress:
                 # resume where previously left off
-                self.root = self._redo(
-                    self.root, self.values[-1], self.nodes[-1])
-        except self.Exit:
-            self.exit()
-        except self._Cancel:
-            pass  # root has already been affected elsewhere
-        except FileNotFoundError:
-            pass  # file does not exist, create new tree
+                self.nodes[-1] = checkpoint.path
+                self._resume_insert()
 
-        # check if any values were moved to self.resume
-        if self.resume:
-            self.insert(self.resume.pop())
+            # replay each insertion
+            while self._replay:
+                _kind, value = self._replay.popleft()
+                self._insert_value(value)
+        except self.Pause:
+            pass  # the records ran out; continued by continue_insert
 
     def insert(self, value):
         """
-        Insert a new value into the tree.
+        Insert a new value into the tree. If an insertion was paused, it
+        is finished first.
+
+        :param value: A new value
+        :type value: object
+        :return: None
+        """
+
+        self.continue_insert()
+        if not self._inserting:
+            self._journal.append(Journal.INSERT, value)
+        self._insert_value(value)
+
+    def load_sorted(self, values):
+        """
+        Fill an empty tree with values that are already sorted, without
+        comparing them, and save the tree to file with them.
+
+        :param values: Values sorted from least to greatest
+        :type values: list
+        :return: None
+        """
+
+        super().load_sorted(values)
+        self._journal.save(
+            self.values, self.root, [], self.resume, False,
+            self.cache.answers, self.loaded)
+
+    def _insert_value(self, value):
+        """
+        Insert a new value into the tree without writing it to the
+        journal.
 
         :param value: A new value
         :type value: object
         :return: None
         """
 
+        inserting = self._inserting
+        self._inserting = True
         try:
             super().insert(value)
         except self.Exit:
+            if inserting:
+                raise  # handled by the outermost insertion
             self.exit()
+        except self.Pause:
+            if not inserting:
+                self._paused = True
+            raise
+        finally:
+            self._inserting = inserting
+
+    def continue_insert(self):
+        """
+        Finish the insertion stopped by the Pause exception, if any.
+
+        :return: None
+        """
+
+        if self._paused:
+            self._paused = False
+            self._resume_insert()
+
+    def _resume_insert(self):
+        """
+        Resume the insertion of the last value, which was in progress
+        when the tree was saved or paused.
+
+        :return: None
+        """
+
+        self._inserting = True
+        try:
+            self._insert_last(redo=True)
+
+            # check if any values were moved to self.resume
+            if self.resume:
+                self._reinsert(self.resume)
+        except self.Exit:
+            self.exit()
+        except self.Pause:
+            self._paused = True
+            raise
+        finally:
+            self._inserting = False
+
+    def _less(self, value, other):
+        """
+        Compare two values, taking the answer from the journal if it is
+        being replayed, or from the cache if it is known. Otherwise, the
+        user is asked. Every answer is written to the journal and added
+        to the cache.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is less than `other`, otherwise False
+        :rtype: bool
+        """
+
+        if self._replay:
+            kind, answer = self._replay.popleft()
+            if kind == Journal.UNDO:
+                self._undo_answer()
+                raise self.UndoClicked
+        else:
+            answer = None if self._undone else self.cache.less(
+                value, other, infer=False)
+            if answer is None:
+                try:
+                    answer = self._ask(super()._less, value, other)
+                except self.UndoClicked:
+                    self._journal.append(Journal.UNDO)
+                    self._undo_answer()
+                    raise
+            elif self.metrics is not None:
+                self.metrics.count('comparisons_cached')
+            self._journal.append(Journal.ANSWER, answer)
+
+        self._undone = False
+        if answer:
+            self.cache.add(value, other)
+        else:
+            self.cache.add(other, value)
+        return answer
+
+    def _greater(self, value, other):
+        """
+        Compare two values with :meth:`_less`, so that the answer is
+        taken from the cache, e.g. when a deletion asks about the same
+        pair after :meth:`_less`, and is journaled like any other.
+
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: True if `value` is greater than `other`, otherwise
+                 False
+        :rtype: bool
+        """
+
+        return self._less(other, value)
+
+    def _ask(self, compare, value, other):
+        """
+        Ask the user to compare two values, recording how long they
+        took if there are metrics.
+
+        :param compare: The method of :class:`UndoTree` that asks
+        :type compare: function
+        :param value: A value
+        :type value: object
+        :param other: The value to compare to
+        :type other: object
+        :return: The answer
+        :rtype: bool
+        """
+
+        if self.metrics is None:
+            return compare(value, other)
+        self.metrics.count('comparisons_asked')
+        return self.metrics.timed('answer_seconds', compare, value, other)
+
+    def _undo_answer(self):
+        """
+        Remove the answer to the comparison that will be asked again
+        after an undo.
+
+        :return: None
+        """
+
+        self.cache.undo()
+        self._undone = True
 
     def delete_file(self):
         """
@@ -761,10 +1643,7 @@ class SaveStateTree(UndoTree):
         :return: None
         """
 
-        try:
-            os.remove(self.filename)
-        except FileNotFoundError:
-            pass
+        self._journal.delete()
 
     def exit(self):
         """
@@ -773,6 +1652,9 @@ class SaveStateTree(UndoTree):
         :return: None
         """
 
-        with open(self.filename, 'wb') as f:
-            pickle.dump(self, f)
+        in_progress = self._inserting or self._paused
+        path = self.nodes[-1] if in_progress else []
+        self._journal.save(
+            self.values, self.root, path, self.resume, in_progress,
+            self.cache.answers, self.loaded)
         raise self.Exit